@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from cascade import is_bagged_forest, tree_predictions
+from hamming_index import hamming_distances, load_index, pack_geometries
+from inference import artifact_model_name, load_model, predict
+from inverse_design import CELL_ROWS, CELL_COLS, cells_to_images, model_input, random_candidates, read_candidates
+
+# Active sampling of the next geometries to simulate (FDFD).
+#   score      a pool of candidate 10x20 grids (random or a .npy, as in inverse_design.py) is scored by
+#              the disagreement of several models (any types) or the tree spread of one bagged forest,
+#              mean std over the 24 outputs
+#   diversity  from the --prefilter x batch most uncertain, greedy selection of uncertainty x Hamming
+#              distance to the closest geometry already picked (or already simulated: --index, a
+#              compressed hamming_index.py index), so a batch does not spend simulations on near-twins
+#   output     <datapath>/<name>/<id>.tiff in the dataset layout, <datapath>/<name>.pending.csv with the ids
+#              to simulate; the simulated spectra go into <datapath>/<name>.csv (id, 24 transmittances)
+
+
+def pool_uncertainty(models, model_names, cells, input_shape_type, **predict_args):
+    if len(models) > 1:
+        predictions = np.stack([predict(model, model_input(cells, model_name, input_shape_type), **predict_args)
+                                for model, model_name in zip(models, model_names)], axis=1)
+    elif is_bagged_forest(models[0]):
+        predictions = tree_predictions(models[0], model_input(cells, model_names[0], input_shape_type))
+    else:
+        raise ValueError('The uncertainty needs a bagged forest (rf, extratree) or several models')
+    return predictions.std(axis=1).mean(axis=1)
+
+
+def select_diverse(cells, uncertainty, batch_size, prefilter=10, reference_distance=None):
+    # greedy: the candidate with the largest uncertainty x distance to everything picked so far
+    candidates = np.argsort(-uncertainty)[:batch_size * prefilter]
+    words, n_bits = pack_geometries(cells[candidates])
+    distance = np.full(len(candidates), n_bits, dtype=np.int32)
+    if reference_distance is not None:
+        distance = np.minimum(distance, reference_distance[candidates])
+    selected = []
+    for _ in range(min(batch_size, len(candidates))):
+        score = np.where(distance > 0, uncertainty[candidates] * distance, -1)
+        best = int(np.argmax(score))
+        if score[best] < 0:
+            break
+        selected.append(best)
+        distance = np.minimum(distance, hamming_distances(words[best:best + 1], words)[0])
+    return candidates[selected]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--models", help="Several models, or one bagged forest (keras path without "
+                                               ".json/.h5, or .joblib)", nargs='+', required=True)
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-n", "--pool", help="Random candidates scored", default=100000)
+    parser.add_argument("--candidates", help="Score a .npy of (N, 10, 20) grids or (N, 100, 200) images instead",
+                        default=None)
+    parser.add_argument("--fill", help="Fraction of open cells of the random candidates", default=0.5)
+    parser.add_argument("-k", "--batch", help="Geometries selected for simulation", default=500)
+    parser.add_argument("--prefilter", help="Diversity selection among the prefilter x batch most uncertain",
+                        default=10)
+    parser.add_argument("--index", help="Compressed (10x20) hamming_index.py index of the simulated geometries",
+                        default=None)
+    parser.add_argument("-b", "--batch_size", help="Candidates per batch", default=4096)
+    parser.add_argument("--seed", help="Random seed", default=0)
+    parser.add_argument("--datapath", help="Folder the selected dataset is written to", default='./data/pending')
+    parser.add_argument("--name", help="Dataset name", default='binary_active_1')
+
+    args = parser.parse_args()
+    batch_size = int(args.batch_size)
+    models = [load_model(path) for path in args.models]
+    model_names = [artifact_model_name(path) for path in args.models]
+    if len(models) == 1 and not is_bagged_forest(models[0]):
+        parser.error('a single model has to be a bagged forest (rf, extratree) for its tree variance')
+    index = None
+    if args.index:
+        index, _ = load_index(args.index)
+        if index.n_bits != CELL_ROWS * CELL_COLS:
+            parser.error('the index has to be built on compressed (10x20) geometries')
+
+    if args.candidates:
+        batches = read_candidates(args.candidates, batch_size)
+    else:
+        batches = random_candidates(int(args.pool), batch_size, float(args.fill), int(args.seed))
+    # only the most uncertain prefilter x batch candidates are kept while the pool streams by
+    keep = int(args.batch) * int(args.prefilter)
+    start_time = time.time()
+    pool = np.zeros((0, CELL_ROWS, CELL_COLS), dtype=np.uint8)
+    uncertainty = np.zeros(0)
+    reference_distance = np.zeros(0, dtype=np.int32)
+    pool_uncertainty_all = []
+    n_pool = 0
+    for cells in batches:
+        batch_uncertainty = pool_uncertainty(models, model_names, cells, args.shape)
+        pool_uncertainty_all.append(batch_uncertainty)
+        n_pool += len(cells)
+        pool = np.concatenate([pool, cells])
+        uncertainty = np.concatenate([uncertainty, batch_uncertainty])
+        if index is not None:
+            distances, _ = index.query(pack_geometries(cells)[0], k=1)
+            reference_distance = np.concatenate([reference_distance, distances[:, 0].astype(np.int32)])
+        if len(pool) > keep:
+            kept = np.argpartition(-uncertainty, keep - 1)[:keep]
+            pool, uncertainty = pool[kept], uncertainty[kept]
+            if index is not None:
+                reference_distance = reference_distance[kept]
+    if index is None:
+        reference_distance = None
+    pool_uncertainty_all = np.concatenate(pool_uncertainty_all)
+    print('Scored {} candidates in {:.3f}s'.format(n_pool, time.time() - start_time))
+
+    selected = select_diverse(pool, uncertainty, int(args.batch), int(args.prefilter), reference_distance)
+    print('Selected {} geometries, uncertainty {:.5f} - {:.5f} (pool median {:.5f})'.format(
+        len(selected), uncertainty[selected].min(), uncertainty[selected].max(), np.median(pool_uncertainty_all)))
+
+    from PIL import Image
+    dataset_folder = os.path.join(args.datapath, args.name)
+    if os.path.exists(dataset_folder):
+        parser.error('{} exists already'.format(dataset_folder))
+    os.makedirs(dataset_folder)
+    for file_id, candidate in enumerate(selected, 1):
+        Image.fromarray(cells_to_images(pool[candidate])).save(os.path.join(dataset_folder, '{}.tiff'.format(file_id)))
+    np.savetxt(os.path.join(args.datapath, '{}.pending.csv'.format(args.name)),
+               np.column_stack([np.arange(1, len(selected) + 1), uncertainty[selected]]),
+               delimiter=',', fmt=['%d', '%.6f'])
+    with open(os.path.join(args.datapath, '{}.manifest.json'.format(args.name)), 'w') as manifest_file:
+        json.dump({
+            'models': args.models,
+            'pool': n_pool,
+            'candidates': args.candidates,
+            'seed': int(args.seed),
+            'selected': len(selected),
+            'pool_uncertainty_median': float(np.median(pool_uncertainty_all)),
+            'min_distance_to_simulated': (int(reference_distance[selected].min())
+                                          if reference_distance is not None and len(selected) else None),
+        }, manifest_file, indent=2)
+    print('Wrote {} geometries to {}, ids to simulate in {}.pending.csv'.format(len(selected), dataset_folder,
+                                                                               args.name))
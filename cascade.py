@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+
+from inference import TracedModel, artifact_model_name, load_model, predict, prepare_input
+from spectrum_metrics import compute_metrics, local_minmax_array
+from train import DATAPATH_VALID, DATASETS_VALID, DATAPATH_TEST, DATASETS_TEST, load_dataset
+
+# Two-tier cascade: a cheap model on the 10x20 subsample predicts every geometry, only the samples
+# it is unsure about go to the keras model (cnn), all escalations in one batched call.
+# Uncertainty of the cheap tier, mean std over the 24 outputs of
+#   one bagged forest (rf, extratree, sklearn or compiled .forest)  the spread of its trees
+#   several cheap models                                           their disagreement
+# The threshold is calibrated on the validation set: the smallest escalation rate whose RMSE is
+# within --max_rmse_increase of always running the cnn (or a fixed --escalation_rate).
+
+
+def is_bagged_forest(model):
+    if hasattr(model, 'meta'):
+        return model.meta['kind'] == 'mean' and model.meta['n_trees'] > 1
+    return isinstance(model, (RandomForestRegressor, ExtraTreesRegressor))
+
+
+def tree_predictions(model, x, batch_size=2048):
+    # (n_samples, n_trees, n_outputs)
+    if hasattr(model, 'meta'):
+        return np.concatenate([model.predict_trees(x[start:start + batch_size])
+                               for start in range(0, len(x), batch_size)])
+    return np.stack([tree.predict(x) for tree in model.estimators_], axis=1)
+
+
+def predict_with_uncertainty(models, x, **predict_args):
+    if len(models) > 1:
+        predictions = np.stack([predict(model, x, **predict_args) for model in models], axis=1)
+    elif is_bagged_forest(models[0]):
+        predictions = tree_predictions(models[0], x)
+    else:
+        raise ValueError('The uncertainty needs a bagged forest (rf, extratree) or several cheap models')
+    return predictions.mean(axis=1), predictions.std(axis=1).mean(axis=1)
+
+
+def calibrate_threshold(y, y_cheap, y_expensive, uncertainty, max_rmse_increase=0.05, escalation_rate=None):
+    # escalating the k most uncertain samples swaps their cheap error for the expensive one
+    order = np.argsort(-uncertainty)
+    cheap_error = np.square(y_cheap - y).sum(axis=1)[order]
+    expensive_error = np.square(y_expensive - y).sum(axis=1)[order]
+    squares = cheap_error.sum() - np.concatenate([[0], np.cumsum(cheap_error - expensive_error)])
+    rmse = np.sqrt(np.maximum(squares, 0) / y.size)
+    if escalation_rate is not None:
+        k = int(np.ceil(escalation_rate * len(y)))
+    else:
+        target = np.sqrt(expensive_error.sum() / y.size) * (1 + max_rmse_increase)
+        within = np.flatnonzero(rmse <= target)
+        k = int(within[0]) if len(within) else len(y)
+    # samples with an uncertainty above the threshold escalate
+    threshold = float(uncertainty[order[k]]) if k < len(y) else -1.0
+    return threshold, k / len(y), float(rmse[k])
+
+
+class CascadePredictor:
+    def __init__(self, cheap_models, cheap_name, expensive_model, expensive_name, threshold, input_shape_type,
+                 batch_size=256):
+        self.cheap_models = cheap_models
+        self.cheap_name = cheap_name
+        self.expensive_model = expensive_model
+        self.expensive_name = expensive_name
+        self.threshold = threshold
+        self.input_shape_type = input_shape_type
+        self.batch_size = batch_size
+
+    def predict(self, images):
+        y, uncertainty = predict_with_uncertainty(self.cheap_models,
+                                                  prepare_input(images, self.cheap_name, self.input_shape_type))
+        escalated = np.flatnonzero(uncertainty > self.threshold)
+        if len(escalated):
+            x = prepare_input(images[escalated], self.expensive_name, self.input_shape_type)
+            y[escalated] = predict(self.expensive_model, x, batch_size=self.batch_size)
+        return y, uncertainty, escalated
+
+
+def load_cascade(config_path, batch_size=256):
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+    cheap_models = [load_model(path) for path in config['cheap']]
+    expensive_model = TracedModel(load_model(config['expensive']), [1, batch_size])
+    return CascadePredictor(cheap_models, artifact_model_name(config['cheap'][0]), expensive_model,
+                            artifact_model_name(config['expensive']), config['threshold'], config['shape'],
+                            batch_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cheap", help="Cheap tier: one bagged forest or several models (.joblib)",
+                        nargs='+', required=True)
+    parser.add_argument("-m", "--model", help="Expensive tier, keras model (path without .json/.h5)",
+                        required=True)
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-b", "--batch_size", help="Batch size of the escalated samples", default=256)
+    parser.add_argument("--max_rmse_increase", help="Relative validation RMSE increase over always-cnn allowed",
+                        default=0.05)
+    parser.add_argument("--escalation_rate", help="Fixed fraction of samples escalated (instead of the RMSE "
+                                                  "target)", default=None)
+    parser.add_argument("--max_samples", help="Validation and test samples used (0: all)", default=0)
+    parser.add_argument("-o", "--output", help="Cascade config path", default='result/cascade/cascade.json')
+
+    args = parser.parse_args()
+    batch_size = int(args.batch_size)
+    max_samples = int(args.max_samples) or None
+    escalation_rate = float(args.escalation_rate) if args.escalation_rate else None
+
+    cheap_models = [load_model(path) for path in args.cheap]
+    cheap_name = artifact_model_name(args.cheap[0])
+    expensive_name = artifact_model_name(args.model)
+    expensive_model = TracedModel(load_model(args.model), [1, batch_size])
+    if len(cheap_models) == 1 and not is_bagged_forest(cheap_models[0]):
+        parser.error('a single cheap model has to be a bagged forest (rf, extratree) for its tree variance')
+
+    print('Data Loading... Validation dataset Start.')
+    images_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, 'cnn', args.shape,
+                                                   max_samples=max_samples)
+    print('Data Loading... Validation dataset Finished.')
+    y_cheap, uncertainty = predict_with_uncertainty(cheap_models, prepare_input(images_validation, cheap_name,
+                                                                                args.shape))
+    y_expensive = predict(expensive_model, prepare_input(images_validation, expensive_name, args.shape))
+    threshold, validation_rate, validation_rmse = calibrate_threshold(
+        y_validation, y_cheap, y_expensive, uncertainty, float(args.max_rmse_increase), escalation_rate)
+    print('Threshold {:.5f}: {:.1%} of the validation set escalated, RMSE {:.4f}'.format(
+        threshold, validation_rate, validation_rmse))
+
+    config = {
+        'cheap': args.cheap,
+        'expensive': args.model,
+        'shape': args.shape,
+        'threshold': threshold,
+        'validation': {'escalation_rate': validation_rate, 'rmse': validation_rmse},
+    }
+    if not os.path.exists(os.path.dirname(args.output) or '.'):
+        os.makedirs(os.path.dirname(args.output))
+    with open(args.output, 'w') as config_file:
+        json.dump(config, config_file, indent=2)
+    print('Saved cascade config to {}'.format(args.output))
+
+    print('Data Loading... Test dataset Start.')
+    images_test, y_test = load_dataset(DATAPATH_TEST, DATASETS_TEST, 'cnn', args.shape, max_samples=max_samples)
+    print('Data Loading... Test dataset Finished.')
+    mask_array = local_minmax_array(y_test)
+    cascade = CascadePredictor(cheap_models, cheap_name, expensive_model, expensive_name, threshold, args.shape,
+                               batch_size)
+
+    start_time = time.time()
+    y_always = predict(expensive_model, prepare_input(images_test, expensive_name, args.shape),
+                       batch_size=batch_size)
+    always_time = time.time() - start_time
+    start_time = time.time()
+    y_cascade, _, escalated = cascade.predict(images_test)
+    cascade_time = time.time() - start_time
+    y_cheap, _ = predict_with_uncertainty(cheap_models, prepare_input(images_test, cheap_name, args.shape))
+
+    report = {
+        'config': config,
+        'escalation_rate': len(escalated) / len(y_test),
+        'cheap': compute_metrics(y_test, y_cheap, mask_array),
+        'cnn': compute_metrics(y_test, y_always, mask_array),
+        'cascade': compute_metrics(y_test, y_cascade, mask_array),
+    }
+    report['cnn']['seconds'] = always_time
+    report['cascade']['seconds'] = cascade_time
+    with open(os.path.splitext(args.output)[0] + '.report.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print('test: {} of {} samples escalated ({:.1%})'.format(len(escalated), len(y_test),
+                                                             report['escalation_rate']))
+    print('{:<20}{:>12}{:>12}{:>12}'.format('', 'cheap', 'cnn', 'cascade'))
+    for key in ['rmse', 'r2', 'local_minmax_rmse', 'r2_local_minmax', 'diff_rmse']:
+        print('{:<20}{:>12.4f}{:>12.4f}{:>12.4f}'.format(key, report['cheap'][key], report['cnn'][key],
+                                                        report['cascade'][key]))
+    print('{:<20}{:>12}{:>12.3f}{:>12.3f}'.format('seconds', '', always_time, cascade_time))
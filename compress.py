@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from keras.layers import Dense, Flatten
+from keras.models import Sequential, model_from_json
+from keras.optimizers import Adam
+
+from inference import TracedModel, single_sample_latency
+from spectrum_metrics import compute_metrics, local_minmax_array, spectrum_metrics
+from train import DATAPATH_TRAIN, DATASETS_TRAIN, DATAPATH_VALID, DATASETS_VALID
+from train import CustomLoss, load_dataset, image_shape, reshape_input
+
+# Compression of the dense head of the cnn (Flatten -> Dense(1024) -> Dropout -> Dense(24)):
+#   prune:   keep the hidden units with the largest |incoming| x |outgoing| weight norms,
+#            the output layer keeps the matching rows
+#   lowrank: W (inputs x units) ~ U_r S_r V_r' by truncated SVD, the layer becomes
+#            Dense(r, linear, no bias) -> Dense(units, relu) with weights U_r S_r and V_r'
+# Both can be combined (prune first). The compressed model is a plain Sequential of standard
+# layers, so test.py / evaluate.py load it like any other .json/.h5 pair.
+
+
+def find_head(model):
+    # index of the Dense after Flatten, and of the next Dense
+    layers = model.layers
+    for i, layer in enumerate(layers[:-1]):
+        if isinstance(layer, Flatten) and isinstance(layers[i + 1], Dense):
+            output = next(j for j in range(i + 2, len(layers)) if isinstance(layers[j], Dense))
+            return i + 1, output
+    raise ValueError('No Flatten -> Dense head in the model')
+
+
+def clone_layer(layer, **changes):
+    config = layer.get_config()
+    config.update(changes)
+    return layer.__class__.from_config(config)
+
+
+def compress_head(model, keep_units=None, rank=None):
+    head_index, output_index = find_head(model)
+    head, output = model.layers[head_index], model.layers[output_index]
+    kernel, bias = head.get_weights()
+    output_weights = output.get_weights()
+
+    if keep_units is not None and keep_units < kernel.shape[1]:
+        importance = np.linalg.norm(kernel, axis=0) * np.linalg.norm(output_weights[0], axis=1)
+        kept = np.sort(np.argsort(importance)[::-1][:keep_units])
+        kernel, bias = kernel[:, kept], bias[kept]
+        output_weights = [output_weights[0][kept]] + output_weights[1:]
+
+    layers, weights = [], []
+    for i, layer in enumerate(model.layers):
+        if i == head_index:
+            units = kernel.shape[1]
+            if rank is not None and rank * sum(kernel.shape) >= kernel.size:
+                raise ValueError('rank {} does not shrink a {}x{} layer (break-even rank {})'.format(
+                    rank, kernel.shape[0], kernel.shape[1], kernel.size // sum(kernel.shape)))
+            if rank is not None:
+                u, s, vt = np.linalg.svd(kernel, full_matrices=False)
+                layers.append(Dense(rank, use_bias=False, name='{}_lowrank'.format(layer.name)))
+                weights.append([u[:, :rank] * s[:rank]])
+                layers.append(clone_layer(layer, units=units))
+                weights.append([vt[:rank], bias])
+            else:
+                layers.append(clone_layer(layer, units=units))
+                weights.append([kernel, bias])
+        elif i == output_index:
+            layers.append(clone_layer(layer))
+            weights.append(output_weights)
+        else:
+            layers.append(clone_layer(layer))
+            weights.append(layer.get_weights())
+
+    compressed = Sequential(layers)
+    if not compressed.built:
+        compressed.build((None,) + tuple(model.input_shape[1:]))
+    for layer, layer_weights in zip(compressed.layers, weights):
+        layer.set_weights(layer_weights)
+    return compressed
+
+
+def file_size(path):
+    return os.path.getsize(path + '.json') + os.path.getsize(path + '.h5')
+
+
+def measure(model, x, y, mask_array, repeats=50):
+    traced = TracedModel(model, [1, 256])
+    latency = single_sample_latency(traced, x, repeats)
+    start_time = time.time()
+    y_predict = traced.predict(x)
+    throughput = len(x) / (time.time() - start_time)
+    result = compute_metrics(y, y_predict, mask_array)
+    result['params'] = int(model.count_params())
+    result['latency_ms'] = latency
+    result['samples_per_s'] = throughput
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path", help="Keras model to compress (path without .json/.h5)")
+    parser.add_argument("-k", "--keep_units", help="Hidden units of the dense head kept by pruning", default=None)
+    parser.add_argument("-r", "--rank", help="Rank of the low-rank factorization of the dense head", default=None)
+    parser.add_argument("-e", "--finetune_epochs", help="Fine-tune the compressed model for N epochs", default=0)
+    parser.add_argument("-l", "--loss_function", help="Loss of the fine-tuning", default='rmse')
+    parser.add_argument("-b", "--batch_size", help="Batch size of the fine-tuning", default=128)
+    parser.add_argument("--learning_rate", help="Learning rate of the fine-tuning", default=0.0001)
+    parser.add_argument("--finetune_samples", help="Training samples used by the fine-tuning (0: all)", default=0)
+    parser.add_argument("--eval_samples", help="Validation samples used for the report (0: all)", default=0)
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-o", "--output", help="Output path without extension (default: <model>_<method>)",
+                        default=None)
+
+    args = parser.parse_args()
+    if args.keep_units is None and args.rank is None:
+        parser.error('give --keep_units and/or --rank')
+    keep_units = int(args.keep_units) if args.keep_units else None
+    rank = int(args.rank) if args.rank else None
+
+    with open(args.model_path + '.json') as json_file:
+        model = model_from_json(json_file.read())
+    model.load_weights(args.model_path + '.h5')
+
+    model_name = 'cnn'
+    img_rows, img_cols, channels = image_shape(model_name, args.shape)
+    print('Data Loading... Validation dataset Start.')
+    x_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, model_name, args.shape,
+                                              max_samples=int(args.eval_samples) or None)
+    x_validation, _ = reshape_input(x_validation, model_name, img_rows, img_cols, channels)
+    print('Data Loading... Validation dataset Finished.')
+    mask_array = local_minmax_array(y_validation)
+
+    compressed = compress_head(model, keep_units, rank)
+    if int(args.finetune_epochs) > 0:
+        print('Data Loading... Train dataset Start.')
+        x_train, y_train = load_dataset(DATAPATH_TRAIN, DATASETS_TRAIN, model_name, args.shape,
+                                        max_samples=int(args.finetune_samples) or None)
+        x_train, _ = reshape_input(x_train, model_name, img_rows, img_cols, channels)
+        print('Data Loading... Train dataset Finished.')
+        custom_loss = CustomLoss(args.loss_function)
+        compressed.compile(loss=custom_loss.custom_loss, optimizer=Adam(lr=float(args.learning_rate)),
+                           metrics=spectrum_metrics())
+        compressed.fit(x_train, y_train, batch_size=int(args.batch_size), epochs=int(args.finetune_epochs),
+                       validation_data=(x_validation, y_validation))
+
+    method = '_'.join(name for name in [
+        'prune{}'.format(keep_units) if keep_units else None,
+        'svd{}'.format(rank) if rank else None,
+    ] if name)
+    output_path = args.output or '{}_{}'.format(args.model_path, method)
+    with open(output_path + '.json', 'w') as json_file:
+        json_file.write(compressed.to_json())
+    compressed.save_weights(output_path + '.h5')
+    print('Saved model to {}.json/.h5'.format(output_path))
+
+    report = {'original': measure(model, x_validation, y_validation, mask_array),
+              'compressed': measure(compressed, x_validation, y_validation, mask_array)}
+    report['original']['file_bytes'] = file_size(args.model_path)
+    report['compressed']['file_bytes'] = file_size(output_path)
+    report['method'] = {'keep_units': keep_units, 'rank': rank, 'finetune_epochs': int(args.finetune_epochs)}
+    with open(output_path + '.compression.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print('{:<20}{:>14}{:>14}{:>10}'.format('', 'original', 'compressed', 'ratio'))
+    for key in ['params', 'file_bytes', 'latency_ms', 'samples_per_s', 'rmse', 'r2', 'local_minmax_rmse',
+                'diff_rmse']:
+        original, new = report['original'][key], report['compressed'][key]
+        print('{:<20}{:>14.4f}{:>14.4f}{:>10.3f}'.format(key, original, new, new / original if original else 0))
@@ -0,0 +1,239 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from spectrum_metrics import compute_metrics, local_minmax_array
+from sweep import limit_threads, limit_tf_threads
+from train import DATAPATH_TRAIN, DATASETS_TRAIN, DATAPATH_VALID, DATASETS_VALID
+from train import count_samples, image_shape, load_dataset, reshape_input, transform_images
+
+# Grouped k-fold cross-validation: every dataset folder is a group, so the samples of one folder are
+# never split between training and testing (the folders of train.py and valid are pooled).
+#   folds    greedy, the largest remaining folder goes to the fold with the fewest samples
+#   data     decoded once at full resolution into memory-mapped .npy files (/dev/shm when available),
+#            laid out fold by fold: the test fold is one contiguous slice, keras models read their
+#            shuffled training batches straight from the map (the square flip is done per batch), nothing
+#            is copied per fold; sklearn models gather their downsampled 10x20 input
+#   workers  one spawned process per fold, --workers folds at a time with the cores split between them
+#   report   the test.py metrics per fold, mean, std and a Student-t confidence interval over the folds,
+#            and the metrics of the pooled out-of-fold predictions
+
+# test fold samples transformed and predicted at a time
+PREDICT_CHUNK = 4096
+
+
+def group_folds(group_sizes, n_folds):
+    folds = [[] for _ in range(n_folds)]
+    fold_sizes = np.zeros(n_folds, dtype=np.int64)
+    for group in sorted(group_sizes, key=lambda group: (-group_sizes[group], group)):
+        fold = int(np.argmin(fold_sizes))
+        folds[fold].append(group)
+        fold_sizes[fold] += group_sizes[group]
+    return folds
+
+
+def share_folds(folds, cache_dir):
+    # (datapath, dataset) groups of every fold -> x.npy / y.npy in fold order and the [start, stop) of each fold
+    n_samples = sum(count_samples(datapath, [dataset]) for fold in folds for datapath, dataset in fold)
+    x = np.lib.format.open_memmap(os.path.join(cache_dir, 'x.npy'), mode='w+', dtype=np.uint8,
+                                  shape=(n_samples,) + image_shape('cnn', 'rect')[:2])
+    y = np.lib.format.open_memmap(os.path.join(cache_dir, 'y.npy'), mode='w+', dtype=np.float64,
+                                  shape=(n_samples, 24))
+    bounds = []
+    count = 0
+    for fold in folds:
+        start = count
+        for datapath, dataset in fold:
+            x_group, y_group = load_dataset(datapath, [dataset], 'cnn', 'rect')
+            x[count:count + len(x_group)] = x_group
+            y[count:count + len(y_group)] = y_group
+            count += len(x_group)
+        bounds.append((start, count))
+    x.flush()
+    y.flush()
+    return bounds
+
+
+def fold_dataset(x, y, index, batch_size, seed=0, transform=None):
+    # transform (e.g. the square flip) runs per batch, the map itself stays untouched
+    import tensorflow as tf
+    if transform is None:
+        transform = np.asarray
+    sample_shape = transform(x[:1]).shape[1:]
+
+    def gather(batch):
+        # sorted rows read the map sequentially
+        batch = np.sort(batch)
+        return np.asarray(transform(x[batch]), dtype=np.float32), np.asarray(y[batch], dtype=np.float32)
+
+    def read(batch):
+        x_batch, y_batch = tf.numpy_function(gather, [batch], [tf.float32, tf.float32])
+        x_batch.set_shape((None,) + sample_shape)
+        y_batch.set_shape((None,) + y.shape[1:])
+        return x_batch, y_batch
+
+    dataset = tf.data.Dataset.from_tensor_slices(index)
+    dataset = dataset.shuffle(len(index), seed=seed, reshuffle_each_iteration=True).batch(batch_size)
+    return dataset.map(read).prefetch(2)
+
+
+def run_fold(fold, bounds, data_paths, model_name, input_shape_type, loss_functions, batch_size, epochs, threads,
+             model_folder):
+    limit_tf_threads(threads)
+    from sklearn.externals import joblib
+    from train import CustomLoss, create_model
+
+    start, stop = bounds[fold]
+    n_samples = bounds[-1][1]
+    start_time = time.time()
+    img_rows, img_cols, channels = image_shape(model_name, input_shape_type)
+    x = np.load(data_paths['x'], mmap_mode='r')[:n_samples]
+    y = np.load(data_paths['y'], mmap_mode='r')[:n_samples]
+    train_index = np.concatenate([np.arange(0, start), np.arange(stop, n_samples)])
+
+    def transform(images):
+        images = transform_images(images, model_name, input_shape_type)
+        return reshape_input(images, model_name, img_rows, img_cols, channels)[0]
+
+    _, input_shape = reshape_input(transform_images(x[:1], model_name, input_shape_type), model_name, img_rows,
+                                   img_cols, channels)
+    custom_loss = CustomLoss(loss_functions)
+    model = create_model(model_name, input_shape, custom_loss.custom_loss, n_jobs=threads)
+    if model_name.startswith('cnn') or model_name.startswith('nn'):
+        model.fit(fold_dataset(x, y, train_index, batch_size, seed=fold, transform=transform), epochs=epochs,
+                  verbose=0)
+        y_predict = np.concatenate([model.predict(transform(x[begin:min(begin + PREDICT_CHUNK, stop)]),
+                                                  batch_size=batch_size)
+                                    for begin in range(start, stop, PREDICT_CHUNK)])
+    else:
+        # the 10x20 input is small enough to be gathered
+        x = transform(x)
+        model.fit(x[train_index], y[train_index])
+        y_predict = model.predict(x[start:stop])
+
+    if model_folder is not None:
+        model_export_path = os.path.join(model_folder, 'fold_{}'.format(fold + 1))
+        if model_name.startswith('cnn') or model_name.startswith('nn'):
+            with open(model_export_path + '.json', 'w') as json_file:
+                json_file.write(model.to_json())
+            model.save_weights(model_export_path + '.h5')
+        else:
+            joblib.dump(model, model_export_path + '.joblib')
+
+    result = compute_metrics(y[start:stop], y_predict)
+    result.update({'fold': fold + 1, 'train_samples': len(train_index), 'test_samples': stop - start,
+                   'train_time': time.time() - start_time})
+    print('Fold {}: rmse={:.4f} local_minmax_rmse={:.4f} ({:.1f}s)'.format(
+        fold + 1, result['rmse'], result['local_minmax_rmse'], result['train_time']))
+    return result, y_predict
+
+
+def confidence_interval(values, confidence=0.95):
+    from scipy import stats
+    values = np.asarray(values, dtype=np.float64)
+    mean = float(values.mean())
+    if len(values) < 2:
+        return mean, float('nan'), float('nan'), float('nan')
+    std = float(values.std(ddof=1))
+    half_width = float(stats.t.ppf((1 + confidence) / 2, len(values) - 1) * std / np.sqrt(len(values)))
+    return mean, std, mean - half_width, mean + half_width
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", help="Select model type.", default="cnn")
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-l", "--loss_function", help="Select loss functions.. (rmse,diff_rmse,diff_ce)",
+                        default='rmse')
+    parser.add_argument("-e", "--epochs", help="Set epochs", default=300)
+    parser.add_argument("-b", "--batch_size", help="Set batch size", default=128)
+    parser.add_argument("-k", "--folds", help="Number of folds (at most the number of dataset folders)", default=5)
+    parser.add_argument("-w", "--workers", help="Folds trained at the same time (default: all)", default=None)
+    parser.add_argument("--confidence", help="Level of the confidence intervals", default=0.95)
+    parser.add_argument("--cache_dir", help="Where the shared dataset arrays are written.", default=None)
+    parser.add_argument("--save_models", help="Keep the model of every fold.", action='store_true')
+
+    args = parser.parse_args()
+    model_name = args.model
+    n_folds = int(args.folds)
+    groups = [(DATAPATH_TRAIN, dataset) for dataset in DATASETS_TRAIN] + \
+             [(DATAPATH_VALID, dataset) for dataset in DATASETS_VALID]
+    if not 2 <= n_folds <= len(groups):
+        parser.error('--folds has to be between 2 and the number of dataset folders ({})'.format(len(groups)))
+    workers = min(n_folds, int(args.workers) if args.workers else n_folds)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    cv_name = '{}_{}_{}_k{}'.format(model_name, args.loss_function, args.shape, n_folds)
+
+    folds = group_folds(dict((group, count_samples(group[0], [group[1]])) for group in groups), n_folds)
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    cache_dir = tempfile.mkdtemp(prefix='cv_{}_'.format(cv_name), dir=cache_dir)
+    data_paths = {'x': os.path.join(cache_dir, 'x.npy'), 'y': os.path.join(cache_dir, 'y.npy')}
+
+    model_folder = None
+    if args.save_models:
+        model_folder = 'models/cv_{}'.format(cv_name)
+        if not os.path.exists(model_folder):
+            os.makedirs(model_folder)
+
+    try:
+        print('Data Loading... Start.')
+        bounds = share_folds(folds, cache_dir)
+        print('Data Loading... Finished. ({} samples)'.format(bounds[-1][1]))
+        for fold, ((start, stop), fold_groups) in enumerate(zip(bounds, folds)):
+            print('Fold {}: {} samples, {}'.format(fold + 1, stop - start,
+                                                  ', '.join(dataset for _, dataset in fold_groups)))
+
+        print('{} folds on {} workers x {} threads'.format(n_folds, workers, threads))
+        limit_threads(threads)
+        start_time = time.time()
+        # one process per fold, so every fold starts with a clean TF session
+        with multiprocessing.get_context('spawn').Pool(workers, maxtasksperchild=1) as pool:
+            outputs = pool.starmap(run_fold, [(fold, bounds, data_paths, model_name, args.shape, args.loss_function,
+                                               int(args.batch_size), int(args.epochs), threads, model_folder)
+                                              for fold in range(n_folds)], chunksize=1)
+        elapsed = time.time() - start_time
+        y = np.array(np.load(data_paths['y'], mmap_mode='r')[:bounds[-1][1]])
+    finally:
+        for path in data_paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(cache_dir)
+
+    results = [result for result, _ in outputs]
+    y_predict = np.concatenate([fold_predict for _, fold_predict in outputs])
+    pooled = compute_metrics(y, y_predict, local_minmax_array(y))
+    confidence = float(args.confidence)
+    summary = {
+        'model': model_name,
+        'loss_function': args.loss_function,
+        'shape': args.shape,
+        'folds': [[dataset for _, dataset in fold_groups] for fold_groups in folds],
+        'confidence': confidence,
+        'seconds': elapsed,
+        'metrics': {},
+        'pooled': pooled,
+    }
+    print('{:<20}{:>10}{:>10}{:>22}{:>10}'.format('', 'mean', 'std', '{:.0%} interval'.format(confidence),
+                                                  'pooled'))
+    for key in ['rmse', 'r2', 'local_minmax_rmse', 'r2_local_minmax', 'diff_rmse', 'rmse_add_diff_rmse']:
+        mean, std, low, high = confidence_interval([result[key] for result in results], confidence)
+        summary['metrics'][key] = {'mean': mean, 'std': std, 'low': low, 'high': high}
+        print('{:<20}{:>10.4f}{:>10.4f}{:>22}{:>10.4f}'.format(key, mean, std, '[{:.4f}, {:.4f}]'.format(low, high),
+                                                              pooled[key]))
+    print('{} folds in {:.1f}s'.format(n_folds, elapsed))
+
+    result_folder = 'result/cv'
+    if not os.path.exists(result_folder):
+        os.makedirs(result_folder)
+    pd.DataFrame(results).to_csv('{}/{}_folds.csv'.format(result_folder, cv_name), index=False)
+    with open('{}/{}.json'.format(result_folder, cv_name), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print('Saved fold metrics to {}/{}_folds.csv'.format(result_folder, cv_name))
@@ -0,0 +1,159 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+from keras.callbacks import EarlyStopping
+
+from inference import TracedModel, artifact_model_name, load_model, prepare_input, predict_images
+from inference import single_sample_latency
+from spectrum_metrics import compute_metrics, local_minmax_array
+from train import DATAPATH_TRAIN, DATASETS_TRAIN, DATAPATH_VALID, DATASETS_VALID, DATAPATH_TEST, DATASETS_TEST
+from train import CustomLoss, create_model, load_dataset, tic, toc
+
+# Knowledge distillation of an ensemble into one network:
+#  1. the ensemble (mean of the teachers, as in test_ensemble.py) predicts the training set once,
+#     the soft targets are cached under data/store keyed by the teachers and the data
+#  2. a student from create_model is trained on alpha * soft + (1 - alpha) * true targets
+#  3. ensemble and student are compared on the validation (or test) set with the test.py metrics
+# Teachers can be any artifact (keras .json/.h5 path or .joblib), each gets its own input resolution.
+
+
+def ensemble_predict(teacher_paths, images, input_shape_type):
+    total = 0
+    for teacher_path in teacher_paths:
+        teacher = load_model(teacher_path)
+        prediction = predict_images(teacher, artifact_model_name(teacher_path), images, input_shape_type,
+                                    batch_size=256)
+        total = total + prediction
+        print('Teacher {} done'.format(teacher_path))
+    return total / len(teacher_paths)
+
+
+def soft_targets_path(teacher_paths, datapath, datasets, input_shape_type, max_samples):
+    key = hashlib.sha1()
+    for teacher_path in teacher_paths:
+        weights_path = teacher_path if teacher_path.endswith('.joblib') else os.path.splitext(teacher_path)[0] + '.h5'
+        key.update('{}:{}'.format(os.path.abspath(teacher_path), os.path.getmtime(weights_path)).encode())
+    key.update(json.dumps([datapath, datasets, input_shape_type, max_samples]).encode())
+    return os.path.join('data', 'store', 'distill_{}.npy'.format(key.hexdigest()[:12]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # space separated: loss names in the model paths contain commas
+    parser.add_argument("-t", "--teachers", help="Ensemble members (path without .json/.h5, or .joblib)",
+                        nargs='+', required=True)
+    parser.add_argument("-m", "--model", help="Student model type (cnn, cnn_small, nn)", default="cnn")
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-l", "--loss_function", help="Select loss functions.. (rmse,diff_rmse,diff_ce)",
+                        default='rmse')
+    parser.add_argument("-e", "--epochs", help="Set epochs", default=300)
+    parser.add_argument("-b", "--batch_size", help="Set batch size", default=128)
+    parser.add_argument("-a", "--alpha", help="Weight of the ensemble targets (1 - alpha: true targets)",
+                        default=1.0)
+    parser.add_argument("--early_stopping", help="Stop after N epochs without improvement (0: off)", default=20)
+    parser.add_argument("--max_samples", help="Training samples used (0: all)", default=0)
+    parser.add_argument("--eval", help="Dataset of the report (valid, test)", default='valid')
+
+    args = parser.parse_args()
+    teacher_paths = args.teachers
+    model_name = args.model
+    input_shape_type = args.shape
+    batch_size = int(args.batch_size)
+    epochs = int(args.epochs)
+    alpha = float(args.alpha)
+    max_samples = int(args.max_samples) or None
+    if model_name.startswith('cnn') is False and model_name.startswith('nn') is False:
+        parser.error('the student has to be a keras model (cnn, cnn_small, nn)')
+
+    # full resolution images once, every model transforms them to its own input
+    print('Data Loading... Train dataset Start.')
+    images_train, y_train = load_dataset(DATAPATH_TRAIN, DATASETS_TRAIN, 'cnn', input_shape_type,
+                                         max_samples=max_samples)
+    print('Data Loading... Train dataset Finished.')
+    print('Data Loading... Validation dataset Start.')
+    images_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, 'cnn', input_shape_type)
+    print('Data Loading... Validation dataset Finished.')
+
+    cache_path = soft_targets_path(teacher_paths, DATAPATH_TRAIN, DATASETS_TRAIN, input_shape_type, max_samples)
+    if os.path.exists(cache_path):
+        y_soft = np.load(cache_path)
+        print('Soft targets from {}'.format(cache_path))
+    else:
+        tic()
+        y_soft = ensemble_predict(teacher_paths, images_train, input_shape_type)
+        toc()
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        np.save(cache_path, y_soft)
+        print('Saved soft targets to {}'.format(cache_path))
+    y_target = alpha * y_soft + (1 - alpha) * y_train
+
+    x_train = prepare_input(images_train, model_name, input_shape_type)
+    input_shape = x_train.shape[1:] if model_name.startswith('cnn') else x_train.shape[1]
+    x_validation = prepare_input(images_validation, model_name, input_shape_type)
+    del images_train
+
+    custom_loss = CustomLoss(args.loss_function)
+    student = create_model(model_name, input_shape, custom_loss.custom_loss)
+    callbacks = []
+    if int(args.early_stopping) > 0:
+        callbacks.append(EarlyStopping(monitor='val_loss', patience=int(args.early_stopping),
+                                       restore_best_weights=True, verbose=1))
+    tic()
+    # validated against the true spectra, the number the student is judged by
+    student.fit(x_train, y_target,
+                batch_size=batch_size,
+                epochs=epochs,
+                callbacks=callbacks,
+                validation_data=(x_validation, y_validation))
+    toc()
+
+    model_export_path_folder = 'models/{}_distill_{}_{}'.format(model_name, batch_size, epochs)
+    if not os.path.exists(model_export_path_folder):
+        os.makedirs(model_export_path_folder)
+    model_export_path = '{}/{}_{}_1'.format(model_export_path_folder, args.loss_function, input_shape_type)
+    with open(model_export_path + '.json', 'w') as json_file:
+        json_file.write(student.to_json())
+    student.save_weights(model_export_path + '.h5')
+    print("Saved model to disk")
+
+    # report: ensemble vs student with the test.py metrics
+    if args.eval == 'test':
+        images_eval, y_eval = load_dataset(DATAPATH_TEST, DATASETS_TEST, 'cnn', input_shape_type)
+    else:
+        images_eval, y_eval = images_validation, y_validation
+    mask_array = local_minmax_array(y_eval)
+    y_ensemble = ensemble_predict(teacher_paths, images_eval, input_shape_type)
+    traced_student = TracedModel(student, [1, 256])
+    y_student = traced_student.predict(prepare_input(images_eval, model_name, input_shape_type))
+
+    x_single = images_eval[:50]
+    teacher_latency = 0
+    for teacher_path in teacher_paths:
+        teacher = load_model(teacher_path)
+        teacher_name = artifact_model_name(teacher_path)
+        if hasattr(teacher, 'input_shape'):
+            teacher = TracedModel(teacher, [1])
+        teacher_latency += single_sample_latency(teacher, prepare_input(x_single, teacher_name, input_shape_type))
+
+    report = {
+        'teachers': teacher_paths,
+        'alpha': alpha,
+        'ensemble': compute_metrics(y_eval, y_ensemble, mask_array),
+        'student': compute_metrics(y_eval, y_student, mask_array),
+        'soft_targets': cache_path,
+    }
+    report['ensemble']['latency_ms'] = teacher_latency
+    report['student']['latency_ms'] = single_sample_latency(
+        traced_student, prepare_input(x_single, model_name, input_shape_type))
+    with open(model_export_path + '.distill.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print('{:<20}{:>12}{:>12}{:>12}'.format(args.eval, 'ensemble', 'student', 'gap'))
+    for key in ['rmse', 'r2', 'local_minmax_rmse', 'r2_local_minmax', 'diff_rmse', 'latency_ms']:
+        ensemble_value, student_value = report['ensemble'][key], report['student'][key]
+        print('{:<20}{:>12.4f}{:>12.4f}{:>12.4f}'.format(key, ensemble_value, student_value,
+                                                        student_value - ensemble_value))
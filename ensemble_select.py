@@ -0,0 +1,253 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+from scipy.optimize import nnls
+
+from inference import TracedModel, artifact_model_name, load_model, predict_images, prepare_input
+from inference import single_sample_latency
+from spectrum_metrics import compute_metrics, local_minmax_array
+from train import DATAPATH_VALID, DATASETS_VALID, load_dataset
+
+# Budgeted ensemble selection for test_ensemble.py:
+#  1. every candidate predicts the validation set once (cached under data/store with its single-sample
+#     latency and FLOPs per sample), members are <model_folder>/<detail> as in model_name_details
+#  2. the squared error of a weighted mean sum_i w_i p_i is a quadratic form in w, so with the
+#     Gram matrix of the predictions every subset is scored without touching the predictions again;
+#     weights are non-negative and sum to 1 (or equal)
+#  3. the subset with the lowest validation error whose summed cost fits the budget is chosen, by
+#     enumerating all subsets (exact) or by forward selection (greedy)
+# The ensemble config is read by test_ensemble.py (ENSEMBLE_CONFIG).
+
+MAX_EXACT_CANDIDATES = 12
+
+
+def member_path(model_folder_path, detail):
+    # the paths test_ensemble.py builds for keras and sklearn members
+    if detail.startswith('cnn') or detail.startswith('nn'):
+        return '{}/{}'.format(model_folder_path, detail)
+    return '{}/{}.joblib'.format(model_folder_path, detail)
+
+
+def model_flops(model):
+    # multiply-adds x 2 of the layers with a kernel, per sample; None when unknown (sklearn)
+    if not hasattr(model, 'layers'):
+        return None
+    flops = 0
+    for layer in model.layers:
+        kernel = getattr(layer, 'kernel', None)
+        if kernel is None:
+            continue
+        positions = int(np.prod([size for size in tuple(layer.output.shape)[1:-1]]))
+        flops += 2 * int(np.prod(kernel.shape)) * positions
+    return flops
+
+
+def member_cache_path(path, datapath, datasets, input_shape_type, max_samples):
+    weights_path = path if path.endswith('.joblib') else path + '.h5'
+    key = hashlib.sha1()
+    key.update('{}:{}'.format(os.path.abspath(path), os.path.getmtime(weights_path)).encode())
+    key.update(json.dumps([datapath, datasets, input_shape_type, max_samples]).encode())
+    return os.path.join('data', 'store', 'ensemble_{}.npz'.format(key.hexdigest()[:12]))
+
+
+def evaluate_member(path, images, input_shape_type, cache_path):
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        flops = float(cached['flops'])
+        return cached['prediction'], float(cached['latency_ms']), None if np.isnan(flops) else int(flops)
+
+    model = load_model(path)
+    model_name = artifact_model_name(path)
+    flops = model_flops(model)
+    if hasattr(model, 'input_shape'):
+        model = TracedModel(model, [1, 256])
+    prediction = predict_images(model, model_name, images, input_shape_type)
+    latency = single_sample_latency(model, prepare_input(images[:50], model_name, input_shape_type))
+
+    if not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    np.savez(cache_path, prediction=prediction, latency_ms=latency, flops=np.nan if flops is None else flops)
+    return prediction, latency, flops
+
+
+class EnsembleObjective:
+    # ||sum_i w_i p_i - y||^2 = w'Gw - 2b'w + c over the scored elements
+    def __init__(self, predictions, y, mask=None):
+        if mask is None:
+            mask = np.ones(y.shape, dtype=bool)
+        p = np.stack([prediction[mask] for prediction in predictions]).astype(np.float64)
+        target = y[mask].astype(np.float64)
+        self.gram = p.dot(p.T)
+        self.cross = p.dot(target)
+        self.target_squares = target.dot(target)
+        self.count = len(target)
+
+    def rmse(self, subset, weights):
+        gram = self.gram[np.ix_(subset, subset)]
+        squares = weights.dot(gram).dot(weights) - 2 * weights.dot(self.cross[subset]) + self.target_squares
+        return float(np.sqrt(max(squares, 0) / self.count))
+
+    def fit_weights(self, subset, equal=False):
+        if equal or len(subset) == 1:
+            return np.full(len(subset), 1.0 / len(subset))
+        gram = self.gram[np.ix_(subset, subset)]
+        gram = gram + 1e-10 * np.trace(gram) * np.eye(len(subset))
+        # w'Gw - 2b'w = ||L'w - L^-1 b||^2 + const, the sum-to-one row as a stiff penalty
+        lower = np.linalg.cholesky(gram)
+        penalty = np.sqrt(1e3 * np.trace(gram) / len(subset))
+        a = np.vstack([lower.T, penalty * np.ones((1, len(subset)))])
+        t = np.append(np.linalg.solve(lower, self.cross[subset]), penalty)
+        weights, _ = nnls(a, t)
+        return weights / weights.sum()
+
+
+def subset_cost(costs, subset):
+    return tuple(sum(cost[i] for i in subset) for cost in costs)
+
+
+def fits(costs, budgets, subset):
+    return all(budget is None or total <= budget for total, budget in zip(subset_cost(costs, subset), budgets))
+
+
+def score(objective, subset, equal):
+    # members that get no weight are dropped, they would only cost latency
+    subset = list(subset)
+    weights = objective.fit_weights(subset, equal)
+    if (weights <= 1e-6).any():
+        subset = [i for i, weight in zip(subset, weights) if weight > 1e-6]
+        weights = objective.fit_weights(subset, equal)
+    return objective.rmse(subset, weights), subset, weights
+
+
+def select_exact(objective, n, costs, budgets, equal=False):
+    best = None
+    for size in range(1, n + 1):
+        for subset in itertools.combinations(range(n), size):
+            if not fits(costs, budgets, subset):
+                continue
+            error, used, weights = score(objective, subset, equal)
+            if best is None or error < best[0]:
+                best = (error, used, weights)
+    return best
+
+
+def select_greedy(objective, n, costs, budgets, equal=False):
+    # forward selection: add the member that lowers the error most while the budget holds
+    best = None
+    subset = []
+    while True:
+        step = None
+        for i in range(n):
+            if i in subset or not fits(costs, budgets, subset + [i]):
+                continue
+            error, used, weights = score(objective, subset + [i], equal)
+            if step is None or error < step[0]:
+                step = (error, used, weights)
+        if step is None or (best is not None and (step[0] >= best[0] or len(step[1]) <= len(subset))):
+            return best
+        best = step
+        subset = step[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # space separated: loss names in the member paths contain commas
+    parser.add_argument("-m", "--members", help="Candidate members (as in model_name_details, "
+                                                "e.g. cnn_128_300/rmse_rect_1)", nargs='+', required=True)
+    parser.add_argument("-f", "--model_folder_path", help="Folder of the members", default='models_paper')
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("--latency_budget", help="Summed single-sample latency of the members in ms",
+                        default=None)
+    parser.add_argument("--flop_budget", help="Summed FLOPs per sample of the members (keras members only)",
+                        default=None)
+    parser.add_argument("--metric", help="Validation error minimized (rmse, local_minmax_rmse)", default='rmse')
+    parser.add_argument("--search", help="Subset search (auto, exact, greedy); auto is exact up to {} "
+                                          "candidates".format(MAX_EXACT_CANDIDATES), default='auto')
+    parser.add_argument("--weights", help="Member weights (optimized, equal)", default='optimized')
+    parser.add_argument("--max_samples", help="Validation samples used (0: all)", default=0)
+    parser.add_argument("-o", "--output", help="Ensemble config path", default=None)
+
+    args = parser.parse_args()
+    details = args.members
+    paths = [member_path(args.model_folder_path, detail) for detail in details]
+    latency_budget = float(args.latency_budget) if args.latency_budget else None
+    flop_budget = float(args.flop_budget) if args.flop_budget else None
+    max_samples = int(args.max_samples) or None
+    if args.metric not in ['rmse', 'local_minmax_rmse']:
+        parser.error('metric must be rmse or local_minmax_rmse')
+
+    print('Data Loading... Validation dataset Start.')
+    images_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, 'cnn', args.shape,
+                                                   max_samples=max_samples)
+    print('Data Loading... Validation dataset Finished.')
+    mask_array = local_minmax_array(y_validation)
+
+    predictions, latencies, flops = [], [], []
+    for path in paths:
+        cache_path = member_cache_path(path, DATAPATH_VALID, DATASETS_VALID, args.shape, max_samples)
+        prediction, latency, member_flops = evaluate_member(path, images_validation, args.shape, cache_path)
+        predictions.append(prediction)
+        latencies.append(latency)
+        flops.append(member_flops)
+        print('{:<50}{:>10.3f} ms{:>14} FLOPs'.format(path, latency, str(member_flops)))
+    if flop_budget is not None and None in flops:
+        parser.error('--flop_budget needs keras members, FLOPs of {} are unknown'.format(
+            [detail for detail, member_flops in zip(details, flops) if member_flops is None]))
+
+    objective = EnsembleObjective(predictions, y_validation, mask_array if args.metric == 'local_minmax_rmse'
+                                  else None)
+    costs = [latencies, [member_flops or 0 for member_flops in flops]]
+    budgets = [latency_budget, flop_budget]
+    equal = args.weights == 'equal'
+    search = args.search
+    if search == 'auto':
+        search = 'exact' if len(paths) <= MAX_EXACT_CANDIDATES else 'greedy'
+    tic_time = time.time()
+    if search == 'exact':
+        best = select_exact(objective, len(paths), costs, budgets, equal)
+    else:
+        best = select_greedy(objective, len(paths), costs, budgets, equal)
+    print('{} search in {:.3f}s'.format(search, time.time() - tic_time))
+    if best is None:
+        parser.error('no member fits the budget (latencies {}, FLOPs {})'.format(latencies, flops))
+    _, subset, weights = best
+
+    y_selected = sum(weight * predictions[i] for i, weight in zip(subset, weights))
+    y_all = sum(predictions) / len(predictions)
+    latency, total_flops = subset_cost(costs, subset)
+    config = {
+        'model_folder_path': args.model_folder_path,
+        'members': [{'detail': details[i], 'weight': float(weight), 'latency_ms': latencies[i],
+                     'flops': flops[i]} for i, weight in zip(subset, weights)],
+        'metric': args.metric,
+        'search': search,
+        'budget': {'latency_ms': latency_budget, 'flops': flop_budget},
+        'latency_ms': latency,
+        'flops': total_flops if None not in [flops[i] for i in subset] else None,
+        'validation': compute_metrics(y_validation, y_selected, mask_array),
+        'validation_all_members': compute_metrics(y_validation, y_all, mask_array),
+    }
+    config['validation_all_members']['latency_ms'] = sum(latencies)
+
+    output_path = args.output
+    if output_path is None:
+        output_folder = 'result/ensemble'
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        output_path = '{}/ensemble_{}_{}.json'.format(output_folder, args.metric, len(subset))
+    with open(output_path, 'w') as config_file:
+        json.dump(config, config_file, indent=2)
+    print('Saved ensemble config to {}'.format(output_path))
+
+    for member in config['members']:
+        print('{:<50}{:>8.3f}'.format(member['detail'], member['weight']))
+    print('{:<20}{:>12}{:>12}'.format('', 'all', 'selected'))
+    for key in ['rmse', 'r2', 'local_minmax_rmse', 'diff_rmse']:
+        print('{:<20}{:>12.4f}{:>12.4f}'.format(key, config['validation_all_members'][key],
+                                                config['validation'][key]))
+    print('{:<20}{:>12.4f}{:>12.4f}'.format('latency_ms', sum(latencies), latency))
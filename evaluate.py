@@ -1,16 +1,17 @@
+import argparse
+import multiprocessing
+import os
 import pandas as pd
-from keras.models import Model
-from keras.layers import Average
-from keras import backend as K
-from keras.models import model_from_json
-import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from keras.utils.vis_utils import plot_model
-from scipy.signal import find_peaks
+from inference import apply_profile, load_profile, predict, trace_model
+from spectrum_plot import plot_sample, render_sample
+
+# keras and cv2 are imported where they are used: the spawned plot renderers import this module too
 
 
 def root_mean_squared_error(y_true, y_pred):
+    from keras import backend as K
     return K.sqrt(K.mean(K.square(y_pred - y_true), axis=-1))
 
 def tic():
@@ -32,6 +33,10 @@ def toc():
 
 # PARAMETERS
 MODEL_SHAPE_TYPE = 'rect'
+# autotuned profile of each model on this host (inference.py autotune): 'latency', 'throughput' or None
+INFERENCE_PROFILE = 'latency'
+# keras models are traced and warmed up for these batch sizes before timing, [] to skip
+TRACE_BATCH_SIZES = [1]
 DATAPATH = './data/test'
 # model_name_details = [
 #     'cnn_128_300/simple_rl_and_fix_rmse_diffloss_acc_binary_rect_1',
@@ -103,9 +108,7 @@ else:
     img_rows, img_cols, channels = 200, 200, 1
 RESULT_PATH = './result/predict'
 model_name = './'
-
-x_test = []
-y_test = []
+myeongjo = 'NanumMyeongjo'
 
 
 # data_folder = 'binary_test_1001'
@@ -177,98 +180,150 @@ data_id = 425  # 870 959
 # data_folder = 'binary_test_1101'
 # data_id = 245   # 288, 514, 928, 35, 220 329 930 493 167 245 632 517 985
 
-image = cv2.imread('{}/{}/{}.tiff'.format(DATAPATH, data_folder, data_id), 0)
-image = np.array(image, dtype=np.uint8)
-image //= 255
-if MODEL_SHAPE_TYPE == 'rect':
-    x_test.append(image)
-else:
-    v_flipped_image = np.flip(image, 0)
-    square_image = np.vstack([image, v_flipped_image])
-    x_test.append(square_image)
-
-dataframe = pd.read_csv('{}/{}.csv'.format(DATAPATH, data_folder), delim_whitespace=False, header=None)
-dataset = dataframe.values
-fileNames = dataset[:, 0]
-
-for idx, val in enumerate(fileNames):
-    if int(idx+1) == int(data_id):
-        y_test = dataset[idx, 1:25]
-        break
-
-x_test = np.array(x_test)
-y_test = np.array(y_test)
-y_test = np.true_divide(y_test, 2767.1)
-
-if K.image_data_format() == 'channels_first':
-    x_test = x_test.reshape(x_test.shape[0], channels, img_rows, img_cols)
-    y_test = y_test.reshape(y_test.shape[0], channels, img_rows, img_cols)
-    input_shape = (channels, img_rows, img_cols)
-else:
-    x_test = x_test.reshape(1, img_rows, img_cols, channels)
-    input_shape = (img_rows, img_cols, channels)
-
-result = dict()
-result['real'] = x_test
-x_axis = range(400, 1600, 50)
-fig, ax = plt.subplots(1, 1, figsize=(14, 7))
-ax.plot(x_axis, y_test, label='real', color='black')
-MODEL_JSON_PATH = ''
-MODEL_H5_PATH = ''
-myeongjo = 'NanumMyeongjo'
-
-for i, model_name_detail in enumerate(model_name_details):
-    MODEL_JSON_PATH = 'models_paper/{}/{}.json'.format(model_name, model_name_detail)
-    MODEL_H5_PATH = 'models_paper/{}/{}.h5'.format(model_name, model_name_detail)
-    print("Loaded model : {}".format(model_name_detail))
-
-    # load json and create model
-    json_file = open(MODEL_JSON_PATH, 'r')
-    loaded_model_json = json_file.read()
-    json_file.close()
-    loaded_model = model_from_json(loaded_model_json)
 
-    # load weights into new model
-    loaded_model.load_weights(MODEL_H5_PATH)
-
-    # evaluate loaded model on test data
-    loaded_model.compile(loss=root_mean_squared_error, optimizer='adam', metrics=['accuracy'])
+def read_samples(samples_path):
+    # a csv with dataset and id columns (e.g. the rank_errors.py ranking) or one <dataset>/<id> per line
+    if samples_path.endswith('.csv'):
+        dataframe = pd.read_csv(samples_path)
+        samples = [(str(data), int(file_id)) for data, file_id in zip(dataframe['dataset'], dataframe['id'])]
+    else:
+        with open(samples_path) as samples_file:
+            samples = [parse_sample(line) for line in samples_file if line.strip()]
+    # the same sample can be listed under several metrics
+    return list(dict.fromkeys(samples))
+
+
+def parse_sample(sample):
+    data, file_id = sample.strip().replace(',', '/').split('/')
+    return data, int(file_id)
+
+
+def load_samples(datapath, samples, input_shape_type):
+    import cv2
+    from keras import backend as K
+    from train import file_row
+    x = []
+    y = []
+    labels = dict()
+    for data, file_id in samples:
+        if data not in labels:
+            # the csv of every dataset is read once
+            dataset = pd.read_csv('{}/{}.csv'.format(datapath, data), delim_whitespace=False, header=None).values
+            labels[data] = dataset
+        dataset = labels[data]
+        y.append(dataset[file_row(dataset[:, 0], file_id), 1:25])
+
+        image = cv2.imread('{}/{}/{}.tiff'.format(datapath, data, file_id), 0)
+        if image is None:
+            raise FileNotFoundError('{}/{}/{}.tiff'.format(datapath, data, file_id))
+        image = np.array(image, dtype=np.uint8)
+        image //= 255
+        if input_shape_type == 'rect':
+            x.append(image)
+        else:
+            v_flipped_image = np.flip(image, 0)
+            x.append(np.vstack([image, v_flipped_image]))
+
+    x = np.array(x)
+    y = np.true_divide(np.array(y, dtype=np.float64), 2767.1)
+    if K.image_data_format() == 'channels_first':
+        x = x.reshape(x.shape[0], channels, img_rows, img_cols)
+    else:
+        x = x.reshape(x.shape[0], img_rows, img_cols, channels)
+    return x, y
+
+
+if __name__ == '__main__':
+    from keras.models import Model
+    from keras.layers import Average
+    from keras.models import model_from_json
+    from keras.utils.vis_utils import plot_model
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("samples", help="Samples to plot, <dataset>/<id> (default: data_folder / data_id above)",
+                        nargs='*')
+    parser.add_argument("-f", "--samples_file", help="csv with dataset and id columns (e.g. rank_errors.py) or "
+                                                     "one <dataset>/<id> per line", default=None)
+    parser.add_argument("--datapath", help="Folder of the datasets", default=DATAPATH)
+    parser.add_argument("-b", "--batch_size", help="Batch size of the predictions", default=256)
+    parser.add_argument("-j", "--jobs", help="Plot renderer processes (default: the cores, at most 4)", default=None)
+    parser.add_argument("-o", "--output", help="Folder of the plots of several samples", default='result/report')
+
+    args = parser.parse_args()
+    samples = [parse_sample(sample) for sample in args.samples]
+    if args.samples_file:
+        samples += read_samples(args.samples_file)
+    if not samples:
+        samples = [(data_folder, int(data_id))]
+    samples = list(dict.fromkeys(samples))
+    batch_size = int(args.batch_size)
 
     tic()
-    if model_name_detail.startswith('cnn'):
-        y_predict = loaded_model.predict(x_test)
-    else:
-        x_test_nn = x_test.reshape(x_test.shape[0], img_rows * img_cols * channels)
-        y_predict = loaded_model.predict(x_test_nn)
+    x_test, y_test = load_samples(args.datapath, samples, MODEL_SHAPE_TYPE)
+    print('Loaded {} samples:'.format(len(samples)))
     toc()
 
-    ax.plot(x_axis, y_predict[0], label = label_name[i], color = colors[i])
-
-    # plot model
-    # plot_model(loaded_model, to_file='plot_model_{}_{}.png'.format(data_folder, data_id), show_shapes=True, show_layer_names=True)
-
-peaks_positive, _ = find_peaks(y_test, height=0)
-peaks_negative, _ = find_peaks(1 - y_test, height=0)
-mask = np.zeros_like(y_test, np.bool)
-mask[peaks_positive] = 1
-mask[peaks_negative] = 1
-peak_array = mask * y_test
-peak_array[peak_array == 0] = np.nan
-plt.plot(x_axis, peak_array, "o", markersize=10)
-
-ax.set_title(r'predict simulation', fontsize = 14, fontname = myeongjo)
-ax.set_xlabel('wavelength', fontsize = 14, fontname = myeongjo)
-ax.set_ylabel('transmittance', fontsize = 14, fontname = myeongjo)
-ax.legend(loc = 'upper left', fontsize = 14)
-# ax.legend(loc = 'lower center', fontsize = 14)
-ax.grid(True)
-
-# ax.set_ylim(0, 10000)
-# ax.set_yticks(np.arange(0, 10000 + 1, 2500))
-
-fig.tight_layout()
-fig.set_size_inches(11,8)
-plt.savefig('plt_rmse_type1_2_all_{}_{}.png'.format(data_folder, data_id))
-plt.show()
-
-
+    y_predicts = []
+    MODEL_JSON_PATH = ''
+    MODEL_H5_PATH = ''
+
+    for i, model_name_detail in enumerate(model_name_details):
+        MODEL_JSON_PATH = 'models_paper/{}/{}.json'.format(model_name, model_name_detail)
+        MODEL_H5_PATH = 'models_paper/{}/{}.h5'.format(model_name, model_name_detail)
+        print("Loaded model : {}".format(model_name_detail))
+        # thread settings have to be in place before the model is built
+        predict_args = apply_profile(load_profile(MODEL_JSON_PATH, INFERENCE_PROFILE))
+        if len(samples) > 1:
+            predict_args['batch_size'] = batch_size
+
+        # load json and create model
+        tic()
+        json_file = open(MODEL_JSON_PATH, 'r')
+        loaded_model_json = json_file.read()
+        json_file.close()
+        loaded_model = model_from_json(loaded_model_json)
+
+        # load weights into new model
+        loaded_model.load_weights(MODEL_H5_PATH)
+
+        # evaluate loaded model on test data
+        loaded_model.compile(loss=root_mean_squared_error, optimizer='adam', metrics=['accuracy'])
+        print('load:')
+        toc()
+        if TRACE_BATCH_SIZES:
+            # tracing and first-call allocation stay out of the timed predict
+            loaded_model = trace_model(loaded_model, TRACE_BATCH_SIZES + ([batch_size] if len(samples) > 1 else []))
+
+        # every sample in one batched predict per model
+        tic()
+        if model_name_detail.startswith('cnn'):
+            y_predict = predict(loaded_model, x_test, **predict_args)
+        else:
+            x_test_nn = x_test.reshape(x_test.shape[0], img_rows * img_cols * channels)
+            y_predict = predict(loaded_model, x_test_nn, **predict_args)
+        print('steady-state predict:')
+        toc()
+        y_predicts.append(y_predict)
+
+        # plot model
+        # plot_model(loaded_model, to_file='plot_model_{}_{}.png'.format(data_folder, data_id), show_shapes=True, show_layer_names=True)
+
+    if len(samples) == 1:
+        data_folder, data_id = samples[0]
+        plot_sample(y_test[0], [y_predict[0] for y_predict in y_predicts], label_name, colors, myeongjo)
+        plt.savefig('plt_rmse_type1_2_all_{}_{}.png'.format(data_folder, data_id))
+        plt.show()
+    else:
+        if not os.path.exists(args.output):
+            os.makedirs(args.output)
+        tasks = [(os.path.join(args.output, '{}_{}.png'.format(data, file_id)), y_test[j],
+                  [y_predict[j] for y_predict in y_predicts], label_name, colors, myeongjo)
+                 for j, (data, file_id) in enumerate(samples)]
+        # headless renderers: the spawned processes pick up the backend when they import pyplot
+        os.environ['MPLBACKEND'] = 'Agg'
+        jobs = int(args.jobs) if args.jobs else min(os.cpu_count() or 1, 4)
+        tic()
+        with multiprocessing.get_context('spawn').Pool(min(jobs, len(tasks))) as pool:
+            pool.map(render_sample, tasks, chunksize=max(1, len(tasks) // (4 * jobs)))
+        print('Rendered {} plots to {}:'.format(len(tasks), args.output))
+        toc()
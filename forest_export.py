@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor, GradientBoostingRegressor
+from sklearn.externals import joblib
+from sklearn.multioutput import MultiOutputRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+from hist_gbr import HistGradientBoostingMultiRegressor
+
+# Tree ensembles compiled into contiguous node arrays:
+#   feature, threshold, left, right  (n_nodes,)      all trees back to back
+#   value                            (n_nodes, n_outputs)
+#   roots                            (n_trees,)
+# prediction = base + tree_weight * sum over trees of value[leaf]
+# Leaves point to themselves, so a batch walks every tree for max_depth steps without branching.
+# The arrays are plain .npy files loaded with mmap_mode='r', so several processes share
+# one copy in the page cache and loading does not depend on the model size.
+ARRAY_NAMES = ['feature', 'threshold', 'left', 'right', 'value', 'roots']
+
+
+def _sklearn_tree_nodes(tree, n_outputs, output=None):
+    t = tree.tree_
+    leaf = t.children_left < 0
+    node_ids = np.arange(t.node_count, dtype=np.int64)
+    value = t.value[:, :, 0]
+    if output is not None:
+        # a single-output tree of a per-output model only contributes to its own column
+        full_value = np.zeros((t.node_count, n_outputs))
+        full_value[:, output] = value[:, 0]
+        value = full_value
+    return {
+        'feature': np.where(leaf, 0, t.feature),
+        'threshold': np.where(leaf, np.inf, t.threshold),
+        'left': np.where(leaf, node_ids, t.children_left),
+        'right': np.where(leaf, node_ids, t.children_right),
+        'value': value,
+        'depth': t.max_depth,
+    }
+
+
+def _hist_tree_nodes(tree):
+    leaf = tree['left'] < 0
+    node_ids = np.arange(len(tree['left']), dtype=np.int64)
+    return {
+        'feature': np.where(leaf, 0, tree['feature']),
+        # hist trees send x < t left, the kernel uses x <= t like sklearn
+        'threshold': np.where(leaf, np.inf, np.nextafter(tree['threshold'], -np.inf)),
+        'left': np.where(leaf, node_ids, tree['left']),
+        'right': np.where(leaf, node_ids, tree['right']),
+        'value': tree['value'],
+    }
+
+
+def _tree_depth(left, right):
+    depth = 0
+    nodes = np.array([0])
+    while True:
+        children = np.concatenate([left[nodes], right[nodes]])
+        children = children[children != np.concatenate([nodes, nodes])]
+        if len(children) == 0:
+            return depth
+        nodes = children
+        depth += 1
+
+
+def _n_features(model):
+    if isinstance(model, MultiOutputRegressor):
+        model = model.estimators_[0]
+    if isinstance(model, HistGradientBoostingMultiRegressor):
+        return len(model.bin_thresholds_)
+    return getattr(model, 'n_features_in_', None) or model.n_features_
+
+
+def compile_forest(model):
+    if isinstance(model, (RandomForestRegressor, ExtraTreesRegressor)):
+        trees = [_sklearn_tree_nodes(tree, model.n_outputs_) for tree in model.estimators_]
+        n_outputs = model.n_outputs_
+        base = np.zeros(n_outputs)
+        tree_weight = 1. / len(trees)
+        kind = 'mean'
+    elif isinstance(model, DecisionTreeRegressor):
+        trees = [_sklearn_tree_nodes(model, model.n_outputs_)]
+        n_outputs = model.n_outputs_
+        base = np.zeros(n_outputs)
+        tree_weight = 1.
+        kind = 'mean'
+    elif isinstance(model, MultiOutputRegressor) and isinstance(model.estimators_[0], GradientBoostingRegressor):
+        n_outputs = len(model.estimators_)
+        n_features = _n_features(model)
+        trees = []
+        base = np.zeros(n_outputs)
+        for output, estimator in enumerate(model.estimators_):
+            if estimator.init_ != 'zero':
+                base[output] = estimator.init_.predict(np.zeros((1, n_features))).ravel()[0]
+            trees.extend(_sklearn_tree_nodes(tree, n_outputs, output) for tree in estimator.estimators_[:, 0])
+        tree_weight = model.estimators_[0].learning_rate
+        kind = 'sum'
+    elif isinstance(model, HistGradientBoostingMultiRegressor):
+        trees = [_hist_tree_nodes(tree) for tree in model.trees_]
+        n_outputs = model.n_outputs_
+        base = model.baseline_
+        tree_weight = 1.
+        kind = 'sum'
+    else:
+        raise ValueError('Cannot compile {}'.format(type(model).__name__))
+
+    offsets = np.cumsum([0] + [len(tree['feature']) for tree in trees])
+    arrays = {
+        'feature': np.concatenate([tree['feature'] for tree in trees]).astype(np.int32),
+        'threshold': np.concatenate([tree['threshold'] for tree in trees]).astype(np.float64),
+        'left': np.concatenate([tree['left'] + offset for tree, offset in zip(trees, offsets)]).astype(np.int32),
+        'right': np.concatenate([tree['right'] + offset for tree, offset in zip(trees, offsets)]).astype(np.int32),
+        'value': np.concatenate([tree['value'] for tree in trees]).astype(np.float32),
+        'roots': offsets[:-1].astype(np.int32),
+    }
+    max_depth = max(tree['depth'] if 'depth' in tree else _tree_depth(tree['left'], tree['right'])
+                    for tree in trees)
+    meta = {
+        'kind': kind,
+        'model': type(model).__name__,
+        'n_features': int(_n_features(model)),
+        'n_outputs': int(n_outputs),
+        'n_trees': len(trees),
+        'max_depth': int(max_depth),
+        'tree_weight': float(tree_weight),
+        'base': [float(b) for b in np.ravel(base)],
+    }
+    return CompiledForest(arrays, meta)
+
+
+class CompiledForest:
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+        self.base = np.array(meta['base'], dtype=np.float64)
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(path, '{}.npy'.format(name)), self.arrays[name])
+        with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+            json.dump(self.meta, meta_file, indent=2)
+
+    def apply(self, X):
+        # leaf index of every (sample, tree) pair
+        # plain ndarray views of the memory maps skip the memmap subclass overhead on every gather
+        a = dict((name, np.asarray(array)) for name, array in self.arrays.items())
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        flat_X = X.ravel()
+        row_offsets = (np.arange(len(X), dtype=np.int64) * X.shape[1])[:, None]
+        nodes = np.tile(np.asarray(a['roots']), (len(X), 1))
+        for _ in range(self.meta['max_depth']):
+            goes_left = np.take(flat_X, row_offsets + a['feature'][nodes]) <= a['threshold'][nodes]
+            next_nodes = np.where(goes_left, a['left'][nodes], a['right'][nodes])
+            if np.array_equal(next_nodes, nodes):
+                break
+            nodes = next_nodes
+        return nodes
+
+    def predict_trees(self, X):
+        # (n_samples, n_trees, n_outputs) contribution of every tree, before tree_weight
+        return np.asarray(self.arrays['value'])[self.apply(X)]
+
+    def _predict_batch(self, X):
+        nodes = self.apply(X)
+        value = np.asarray(self.arrays['value'])
+        total = np.zeros((len(X), self.meta['n_outputs']))
+        for tree in range(nodes.shape[1]):
+            total += value[nodes[:, tree]]
+        return self.base + self.meta['tree_weight'] * total
+
+    def predict(self, X, batch_size=2048, n_jobs=None):
+        X = np.asarray(X)
+        batches = [X[start:start + batch_size] for start in range(0, len(X), batch_size)]
+        if n_jobs is not None and n_jobs != 1 and len(batches) > 1:
+            # the numpy gathers release the GIL, so batches run in parallel threads
+            with ThreadPoolExecutor(n_jobs if n_jobs > 0 else None) as executor:
+                predictions = list(executor.map(self._predict_batch, batches))
+        else:
+            predictions = [self._predict_batch(batch) for batch in batches]
+        prediction = np.concatenate(predictions) if predictions else np.empty((0, self.meta['n_outputs']))
+        if self.meta['n_outputs'] == 1:
+            return prediction[:, 0]
+        return prediction
+
+
+def load_forest(path, mmap_mode='r'):
+    with open(os.path.join(path, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+    arrays = dict((name, np.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode=mmap_mode))
+                  for name in ARRAY_NAMES)
+    return CompiledForest(arrays, meta)
+
+
+def forest_path(model_path):
+    return os.path.splitext(model_path)[0] + '.forest'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_path", help="joblib model to compile (rf, extratree, dt, gbr, gbr_exact)")
+    parser.add_argument("-c", "--check", help="Compare against the joblib model on random inputs",
+                        action='store_true')
+
+    args = parser.parse_args()
+    start_time = time.time()
+    model = joblib.load(args.model_path)
+    joblib_load_time = time.time() - start_time
+
+    compiled = compile_forest(model)
+    export_path = forest_path(args.model_path)
+    compiled.save(export_path)
+    print('Saved {} trees ({} nodes) to {}'.format(compiled.meta['n_trees'], len(compiled.arrays['feature']),
+                                                   export_path))
+
+    start_time = time.time()
+    loaded = load_forest(export_path)
+    print('load time: joblib {:.3f}s, compiled {:.3f}s'.format(joblib_load_time, time.time() - start_time))
+
+    if args.check:
+        x_check = (np.random.RandomState(0).rand(512, compiled.meta['n_features']) < 0.5).astype(np.uint8) * 255
+        start_time = time.time()
+        y_model = model.predict(x_check)
+        model_time = time.time() - start_time
+        start_time = time.time()
+        y_compiled = loaded.predict(x_check)
+        compiled_time = time.time() - start_time
+        print('max abs diff: {:.2e}'.format(np.max(np.abs(y_model - y_compiled))))
+        print('predict time (512 samples): model {:.3f}s, compiled {:.3f}s'.format(model_time, compiled_time))
@@ -0,0 +1,273 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+
+# Nearest-neighbour search over binary geometries by Hamming distance.
+#  - geometries are bit-packed (x > 0) into uint64 words, distances are XOR + popcount
+#  - multi-index hashing: the code is cut into m substrings with one sorted table each.
+#    If two codes differ in d bits, one substring differs in at most d // m bits, so probing
+#    every substring within radius s finds every code within distance m * (s + 1) - 1.
+#    Queries whose k-th neighbour is not certified after max_radius fall back to an exact scan,
+#    so results are always exact. Probing pays off on near-duplicate designs (families of
+#    variations of one geometry); for far neighbours the scan does the work.
+# On the 0/255 images the Hamming order is the Euclidean order, so HammingKNeighborsRegressor
+# matches KNeighborsRegressor on the same input (up to ties).
+
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(words):
+    # set bits of every uint64 word
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    x = words - ((words >> np.uint64(1)) & M1)
+    x = (x & M2) + ((x >> np.uint64(2)) & M2)
+    x = (x + (x >> np.uint64(4))) & M4
+    return ((x * H01) >> np.uint64(56)).astype(np.uint8)
+
+
+def pack_geometries(x):
+    # (n, ...) images -> (n, n_words) uint64, one bit per pixel
+    bits = np.asarray(x).reshape(len(x), -1) > 0
+    packed = np.packbits(bits, axis=1)
+    padding = (-packed.shape[1]) % 8
+    if padding:
+        packed = np.hstack([packed, np.zeros((len(packed), padding), dtype=np.uint8)])
+    return np.ascontiguousarray(packed).view(np.uint64), bits.shape[1]
+
+
+def hamming_distances(query_words, words, block_size=64):
+    # (n_queries, n) exact distances, one word at a time over blocks of queries so the
+    # temporaries stay small; words are transposed so every word is a contiguous row
+    words_t = np.ascontiguousarray(words.T)
+    distances = np.zeros((len(query_words), len(words)), dtype=np.int32)
+    for start in range(0, len(query_words), block_size):
+        block = distances[start:start + block_size]
+        for w, query_word in enumerate(query_words[start:start + block_size].T):
+            block += popcount(query_word[:, None] ^ words_t[w][None, :])
+    return distances
+
+
+def _flip_masks(length, radius):
+    # every key of `length` bits with exactly `radius` bits set
+    from itertools import combinations
+    return np.array([sum(1 << bit for bit in bits) for bits in combinations(range(length), radius)],
+                    dtype=np.uint64)
+
+
+class HammingIndex:
+    def __init__(self, words, n_bits, substring_bits=None, max_radius=1, max_candidates=None):
+        self.words = np.ascontiguousarray(words)
+        self.n_bits = n_bits
+        # probing stops for a batch once it averages more than max_candidates pairs per query
+        self.max_candidates = max_candidates or max(len(words) // 8, 1)
+        if substring_bits is None:
+            substring_bits = int(np.clip(np.ceil(np.log2(max(len(words), 2))), 8, 32))
+            substring_bits = max(substring_bits, -(-n_bits // 256))
+        self.substring_bits = min(int(substring_bits), 64)
+        self.max_radius = max_radius
+        self.bounds = [(start, min(start + self.substring_bits, n_bits))
+                       for start in range(0, n_bits, self.substring_bits)]
+        keys = self._keys(self.words)
+        self.orders = np.argsort(keys, axis=0, kind='stable')
+        self.sorted_keys = np.take_along_axis(keys, self.orders, axis=0)
+
+    @property
+    def n_substrings(self):
+        return len(self.bounds)
+
+    def _keys(self, words, chunk_size=16384):
+        keys = np.empty((len(words), self.n_substrings), dtype=np.uint64)
+        for start in range(0, len(words), chunk_size):
+            bits = np.unpackbits(words[start:start + chunk_size].view(np.uint8), axis=1)
+            for i, (lo, hi) in enumerate(self.bounds):
+                weights = np.uint64(1) << np.arange(hi - lo, dtype=np.uint64)
+                keys[start:start + chunk_size, i] = bits[:, lo:hi].astype(np.uint64) @ weights
+        return keys
+
+    def _candidates(self, query_keys, radius, max_pairs):
+        # (query, item) pairs whose substring i is within `radius` of the query's substring i,
+        # None when there are more than max_pairs (a scan is cheaper then)
+        probed = []
+        for i, (lo, hi) in enumerate(self.bounds):
+            if radius > hi - lo:
+                continue
+            probes = (query_keys[:, i, None] ^ _flip_masks(hi - lo, radius)[None, :]).ravel()
+            left = np.searchsorted(self.sorted_keys[:, i], probes, side='left')
+            counts = np.searchsorted(self.sorted_keys[:, i], probes, side='right') - left
+            probed.append((i, len(probes) // len(query_keys), left, counts))
+            if sum(c.sum() for _, _, _, c in probed) > max_pairs:
+                return None
+        pairs = []
+        for i, n_probes, left, counts in probed:
+            if counts.sum() == 0:
+                continue
+            query_ids = np.repeat(np.repeat(np.arange(len(query_keys)), n_probes), counts)
+            positions = np.repeat(left - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            pairs.append(query_ids * len(self.words) + self.orders[positions, i])
+        if not pairs:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(pairs))
+
+    def query(self, query_words, k=5, batch_size=256, n_jobs=None):
+        # (distances, ids), both (n_queries, k), nearest first; with n_jobs (-1: all cores) the query
+        # batches run in threads, the XOR / popcount / sort kernels release the GIL
+        k = min(k, len(self.words))
+        distances = np.empty((len(query_words), k), dtype=np.int64)
+        ids = np.empty((len(query_words), k), dtype=np.int64)
+        starts = list(range(0, len(query_words), batch_size))
+
+        def query_batch(start):
+            return self._query_batch(query_words[start:start + batch_size], k)
+
+        if n_jobs is None or n_jobs == 1 or len(starts) < 2:
+            results = map(query_batch, starts)
+        else:
+            with ThreadPoolExecutor(os.cpu_count() if n_jobs < 0 else n_jobs) as executor:
+                results = list(executor.map(query_batch, starts))
+        for start, (batch_distances, batch_ids) in zip(starts, results):
+            distances[start:start + len(batch_ids)] = batch_distances
+            ids[start:start + len(batch_ids)] = batch_ids
+        return distances, ids
+
+    def _query_batch(self, query_words, k):
+        n = len(self.words)
+        query_keys = self._keys(query_words)
+        best_distances = np.full((len(query_words), k), np.iinfo(np.int64).max)
+        best_ids = np.full((len(query_words), k), -1)
+        seen = np.empty(0, dtype=np.int64)
+        pending = np.arange(len(query_words))
+        for radius in range(self.max_radius + 1):
+            pairs = self._candidates(query_keys[pending], radius, self.max_candidates * len(pending))
+            if pairs is None:
+                break
+            # back to batch query numbers, and skip pairs scored at a smaller radius
+            pairs = np.setdiff1d(pending[pairs // n] * n + pairs % n, seen, assume_unique=True)
+            seen = np.union1d(seen, pairs)
+            if len(pairs):
+                query_ids = np.concatenate([np.repeat(np.arange(len(query_words)), k), pairs // n])
+                item_ids = np.concatenate([best_ids.ravel(), pairs % n])
+                distances = np.concatenate([best_distances.ravel(),
+                                            popcount(query_words[pairs // n] ^ self.words[pairs % n]).sum(axis=1, dtype=np.int64)])
+                # the k nearest of every query: sort by (query, distance, id), keep the first k per query
+                order = np.lexsort((item_ids, distances, query_ids))
+                query_ids, item_ids, distances = query_ids[order], item_ids[order], distances[order]
+                rank = np.arange(len(order)) - np.searchsorted(query_ids, query_ids, side='left')
+                keep = rank < k
+                best_distances[query_ids[keep], rank[keep]] = distances[keep]
+                best_ids[query_ids[keep], rank[keep]] = item_ids[keep]
+            certified = best_distances[pending, -1] <= self.n_substrings * (radius + 1) - 1
+            pending = pending[~certified]
+            if len(pending) == 0:
+                break
+
+        if len(pending):
+            distances = hamming_distances(query_words[pending], self.words)
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+            order = np.lexsort((nearest, nearest_distances), axis=1)
+            best_ids[pending] = np.take_along_axis(nearest, order, axis=1)
+            best_distances[pending] = np.take_along_axis(nearest_distances, order, axis=1)
+        return best_distances, best_ids
+
+    def save(self, path, **extra):
+        np.savez(path, words=self.words, n_bits=self.n_bits, substring_bits=self.substring_bits,
+                 max_radius=self.max_radius, orders=self.orders, sorted_keys=self.sorted_keys, **extra)
+
+
+def load_index(path):
+    # returns the index and the extra arrays stored with it
+    data = np.load(path, allow_pickle=False)
+    index = HammingIndex.__new__(HammingIndex)
+    index.words = data['words']
+    index.n_bits = int(data['n_bits'])
+    index.substring_bits = int(data['substring_bits'])
+    index.max_radius = int(data['max_radius'])
+    index.max_candidates = max(len(index.words) // 8, 1)
+    index.bounds = [(start, min(start + index.substring_bits, index.n_bits))
+                    for start in range(0, index.n_bits, index.substring_bits)]
+    index.orders = data['orders']
+    index.sorted_keys = data['sorted_keys']
+    extra = dict((name, data[name]) for name in data.files
+                 if name not in ['words', 'n_bits', 'substring_bits', 'max_radius', 'orders', 'sorted_keys'])
+    return index, extra
+
+
+class HammingKNeighborsRegressor(BaseEstimator, RegressorMixin):
+    def __init__(self, n_neighbors=5, max_radius=0, n_jobs=None):
+        self.n_neighbors = n_neighbors
+        self.max_radius = max_radius
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        words, n_bits = pack_geometries(X)
+        self.index_ = HammingIndex(words, n_bits, max_radius=self.max_radius)
+        self.y_ = np.asarray(y, dtype=np.float64)
+        return self
+
+    def kneighbors(self, X):
+        return self.index_.query(pack_geometries(X)[0], self.n_neighbors, n_jobs=self.n_jobs)
+
+    def predict(self, X):
+        _, ids = self.kneighbors(X)
+        return self.y_[ids].mean(axis=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help="Index the geometries of dataset folders")
+    build_parser.add_argument("index", help="Index file (.npz)")
+    build_parser.add_argument("--datapath", help="Folder of the datasets", default=None)
+    build_parser.add_argument("--datasets", help="Datasets, comma separated (default: train datasets)",
+                              default=None)
+    build_parser.add_argument("-r", "--resolution", help="full (100x200) or compressed (10x20) geometries",
+                              default='full')
+
+    query_parser = subparsers.add_parser('query', help="Closest indexed geometries of a sample")
+    query_parser.add_argument("index", help="Index file (.npz)")
+    query_parser.add_argument("--datapath", help="Folder of the queried dataset", default=os.path.join('data', 'test'))
+    query_parser.add_argument("--dataset", help="Dataset of the queried geometry", required=True)
+    query_parser.add_argument("--id", help="File id of the queried geometry", required=True)
+    query_parser.add_argument("-k", help="Number of neighbours", default=10)
+
+    args = parser.parse_args()
+    model_name = 'cnn' if getattr(args, 'resolution', 'full') == 'full' else 'knn'
+    if args.command == 'build':
+        from train import DATAPATH_TRAIN, DATASETS_TRAIN, load_dataset, tic, toc
+
+        datapath = args.datapath or DATAPATH_TRAIN
+        datasets = args.datasets.split(',') if args.datasets else DATASETS_TRAIN
+        x, y, ids = load_dataset(datapath, datasets, model_name, 'rect', return_ids=True)
+        tic()
+        words, n_bits = pack_geometries(x)
+        index = HammingIndex(words, n_bits)
+        toc()
+        index.save(args.index, y=y, datapath=np.array(datapath), datasets=np.array([i[0] for i in ids]),
+                   file_ids=np.array([i[1] for i in ids]), shape=np.array(x.shape[1:]))
+        print('Indexed {} geometries ({} bits, {} substrings) to {}'.format(len(x), n_bits, index.n_substrings,
+                                                                          args.index))
+    elif args.command == 'query':
+        from PIL import Image
+        from train import transform_images, tic, toc
+
+        index, extra = load_index(args.index)
+        image = np.array(Image.open(os.path.join(args.datapath, args.dataset, '{}.tiff'.format(args.id))),
+                         dtype=np.uint8)
+        if tuple(extra['shape']) != image.shape:
+            image = transform_images(image, 'knn', 'rect')
+        tic()
+        distances, ids = index.query(pack_geometries(image[None])[0], int(args.k))
+        toc()
+        print('closest geometries to {}/{}:'.format(args.dataset, args.id))
+        for distance, item in zip(distances[0], ids[0]):
+            print('  {}/{}  distance {}'.format(extra['datasets'][item], extra['file_ids'][item], distance))
+    else:
+        parser.print_help()
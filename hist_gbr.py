@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+
+# Gradient boosting for the 24 transmittance outputs at once:
+#  - features are binned once (uint8 bin codes) before the first tree
+#  - every tree predicts all outputs jointly (vector-valued leaves), the split gain is
+#    summed over the outputs, so one tree replaces 24 per-output trees
+#  - node histograms are one-hot x gradient matrix products, run over feature chunks
+#    in a thread pool; the larger child histogram is parent - smaller child
+
+
+class HistGradientBoostingMultiRegressor(BaseEstimator, RegressorMixin):
+    def __init__(self, n_estimators=100, learning_rate=0.1, max_depth=5, max_bins=255, min_samples_leaf=1,
+                 l2_regularization=0., subsample=1.0, n_jobs=None, random_state=0):
+        self.n_estimators = n_estimators
+        self.learning_rate = learning_rate
+        self.max_depth = max_depth
+        self.max_bins = max_bins
+        self.min_samples_leaf = min_samples_leaf
+        self.l2_regularization = l2_regularization
+        self.subsample = subsample
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def _fit_bins(self, X):
+        self.bin_thresholds_ = []
+        for f in range(X.shape[1]):
+            values = np.unique(X[:, f])
+            if len(values) > self.max_bins:
+                values = np.unique(np.percentile(X[:, f], np.linspace(0, 100, self.max_bins + 1)))
+            # a sample goes to bin b when it is below threshold b and not below threshold b - 1
+            self.bin_thresholds_.append((values[:-1] + values[1:]) / 2)
+        self.n_bins_ = max(len(thresholds) for thresholds in self.bin_thresholds_) + 1
+
+    def _bin(self, X):
+        X_binned = np.empty(X.shape, dtype=np.uint8)
+        for f, thresholds in enumerate(self.bin_thresholds_):
+            X_binned[:, f] = np.searchsorted(thresholds, X[:, f], side='right')
+        return X_binned
+
+    def _histogram(self, X_binned, gradients, chunks, executor):
+        # hist[f, b] = sum of [gradients, 1] over the samples whose feature f falls into bin b
+        bins = np.arange(self.n_bins_, dtype=np.uint8)
+
+        def chunk_histogram(chunk):
+            one_hot = (X_binned[:, chunk, None] == bins).reshape(len(X_binned), -1).astype(np.float32)
+            return (one_hot.T @ gradients).reshape(len(chunk), self.n_bins_, -1)
+
+        return np.concatenate(list(executor.map(chunk_histogram, chunks)), axis=0)
+
+    def _best_split(self, hist, total):
+        l2 = self.l2_regularization
+        left = np.cumsum(hist, axis=1)[:, :-1]
+        right = total - left
+        n_left = left[:, :, -1]
+        n_right = right[:, :, -1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gain = (np.sum(left[:, :, :-1] ** 2, axis=2) / (n_left + l2) +
+                    np.sum(right[:, :, :-1] ** 2, axis=2) / (n_right + l2) -
+                    np.sum(total[:-1] ** 2) / (total[-1] + l2))
+        valid = (n_left >= self.min_samples_leaf) & (n_right >= self.min_samples_leaf)
+        gain = np.where(valid, gain, -np.inf)
+        best = np.argmax(gain)
+        feature, threshold_bin = np.unravel_index(best, gain.shape)
+        if not np.isfinite(gain[feature, threshold_bin]) or gain[feature, threshold_bin] <= 1e-12:
+            return None
+        return feature, threshold_bin
+
+    def _grow_tree(self, X_binned, residuals, rows, chunks, executor):
+        gradients = np.hstack([residuals, np.ones((len(residuals), 1))]).astype(np.float32)
+        features, thresholds, lefts, rights, values = [], [], [], [], []
+        leaves = []
+
+        def add_node():
+            features.append(-1)
+            thresholds.append(0.)
+            lefts.append(-1)
+            rights.append(-1)
+            values.append(None)
+            return len(features) - 1
+
+        root = add_node()
+        root_hist = self._histogram(X_binned[rows], gradients[rows], chunks, executor)
+        stack = [(root, rows, root_hist, 0)]
+        while stack:
+            node, node_rows, hist, depth = stack.pop()
+            total = hist[0].sum(axis=0).astype(np.float64)
+            split = None
+            if depth < self.max_depth and len(node_rows) >= 2 * self.min_samples_leaf:
+                split = self._best_split(hist.astype(np.float64), total)
+
+            if split is None:
+                values[node] = self.learning_rate * total[:-1] / (total[-1] + self.l2_regularization)
+                leaves.append((node_rows, values[node]))
+                continue
+
+            feature, threshold_bin = split
+            goes_left = X_binned[node_rows, feature] <= threshold_bin
+            left_rows, right_rows = node_rows[goes_left], node_rows[~goes_left]
+            # only the smaller child is histogrammed, the sibling is the difference
+            if len(left_rows) <= len(right_rows):
+                left_hist = self._histogram(X_binned[left_rows], gradients[left_rows], chunks, executor)
+                right_hist = hist - left_hist
+            else:
+                right_hist = self._histogram(X_binned[right_rows], gradients[right_rows], chunks, executor)
+                left_hist = hist - right_hist
+
+            features[node] = feature
+            thresholds[node] = self.bin_thresholds_[feature][threshold_bin]
+            lefts[node] = add_node()
+            rights[node] = add_node()
+            stack.append((lefts[node], left_rows, left_hist, depth + 1))
+            stack.append((rights[node], right_rows, right_hist, depth + 1))
+
+        n_outputs = residuals.shape[1]
+        tree = {
+            'feature': np.array(features, dtype=np.int32),
+            'threshold': np.array(thresholds, dtype=np.float64),
+            'left': np.array(lefts, dtype=np.int32),
+            'right': np.array(rights, dtype=np.int32),
+            'value': np.array([v if v is not None else np.zeros(n_outputs) for v in values]),
+        }
+        return tree, leaves
+
+    def fit(self, X, y):
+        X = np.asarray(X)
+        y = np.asarray(y, dtype=np.float64)
+        if y.ndim == 1:
+            y = y[:, None]
+        rng = np.random.RandomState(self.random_state)
+
+        self._fit_bins(X)
+        X_binned = self._bin(X)
+        n_samples, n_features = X_binned.shape
+
+        # keep a one-hot chunk around 32M entries
+        chunk_size = max(1, min(n_features, (1 << 25) // max(1, n_samples * self.n_bins_)))
+        chunks = [np.arange(start, min(start + chunk_size, n_features))
+                  for start in range(0, n_features, chunk_size)]
+        n_jobs = self.n_jobs if self.n_jobs is not None and self.n_jobs > 0 else None
+
+        self.baseline_ = y.mean(axis=0)
+        raw_prediction = np.tile(self.baseline_, (n_samples, 1))
+        self.trees_ = []
+        with ThreadPoolExecutor(n_jobs) as executor:
+            for _ in range(self.n_estimators):
+                if self.subsample < 1.0:
+                    rows = np.sort(rng.choice(n_samples, max(1, int(self.subsample * n_samples)), replace=False))
+                else:
+                    rows = np.arange(n_samples)
+                tree, leaves = self._grow_tree(X_binned, y - raw_prediction, rows, chunks, executor)
+                self.trees_.append(tree)
+                if self.subsample < 1.0:
+                    raw_prediction += self._predict_tree(tree, X)
+                else:
+                    for leaf_rows, value in leaves:
+                        raw_prediction[leaf_rows] += value
+        self.n_outputs_ = y.shape[1]
+        return self
+
+    def _predict_tree(self, tree, X):
+        node = np.zeros(len(X), dtype=np.int32)
+        rows = np.arange(len(X))
+        for _ in range(self.max_depth):
+            internal = tree['left'][node] >= 0
+            if not internal.any():
+                break
+            goes_left = X[rows, tree['feature'][node]] < tree['threshold'][node]
+            node = np.where(internal, np.where(goes_left, tree['left'][node], tree['right'][node]), node)
+        return tree['value'][node]
+
+    def predict(self, X):
+        X = np.asarray(X)
+        prediction = np.tile(self.baseline_, (len(X), 1))
+        for tree in self.trees_:
+            prediction += self._predict_tree(tree, X)
+        if self.n_outputs_ == 1:
+            return prediction[:, 0]
+        return prediction
@@ -0,0 +1,325 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import statistics
+import time
+
+import numpy as np
+
+# Inference profiles: thread pools, core pinning and batch size of a model artifact on one host.
+# `python inference.py autotune <model>` measures every configuration in a fresh process (the TF
+# thread pools are fixed once the runtime starts) and writes <model>.profile.json:
+#   {"<hostname>": {"latency": {...}, "throughput": {...}, "trials": [...]}}
+# "latency" is the fastest single-sample call, "throughput" the most samples per second.
+# test.py, test_ensemble.py and evaluate.py apply the profile named by INFERENCE_PROFILE.
+# trace_model() wraps a keras model in fixed-signature functions traced and warmed up at load time.
+PROFILE_NAMES = ['latency', 'throughput']
+BATCH_SIZES = [16, 32, 64, 128, 256, 512, 1024]
+
+_applied_profile = None
+
+
+def is_keras_model(model_path):
+    return not model_path.endswith('.joblib')
+
+
+def profile_path(model_path):
+    return os.path.splitext(model_path)[0] + '.profile.json'
+
+
+def load_profile(model_path, name, host=None):
+    if name is None or not os.path.exists(profile_path(model_path)):
+        return None
+    if name not in PROFILE_NAMES:
+        raise ValueError('Unknown profile: {} ({})'.format(name, ', '.join(PROFILE_NAMES)))
+    with open(profile_path(model_path)) as profile_file:
+        profiles = json.load(profile_file)
+    host_profiles = profiles.get(host or socket.gethostname())
+    if host_profiles is None:
+        print('No inference profile of {} for this host'.format(model_path))
+        return None
+    return host_profiles[name]
+
+
+def limit_threads(threads):
+    # BLAS pools read these when they start, TF before its runtime is initialized
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[name] = str(threads)
+    # the scripts import numpy before a profile is applied, so its pools are already running: resize them
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        print('threadpoolctl is not installed, BLAS pools already started keep their size '
+              '(start the script with OMP_NUM_THREADS / MKL_NUM_THREADS / OPENBLAS_NUM_THREADS set)')
+        return
+    threadpool_limits(threads)
+
+
+def apply_profile(profile, keras_model=True):
+    # thread pools and pinning belong to the process and only the first profile applied sets them,
+    # batch size and n_jobs (returned as predict() arguments) are per model.
+    # Call before the first keras model is built.
+    global _applied_profile
+    if profile is None:
+        return {}
+    if _applied_profile is None:
+        if profile['cores'] and hasattr(os, 'sched_setaffinity'):
+            # threads started afterwards (the TF and BLAS pools) inherit the mask
+            os.sched_setaffinity(0, profile['cores'])
+        limit_threads(profile['intra_op_threads'])
+        if keras_model:
+            import tensorflow as tf
+            try:
+                tf.config.threading.set_intra_op_parallelism_threads(profile['intra_op_threads'])
+                tf.config.threading.set_inter_op_parallelism_threads(profile['inter_op_threads'])
+            except RuntimeError:
+                print('TensorFlow is already initialized, keeping its thread pools')
+        _applied_profile = profile
+    elif (profile['intra_op_threads'], profile['inter_op_threads'], profile['cores']) != (
+            _applied_profile['intra_op_threads'], _applied_profile['inter_op_threads'], _applied_profile['cores']):
+        print('Thread settings of the first profile are kept, only the batch size is applied')
+    return {'batch_size': profile['batch_size'], 'n_jobs': profile['intra_op_threads']}
+
+
+def load_model(model_path):
+    # keras: path of the .json (weights in the .h5 next to it); sklearn: .joblib, or its compiled .forest
+    if is_keras_model(model_path):
+        from keras.models import model_from_json
+        with open(os.path.splitext(model_path)[0] + '.json') as json_file:
+            model = model_from_json(json_file.read())
+        model.load_weights(os.path.splitext(model_path)[0] + '.h5')
+        return model
+
+    from forest_export import forest_path, load_forest
+    if os.path.isdir(forest_path(model_path)):
+        return load_forest(forest_path(model_path))
+    from sklearn.externals import joblib
+    return joblib.load(model_path)
+
+
+class TracedModel:
+    # a keras model behind one tf.function traced up front for every declared batch size (fixed
+    # input signatures). predict() runs full batches of the largest size and pads the rest to the
+    # smallest declared size that fits, so no call after loading traces or allocates anew.
+    def __init__(self, model, batch_sizes=(1, 32), warmup=2):
+        import tensorflow as tf
+        self.model = model
+        self.input_shape = model.input_shape
+        self.batch_sizes = sorted(set(int(batch_size) for batch_size in batch_sizes))
+        sample_shape = tuple(model.input_shape[1:])
+        function = tf.function(lambda x: model(x, training=False))
+
+        start_time = time.time()
+        self.functions = dict((batch_size, function.get_concrete_function(
+            tf.TensorSpec((batch_size,) + sample_shape, tf.float32))) for batch_size in self.batch_sizes)
+        self.trace_time = time.time() - start_time
+
+        start_time = time.time()
+        for batch_size in self.batch_sizes:
+            for _ in range(warmup):
+                self.functions[batch_size](tf.zeros((batch_size,) + sample_shape))
+        self.warmup_time = time.time() - start_time
+
+    def _predict_batch(self, x):
+        n = len(x)
+        batch_size = next((size for size in self.batch_sizes if size >= n), self.batch_sizes[-1])
+        if batch_size > n:
+            x = np.concatenate([x, np.zeros((batch_size - n,) + x.shape[1:], dtype=x.dtype)])
+        return self.functions[batch_size](x).numpy()[:n]
+
+    def predict(self, x, batch_size=None, verbose=0):
+        # batch_size is fixed by the declared sizes
+        x = np.asarray(x, dtype=np.float32)
+        step = self.batch_sizes[-1]
+        return np.concatenate([self._predict_batch(x[start:start + step]) for start in range(0, len(x), step)])
+
+
+def trace_model(model, batch_sizes, warmup=2):
+    traced = TracedModel(model, batch_sizes, warmup)
+    print('Traced batch sizes {} in {:.3f}s, warmup {:.3f}s'.format(traced.batch_sizes, traced.trace_time,
+                                                                    traced.warmup_time))
+    return traced
+
+
+def artifact_model_name(model_path):
+    # models/<model>_<batch>_<epochs>/<loss>_<shape>_1: the folder name starts with the model type
+    return os.path.basename(os.path.dirname(os.path.abspath(model_path)))
+
+
+def prepare_input(images, model_name, input_shape_type):
+    # full resolution (N, rows, cols) images -> the input of a model type
+    from train import image_shape, reshape_input, transform_images
+    img_rows, img_cols, channels = image_shape(model_name, input_shape_type)
+    x, _ = reshape_input(transform_images(images, model_name, input_shape_type), model_name, img_rows, img_cols,
+                         channels)
+    return x
+
+
+def predict_images(model, model_name, images, input_shape_type, chunk_size=4096, **predict_args):
+    # predicts chunk by chunk, so the transformed copy of the images stays small
+    return np.concatenate([predict(model, prepare_input(images[start:start + chunk_size], model_name,
+                                                        input_shape_type), **predict_args)
+                           for start in range(0, len(images), chunk_size)])
+
+
+def input_shape(model):
+    if hasattr(model, 'input_shape'):
+        return tuple(model.input_shape[1:])
+    if hasattr(model, 'meta'):
+        return (model.meta['n_features'],)
+    return (getattr(model, 'n_features_in_', None) or getattr(model, 'n_features_', None) or 200,)
+
+
+def predict(model, x, batch_size=None, n_jobs=None):
+    # batched predict of any loaded artifact
+    if hasattr(model, 'input_shape'):
+        return model.predict(x, batch_size=batch_size or 32, verbose=0)
+    if hasattr(model, 'meta'):
+        return model.predict(x, batch_size=batch_size or 2048, n_jobs=n_jobs)
+    if n_jobs is not None and hasattr(model, 'set_params') and model.get_params().get('n_jobs', n_jobs) != n_jobs:
+        model.set_params(n_jobs=n_jobs)
+    if batch_size is None:
+        return model.predict(x)
+    return np.concatenate([model.predict(x[start:start + batch_size]) for start in range(0, len(x), batch_size)])
+
+
+def single_sample_latency(model, x, repeats=50, warmup=0, n_jobs=None):
+    # median milliseconds of single sample calls, cycling through x; the first warmup calls are not counted
+    latencies = []
+    for i in range(warmup + repeats):
+        start_time = time.time()
+        predict(model, x[i % len(x):i % len(x) + 1], 1, n_jobs)
+        latencies.append(time.time() - start_time)
+    return 1000 * statistics.median(latencies[warmup:])
+
+
+def run_config(task):
+    # runs in its own process: the settings below only take effect before the first model is built
+    model_path, config, batch_sizes, samples, repeats = task
+    if config['cores'] and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, config['cores'])
+    limit_threads(config['intra_op_threads'])
+    if is_keras_model(model_path):
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(config['intra_op_threads'])
+        tf.config.threading.set_inter_op_parallelism_threads(config['inter_op_threads'])
+
+    model = load_model(model_path)
+    if is_keras_model(model_path):
+        # measured the way the scripts run it, traced and warmed up
+        model = TracedModel(model, [1])
+    x = (np.random.RandomState(0).rand(samples, *input_shape(model)) < 0.5).astype(np.float32) * 255
+    n_jobs = config['intra_op_threads']
+
+    result = dict(config)
+    result['latency_ms'] = single_sample_latency(model, x, repeats, warmup=3, n_jobs=n_jobs)
+
+    throughput = {}
+    for batch_size in batch_sizes:
+        if isinstance(model, TracedModel):
+            model = TracedModel(model.model, [1, batch_size])
+        predict(model, x[:batch_size], batch_size, n_jobs)
+        start_time = time.time()
+        predict(model, x, batch_size, n_jobs)
+        throughput[batch_size] = samples / (time.time() - start_time)
+    result['samples_per_s'] = throughput
+    print('threads {intra_op_threads}/{inter_op_threads} pinned {pin}: {latency_ms:.2f} ms, '
+          '{best:.0f} samples/s'.format(best=max(throughput.values()), **result))
+    return result
+
+
+def thread_configs(keras_model, max_threads=None):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    max_threads = min(max_threads or len(cores), len(cores))
+    thread_counts = sorted(set([2 ** i for i in range(int(np.log2(max_threads)) + 1)] + [max_threads]))
+    inter_op_counts = [1, 2] if keras_model else [1]
+    configs = []
+    for threads in thread_counts:
+        for inter_op_threads in inter_op_counts:
+            for pin in [False, True]:
+                if pin and threads == len(cores):
+                    continue
+                configs.append({
+                    'intra_op_threads': threads,
+                    'inter_op_threads': inter_op_threads,
+                    'pin': pin,
+                    # the first cores of the allowed set, so several pinned processes can be laid out side by side
+                    'cores': cores[:threads] if pin else [],
+                })
+    return configs
+
+
+def autotune(model_path, samples=2048, repeats=50, max_threads=None, batch_sizes=None):
+    batch_sizes = batch_sizes or BATCH_SIZES
+    configs = thread_configs(is_keras_model(model_path), max_threads)
+    tasks = [(model_path, config, batch_sizes, samples, repeats) for config in configs]
+    # one fresh process per configuration, one at a time so the trials do not compete for cores
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        trials = pool.map(run_config, tasks, chunksize=1)
+
+    latency = dict(min(trials, key=lambda trial: trial['latency_ms']))
+    latency['batch_size'] = 1
+    best = max(((trial, batch_size) for trial in trials for batch_size in trial['samples_per_s']),
+               key=lambda pair: pair[0]['samples_per_s'][pair[1]])
+    throughput = dict(best[0])
+    throughput['batch_size'] = int(best[1])
+    for profile in [latency, throughput]:
+        profile['samples_per_s'] = profile['samples_per_s'][profile['batch_size']] \
+            if profile['batch_size'] in profile['samples_per_s'] else None
+
+    profiles = {}
+    if os.path.exists(profile_path(model_path)):
+        with open(profile_path(model_path)) as profile_file:
+            profiles = json.load(profile_file)
+    profiles[socket.gethostname()] = {
+        'cpu_count': os.cpu_count(),
+        'latency': latency,
+        'throughput': throughput,
+        'trials': [dict(trial, samples_per_s=dict((str(b), v) for b, v in trial['samples_per_s'].items()))
+                   for trial in trials],
+    }
+    with open(profile_path(model_path), 'w') as profile_file:
+        json.dump(profiles, profile_file, indent=2)
+    return profiles[socket.gethostname()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    autotune_parser = subparsers.add_parser('autotune', help="Measure thread / pinning / batch size settings")
+    autotune_parser.add_argument("model_path", help="Model artifact (.json of a keras model, or .joblib)")
+    autotune_parser.add_argument("-n", "--samples", help="Samples per throughput measurement", default=2048)
+    autotune_parser.add_argument("-r", "--repeats", help="Single-sample calls per latency measurement", default=50)
+    autotune_parser.add_argument("-t", "--max_threads", help="Largest thread count tried (default: all cores)",
+                                 default=None)
+    autotune_parser.add_argument("--batch_sizes", help="Batch sizes tried, comma separated",
+                                 default=','.join(str(b) for b in BATCH_SIZES))
+
+    show_parser = subparsers.add_parser('show', help="Print the profiles of a model artifact")
+    show_parser.add_argument("model_path", help="Model artifact (.json of a keras model, or .joblib)")
+
+    args = parser.parse_args()
+    if args.command == 'autotune':
+        result = autotune(args.model_path, int(args.samples), int(args.repeats),
+                          int(args.max_threads) if args.max_threads else None,
+                          [int(b) for b in args.batch_sizes.split(',')])
+        print('Saved profiles to {}'.format(profile_path(args.model_path)))
+    elif args.command == 'show':
+        with open(profile_path(args.model_path)) as profile_file:
+            result = json.load(profile_file).get(socket.gethostname())
+        if result is None:
+            parser.error('No profile of {} for this host'.format(args.model_path))
+    else:
+        parser.print_help()
+        result = None
+
+    if result is not None:
+        for name in PROFILE_NAMES:
+            profile = result[name]
+            print('{}: threads {}/{}, cores {}, batch size {}, {:.2f} ms/sample call, {} samples/s'.format(
+                name, profile['intra_op_threads'], profile['inter_op_threads'], profile['cores'] or 'all',
+                profile['batch_size'], profile['latency_ms'],
+                '{:.0f}'.format(profile['samples_per_s']) if profile['samples_per_s'] else '-'))
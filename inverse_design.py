@@ -0,0 +1,268 @@
+import argparse
+import heapq
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from inference import TracedModel, apply_profile, artifact_model_name, is_keras_model, load_model, load_profile
+from inference import predict
+
+# Geometry sweep and inverse design against a target spectrum.
+# Candidates are 10x20 binary cell grids, the images are the grids upsampled by 10 (0/255), so every
+# model type reads its input straight from the cells (sklearn models see the cells themselves).
+#   sweep     random grids (--fill, --seed) or a .npy of (N, 10, 20) grids / (N, 100, 200) images,
+#             streamed in batches (the next batch is generated while the model predicts)
+#   top-k     distance to the target spectrum, a bounded heap keeps the k closest distinct grids
+#   optimize  (mu + lambda) evolution from the top-k: every elite gets --offspring mutants with
+#             --flips random cells flipped, elites and mutants compete for the k places
+# Throughput in candidates per second is reported for both phases.
+
+CELL_ROWS, CELL_COLS, CELL_SIZE = 10, 20, 10
+
+
+def random_candidates(n_candidates, batch_size, fill=0.5, seed=0):
+    rng = np.random.RandomState(seed)
+    for start in range(0, n_candidates, batch_size):
+        size = min(batch_size, n_candidates - start)
+        yield (rng.random_sample((size, CELL_ROWS, CELL_COLS)) < fill).astype(np.uint8)
+
+
+def read_candidates(path, batch_size):
+    # (N, 10, 20) cells or (N, 100, 200) images, memory mapped
+    candidates = np.load(path, mmap_mode='r')
+    for start in range(0, len(candidates), batch_size):
+        batch = np.asarray(candidates[start:start + batch_size])
+        if batch.shape[1:] != (CELL_ROWS, CELL_COLS):
+            batch = batch[:, ::CELL_SIZE, ::CELL_SIZE]
+        yield (batch > 0).astype(np.uint8)
+
+
+def prefetch(iterator):
+    # produce the next batch in a thread while the current one is evaluated
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(next, iterator, None)
+        while True:
+            batch = future.result()
+            if batch is None:
+                return
+            future = executor.submit(next, iterator, None)
+            yield batch
+
+
+def cells_to_images(cells, factor=CELL_SIZE):
+    return np.repeat(np.repeat(cells * np.uint8(255), factor, axis=-2), factor, axis=-1)
+
+
+def model_input(cells, model_name, input_shape_type):
+    # the transform_images / reshape_input result of the upsampled images, without building them
+    from train import image_shape, reshape_input
+    if model_name.startswith('cnn_small'):
+        images = cells_to_images(cells, CELL_SIZE // 5)
+    elif model_name.startswith('cnn') or model_name.startswith('nn'):
+        images = cells_to_images(cells)
+    else:
+        images = cells * np.uint8(255)
+    if input_shape_type.startswith('rect') is False:
+        images = np.concatenate([images, np.flip(images, -2)], axis=-2)
+    img_rows, img_cols, channels = image_shape(model_name, input_shape_type)
+    x, _ = reshape_input(images, model_name, img_rows, img_cols, channels)
+    return x
+
+
+def spectrum_distance(y_predict, target, metric='rmse'):
+    rmse = np.sqrt(np.mean(np.square(y_predict - target), axis=1))
+    if metric == 'rmse':
+        return rmse
+    diff_rmse = np.sqrt(np.mean(np.square(np.diff(y_predict, axis=1) - np.diff(target)), axis=1))
+    if metric == 'diff_rmse':
+        return diff_rmse
+    if metric == 'rmse_add_diff_rmse':
+        return rmse + diff_rmse
+    raise ValueError('Unknown metric: {} (rmse, diff_rmse, rmse_add_diff_rmse)'.format(metric))
+
+
+class TopK:
+    # the k closest distinct grids; heap of (-distance, order, key) so the worst kept one is on top
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.entries = {}
+        self.order = 0
+
+    def worst(self):
+        return -self.heap[0][0] if len(self.heap) == self.k else np.inf
+
+    def push_batch(self, cells, distances, y_predict):
+        # only the k best of the batch can enter
+        if len(distances) > self.k:
+            best = np.argpartition(distances, self.k - 1)[:self.k]
+        else:
+            best = np.arange(len(distances))
+        for i in best[np.argsort(distances[best])]:
+            if distances[i] >= self.worst():
+                break
+            key = cells[i].tobytes()
+            if key in self.entries:
+                continue
+            self.order += 1
+            self.entries[key] = (float(distances[i]), cells[i].copy(), y_predict[i].copy())
+            if len(self.heap) == self.k:
+                _, _, removed = heapq.heapreplace(self.heap, (-float(distances[i]), self.order, key))
+                del self.entries[removed]
+            else:
+                heapq.heappush(self.heap, (-float(distances[i]), self.order, key))
+
+    def sorted(self):
+        entries = sorted(self.entries.values(), key=lambda entry: entry[0])
+        return (np.array([entry[0] for entry in entries]), np.array([entry[1] for entry in entries]),
+                np.array([entry[2] for entry in entries]))
+
+
+class CandidateEvaluator:
+    def __init__(self, model, model_name, input_shape_type, target, metric='rmse', **predict_args):
+        self.model = model
+        self.model_name = model_name
+        self.input_shape_type = input_shape_type
+        self.target = target
+        self.metric = metric
+        self.predict_args = predict_args
+        self.evaluated = 0
+        self.seconds = 0.
+
+    def __call__(self, cells):
+        start_time = time.time()
+        y_predict = predict(self.model, model_input(cells, self.model_name, self.input_shape_type),
+                            **self.predict_args)
+        distances = spectrum_distance(y_predict, self.target, self.metric)
+        self.evaluated += len(cells)
+        self.seconds += time.time() - start_time
+        return distances, y_predict
+
+
+def sweep(evaluate, batches, top_k):
+    for cells in prefetch(batches):
+        distances, y_predict = evaluate(cells)
+        top_k.push_batch(cells, distances, y_predict)
+    return top_k
+
+
+def mutate(cells, n_offspring, n_flips, rng):
+    # every parent -> n_offspring copies with n_flips distinct cells flipped
+    children = np.repeat(cells, n_offspring, axis=0).reshape(-1, CELL_ROWS * CELL_COLS)
+    flips = np.argsort(rng.random_sample(children.shape), axis=1)[:, :n_flips]
+    rows = np.arange(len(children))[:, None]
+    children[rows, flips] ^= 1
+    return children.reshape(-1, CELL_ROWS, CELL_COLS)
+
+
+def evolve(evaluate, top_k, generations, n_offspring, n_flips, seed=0):
+    rng = np.random.RandomState(seed)
+    history = []
+    for generation in range(generations):
+        _, elites, _ = top_k.sorted()
+        children = mutate(elites, n_offspring, n_flips, rng)
+        distances, y_predict = evaluate(children)
+        top_k.push_batch(children, distances, y_predict)
+        history.append(float(top_k.sorted()[0][0]))
+        print('generation {}: best {:.5f}, k-th {:.5f}'.format(generation + 1, history[-1], top_k.worst()))
+    return history
+
+
+def load_target(datapath, reference):
+    # <dataset>/<id> of a simulated geometry, the row the loaders read for <id>.tiff
+    from train import file_row
+    data, data_id = reference.split('/')
+    dataset = pd.read_csv('{}/{}.csv'.format(datapath, data), delim_whitespace=False, header=None).values
+    row = file_row(dataset[:, 0], int(data_id))
+    return np.true_divide(dataset[row, 1:25].astype(np.float64), 2767.1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", help="Model (keras path without .json/.h5, or .joblib)", required=True)
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-t", "--target", help="Target spectrum of a simulated geometry, <dataset>/<id>",
+                        default=None)
+    parser.add_argument("--datapath", help="Folder of the target dataset", default='./data/test')
+    parser.add_argument("--target_values", help="Target spectrum, 24 comma separated transmittances (0-1)",
+                        default=None)
+    parser.add_argument("--metric", help="Distance to the target (rmse, diff_rmse, rmse_add_diff_rmse)",
+                        default='rmse')
+    parser.add_argument("-n", "--n_candidates", help="Random candidates of the sweep", default=100000)
+    parser.add_argument("--candidates", help="Sweep a .npy of (N, 10, 20) grids or (N, 100, 200) images instead",
+                        default=None)
+    parser.add_argument("--fill", help="Fraction of open cells of the random candidates", default=0.5)
+    parser.add_argument("-k", "--top_k", help="Candidates kept", default=100)
+    parser.add_argument("-b", "--batch_size", help="Candidates per batch", default=4096)
+    parser.add_argument("-g", "--generations", help="Generations of the evolutionary search (0: sweep only)",
+                        default=20)
+    parser.add_argument("--offspring", help="Mutants per elite and generation", default=20)
+    parser.add_argument("--flips", help="Cells flipped per mutant", default=2)
+    parser.add_argument("--seed", help="Random seed", default=0)
+    parser.add_argument("-o", "--output", help="Output folder", default='result/design')
+
+    args = parser.parse_args()
+    if (args.target is None) == (args.target_values is None):
+        parser.error('give --target or --target_values')
+    if args.target is not None:
+        target = load_target(args.datapath, args.target)
+    else:
+        target = np.array([float(value) for value in args.target_values.split(',')])
+    if len(target) != 24:
+        parser.error('the target spectrum needs 24 values')
+    batch_size = int(args.batch_size)
+    seed = int(args.seed)
+
+    predict_args = apply_profile(load_profile(args.model, 'throughput'), keras_model=is_keras_model(args.model))
+    model = load_model(args.model)
+    model_name = artifact_model_name(args.model)
+    if hasattr(model, 'input_shape'):
+        model = TracedModel(model, [256])
+    evaluate = CandidateEvaluator(model, model_name, args.shape, target, args.metric, **predict_args)
+    top_k = TopK(int(args.top_k))
+
+    if args.candidates:
+        batches = read_candidates(args.candidates, batch_size)
+    else:
+        batches = random_candidates(int(args.n_candidates), batch_size, float(args.fill), seed)
+    start_time = time.time()
+    sweep(evaluate, batches, top_k)
+    sweep_time = time.time() - start_time
+    sweep_count = evaluate.evaluated
+    print('sweep: {} candidates in {:.3f}s, {:.1f} candidates/s (model {:.1f}/s), best {:.5f}'.format(
+        sweep_count, sweep_time, sweep_count / sweep_time, sweep_count / evaluate.seconds, top_k.sorted()[0][0]))
+
+    start_time = time.time()
+    history = evolve(evaluate, top_k, int(args.generations), int(args.offspring), int(args.flips), seed)
+    evolve_time = time.time() - start_time
+    evolve_count = evaluate.evaluated - sweep_count
+    if evolve_count:
+        print('evolution: {} candidates in {:.3f}s, {:.1f} candidates/s'.format(
+            evolve_count, evolve_time, evolve_count / evolve_time))
+
+    distances, cells, y_predict = top_k.sorted()
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    from PIL import Image
+    for rank, grid in enumerate(cells):
+        Image.fromarray(cells_to_images(grid)).save(os.path.join(args.output, '{}.tiff'.format(rank + 1)))
+    # the layout of the data csv files: id, 24 transmittances (unnormalized)
+    np.savetxt(os.path.join(args.output, 'predicted.csv'),
+               np.hstack([np.arange(1, len(cells) + 1)[:, None], y_predict * 2767.1]), delimiter=',')
+    np.savez(os.path.join(args.output, 'top_k.npz'), cells=cells, distances=distances, y_predict=y_predict,
+             target=target)
+    summary = {
+        'model': args.model,
+        'target': args.target or list(target),
+        'metric': args.metric,
+        'sweep': {'candidates': sweep_count, 'seconds': sweep_time, 'candidates_per_s': sweep_count / sweep_time},
+        'evolution': {'candidates': evolve_count, 'seconds': evolve_time, 'best_per_generation': history},
+        'distances': [float(distance) for distance in distances],
+    }
+    with open(os.path.join(args.output, 'summary.json'), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print('Saved {} designs to {}, best distance {:.5f}'.format(len(cells), args.output, distances[0]))
@@ -0,0 +1,92 @@
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+
+from linear_stream import StreamingLinearRegressor
+
+# Multi-output RBF kernel ridge regression on an explicit low-rank feature map:
+#   rff:       z(x) = sqrt(2 / D) cos(x W + b),  W ~ N(0, 2 gamma), b ~ U(0, 2 pi)
+#   nystroem:  z(x) = k(x, landmarks) K_mm^(-1/2)
+# The ridge solve runs on accumulated Z'Z / Z'Y (linear_stream), so training goes batch by batch,
+# and predicting all 24 outputs is the feature map plus one matrix multiply.
+
+
+class KernelApproximationRegressor(BaseEstimator, RegressorMixin):
+    def __init__(self, method='nystroem', n_components=1000, gamma='scale', alpha=1.0, input_scale=1 / 255.,
+                 batch_size=4096, random_state=0):
+        self.method = method
+        self.n_components = n_components
+        self.gamma = gamma
+        self.alpha = alpha
+        self.input_scale = input_scale
+        self.batch_size = batch_size
+        self.random_state = random_state
+
+    def _init_features(self, X):
+        rng = np.random.RandomState(self.random_state)
+        n_features = X.shape[1]
+        if self.gamma == 'scale':
+            self.gamma_ = 1. / (n_features * max(X.var(), 1e-12))
+        else:
+            self.gamma_ = float(self.gamma)
+
+        if self.method == 'rff':
+            self.weights_ = rng.normal(scale=np.sqrt(2 * self.gamma_), size=(n_features, self.n_components))
+            self.offsets_ = rng.uniform(0, 2 * np.pi, size=self.n_components)
+        elif self.method == 'nystroem':
+            n_landmarks = min(self.n_components, len(X))
+            self.landmarks_ = X[rng.choice(len(X), n_landmarks, replace=False)]
+            eigenvalues, eigenvectors = np.linalg.eigh(self._rbf(self.landmarks_))
+            eigenvalues = np.maximum(eigenvalues, 1e-12)
+            self.normalization_ = eigenvectors / np.sqrt(eigenvalues)
+        else:
+            raise ValueError('Unknown method: {}'.format(self.method))
+        self.solver_ = StreamingLinearRegressor(penalty='ridge', alpha=self.alpha)
+
+    def _rbf(self, X):
+        squared_distance = (np.sum(X ** 2, axis=1)[:, None] - 2 * X @ self.landmarks_.T +
+                            np.sum(self.landmarks_ ** 2, axis=1)[None, :])
+        return np.exp(-self.gamma_ * np.maximum(squared_distance, 0))
+
+    def transform(self, X):
+        X = np.asarray(X, dtype=np.float64) * self.input_scale
+        if self.method == 'rff':
+            return np.sqrt(2. / self.n_components) * np.cos(X @ self.weights_ + self.offsets_)
+        return self._rbf(X) @ self.normalization_
+
+    def init_features(self, X):
+        # gamma and the landmarks from a random sample of all rows (X can be a folder-ordered memmap),
+        # before any batch is streamed
+        n_sample = min(len(X), max(self.batch_size, self.n_components))
+        rows = np.sort(np.random.RandomState(self.random_state).choice(len(X), n_sample, replace=False))
+        self._init_features(np.asarray(X[rows], dtype=np.float64) * self.input_scale)
+        return self
+
+    def partial_fit(self, X, y):
+        if not hasattr(self, 'solver_'):
+            self._init_features(np.asarray(X, dtype=np.float64) * self.input_scale)
+        self.solver_.partial_fit(self.transform(X), y)
+        return self
+
+    def solve(self):
+        self.solver_.set_params(alpha=self.alpha)
+        self.solver_.solve()
+        return self
+
+    def fit(self, X, y):
+        for name in ['solver_', 'weights_', 'landmarks_']:
+            if hasattr(self, name):
+                delattr(self, name)
+        self.init_features(X)
+        for start in range(0, len(X), self.batch_size):
+            self.partial_fit(np.asarray(X[start:start + self.batch_size]),
+                             np.asarray(y[start:start + self.batch_size]))
+        return self.solve()
+
+    def predict(self, X):
+        X = np.asarray(X)
+        if len(X) == 0:
+            return np.zeros((0, self.solver_.coef_.shape[0]))
+        prediction = []
+        for start in range(0, len(X), self.batch_size):
+            prediction.append(self.solver_.predict(self.transform(X[start:start + self.batch_size])))
+        return np.concatenate(prediction)
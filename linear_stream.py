@@ -0,0 +1,266 @@
+import argparse
+import multiprocessing
+import os
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+
+# Exact linear models from accumulated sufficient statistics:
+#   n, sum(x), sum(y), X'X, X'Y, Y'Y
+# Chunks (or whole folders, or other workers' partial sums) are added with partial_fit / merge,
+# the solve only touches the (n_features x n_features) Gram matrix, for all 24 outputs at once.
+# Objectives follow sklearn, so a solved model matches LinearRegression / Ridge / Lasso / ElasticNet:
+#   ols, ridge:         ||y - Xw - b||^2 + alpha ||w||^2
+#   lasso, elasticnet:  1 / (2n) ||y - Xw - b||^2 + alpha l1_ratio |w| + alpha (1 - l1_ratio) / 2 ||w||^2
+STAT_NAMES = ['n', 'x_sum', 'y_sum', 'xtx', 'xty', 'yty']
+LINEAR_MODELS = ('lr', 'ridge', 'lasso', 'elasticnet')
+
+
+class StreamingLinearRegressor(BaseEstimator, RegressorMixin):
+    def __init__(self, penalty='ridge', alpha=1.0, l1_ratio=0.5, max_iter=1000, tol=1e-4):
+        self.penalty = penalty
+        self.alpha = alpha
+        self.l1_ratio = l1_ratio
+        self.max_iter = max_iter
+        self.tol = tol
+
+    def reset(self):
+        for name in STAT_NAMES:
+            if hasattr(self, name + '_'):
+                delattr(self, name + '_')
+        return self
+
+    def partial_fit(self, X, y):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if not hasattr(self, 'n_'):
+            self.n_ = 0
+            self.x_sum_ = np.zeros(X.shape[1])
+            self.y_sum_ = np.zeros(y.shape[1])
+            self.xtx_ = np.zeros((X.shape[1], X.shape[1]))
+            self.xty_ = np.zeros((X.shape[1], y.shape[1]))
+            self.yty_ = np.zeros(y.shape[1])
+        self.n_ += len(X)
+        self.x_sum_ += X.sum(axis=0)
+        self.y_sum_ += y.sum(axis=0)
+        self.xtx_ += X.T @ X
+        self.xty_ += X.T @ y
+        self.yty_ += np.einsum('ij,ij->j', y, y)
+        return self
+
+    def merge(self, other):
+        if not hasattr(self, 'n_'):
+            for name in STAT_NAMES:
+                setattr(self, name + '_', np.copy(getattr(other, name + '_')))
+            return self
+        for name in STAT_NAMES:
+            setattr(self, name + '_', getattr(self, name + '_') + getattr(other, name + '_'))
+        return self
+
+    def save_stats(self, path):
+        np.savez(path, **dict((name, getattr(self, name + '_')) for name in STAT_NAMES))
+
+    def load_stats(self, path):
+        stats = np.load(path)
+        for name in STAT_NAMES:
+            setattr(self, name + '_', stats[name])
+        self.n_ = int(self.n_)
+        return self
+
+    def _centered(self):
+        x_mean = self.x_sum_ / self.n_
+        y_mean = self.y_sum_ / self.n_
+        gram = self.xtx_ - self.n_ * np.outer(x_mean, x_mean)
+        xty = self.xty_ - self.n_ * np.outer(x_mean, y_mean)
+        return x_mean, y_mean, gram, xty
+
+    def _coordinate_descent(self, gram, xty, alpha, l1_ratio, coef):
+        # covariance-form coordinate descent, every output updated together per feature
+        gram = gram / self.n_
+        xty = xty / self.n_
+        l1 = alpha * l1_ratio
+        l2 = alpha * (1 - l1_ratio)
+        coef = np.array(coef, dtype=np.float64)
+        gram_coef = gram @ coef
+        diagonal = np.diag(gram)
+        for _ in range(self.max_iter):
+            max_update = 0.
+            for j in range(len(coef)):
+                if diagonal[j] == 0:
+                    continue
+                rho = xty[j] - gram_coef[j] + diagonal[j] * coef[j]
+                new_coef = np.sign(rho) * np.maximum(np.abs(rho) - l1, 0) / (diagonal[j] + l2)
+                update = new_coef - coef[j]
+                if np.any(update != 0):
+                    gram_coef += np.outer(gram[:, j], update)
+                    coef[j] = new_coef
+                    max_update = max(max_update, np.max(np.abs(update)))
+            if max_update <= self.tol * max(1e-12, np.max(np.abs(coef))):
+                break
+        return coef
+
+    def _solve(self, alpha, gram, xty, warm_start=None):
+        if self.penalty == 'ols':
+            return np.linalg.lstsq(gram, xty, rcond=None)[0]
+        if self.penalty == 'ridge':
+            return np.linalg.solve(gram + alpha * np.eye(len(gram)), xty)
+        if self.penalty in ('lasso', 'elasticnet'):
+            l1_ratio = 1.0 if self.penalty == 'lasso' else self.l1_ratio
+            return self._coordinate_descent(gram, xty, alpha, l1_ratio,
+                                            np.zeros_like(xty) if warm_start is None else warm_start)
+        raise ValueError('Unknown penalty: {}'.format(self.penalty))
+
+    def solve(self, alpha=None):
+        alpha = self.alpha if alpha is None else alpha
+        x_mean, y_mean, gram, xty = self._centered()
+        self.coef_ = self._solve(alpha, gram, xty).T
+        self.intercept_ = y_mean - self.coef_ @ x_mean
+        return self
+
+    def regularization_path(self, alphas):
+        # list of (alpha, coef, intercept) from the same Gram matrix
+        x_mean, y_mean, gram, xty = self._centered()
+        path = []
+        if self.penalty == 'ridge':
+            eigenvalues, eigenvectors = np.linalg.eigh(gram)
+            projected = eigenvectors.T @ xty
+            for alpha in alphas:
+                coef = (eigenvectors @ (projected / (eigenvalues + alpha)[:, None])).T
+                path.append((alpha, coef, y_mean - coef @ x_mean))
+        else:
+            # large to small alpha, every solve warm-starts from the previous one
+            coef = None
+            for alpha in sorted(alphas, reverse=True):
+                coef = self._solve(alpha, gram, xty, warm_start=coef)
+                path.append((alpha, coef.T, y_mean - coef.T @ x_mean))
+        return path
+
+    def stats_mse(self, coef, intercept):
+        # mean squared error of (coef, intercept) on the data behind these statistics
+        w = np.vstack([coef.T, intercept[None, :]])
+        xtx = np.block([[self.xtx_, self.x_sum_[:, None]], [self.x_sum_[None, :], np.array([[self.n_]])]])
+        xty = np.vstack([self.xty_, self.y_sum_[None, :]])
+        sse = self.yty_ - 2 * np.einsum('ij,ij->j', w, xty) + np.einsum('ij,ij->j', w, xtx @ w)
+        return float(np.sum(sse) / (self.n_ * len(sse)))
+
+    def fit(self, X, y):
+        return self.reset().partial_fit(X, y).solve()
+
+    def predict(self, X):
+        return np.asarray(X, dtype=np.float64) @ self.coef_.T + self.intercept_
+
+
+def from_sklearn(model):
+    # the streaming counterpart of a create_model linear estimator
+    name = type(model).__name__
+    if name == 'LinearRegression':
+        return StreamingLinearRegressor(penalty='ols')
+    if name == 'Ridge':
+        return StreamingLinearRegressor(penalty='ridge', alpha=model.alpha)
+    if name == 'Lasso':
+        return StreamingLinearRegressor(penalty='lasso', alpha=model.alpha, max_iter=model.max_iter, tol=model.tol)
+    if name == 'ElasticNet':
+        return StreamingLinearRegressor(penalty='elasticnet', alpha=model.alpha, l1_ratio=model.l1_ratio,
+                                        max_iter=model.max_iter, tol=model.tol)
+    raise ValueError('No streaming counterpart for {}'.format(name))
+
+
+def accumulate_stats(datapath, datasets, input_shape_type, chunk_size=4096):
+    from train import iter_dataset
+
+    stats = StreamingLinearRegressor()
+    for x, y in iter_dataset(datapath, datasets, 'lr', input_shape_type, chunk_size):
+        stats.partial_fit(x.reshape(len(x), -1), y)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    update_parser = subparsers.add_parser('update', help="Add dataset folders to a statistics file")
+    update_parser.add_argument("stats", help="Statistics file (.npz), created when missing")
+    update_parser.add_argument("--datapath", help="Folder of the datasets", default=None)
+    update_parser.add_argument("--datasets", help="Datasets, comma separated (default: train datasets)",
+                               default=None)
+    update_parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)",
+                               default='rect')
+    update_parser.add_argument("-w", "--workers", help="Accumulate datasets in parallel processes", default=1)
+
+    merge_parser = subparsers.add_parser('merge', help="Merge partial statistics of several workers")
+    merge_parser.add_argument("stats", help="Merged statistics file (.npz)")
+    merge_parser.add_argument("parts", help="Partial statistics files", nargs='+')
+
+    fit_parser = subparsers.add_parser('fit', help="Solve a linear model from a statistics file")
+    fit_parser.add_argument("stats", help="Statistics file (.npz)")
+    fit_parser.add_argument("-m", "--model", help="Select model type. ({})".format(', '.join(LINEAR_MODELS)),
+                            default='ridge')
+    fit_parser.add_argument("-a", "--alpha", help="Regularization strength", default=1.0)
+    fit_parser.add_argument("--l1_ratio", help="l1 ratio of elasticnet", default=0.5)
+    fit_parser.add_argument("--path", help="Alphas of a regularization path, comma separated", default=None)
+    fit_parser.add_argument("--validation_stats", help="Statistics file used to pick the alpha of --path",
+                            default=None)
+    fit_parser.add_argument("-s", "--shape", help="Input image shape the statistics were built with",
+                            default='rect')
+
+    args = parser.parse_args()
+    if args.command == 'update':
+        from train import DATAPATH_TRAIN, DATASETS_TRAIN
+
+        datapath = args.datapath or DATAPATH_TRAIN
+        datasets = args.datasets.split(',') if args.datasets else DATASETS_TRAIN
+        stats = StreamingLinearRegressor()
+        if os.path.exists(args.stats):
+            stats.load_stats(args.stats)
+        n_before = getattr(stats, 'n_', 0)
+
+        if int(args.workers) > 1:
+            with multiprocessing.get_context('spawn').Pool(int(args.workers)) as pool:
+                parts = pool.starmap(accumulate_stats, [(datapath, [data], args.shape) for data in datasets])
+        else:
+            parts = [accumulate_stats(datapath, datasets, args.shape)]
+        for part in parts:
+            if hasattr(part, 'n_'):
+                stats.merge(part)
+        stats.save_stats(args.stats)
+        print('{}: {} samples (+{})'.format(args.stats, stats.n_, stats.n_ - n_before))
+
+    elif args.command == 'merge':
+        stats = StreamingLinearRegressor()
+        for part in args.parts:
+            stats.merge(StreamingLinearRegressor().load_stats(part))
+        stats.save_stats(args.stats)
+        print('{}: {} samples'.format(args.stats, stats.n_))
+
+    elif args.command == 'fit':
+        from sklearn.externals import joblib
+
+        if args.model not in LINEAR_MODELS:
+            parser.error('--model must be one of {}'.format(', '.join(LINEAR_MODELS)))
+        penalty = 'ols' if args.model == 'lr' else args.model
+        regr = StreamingLinearRegressor(penalty=penalty, alpha=float(args.alpha), l1_ratio=float(args.l1_ratio))
+        regr.load_stats(args.stats)
+
+        if args.path is not None:
+            alphas = [float(alpha) for alpha in args.path.split(',')]
+            scoring_stats = regr
+            if args.validation_stats is not None:
+                scoring_stats = StreamingLinearRegressor().load_stats(args.validation_stats)
+            best_alpha, best_mse = None, np.inf
+            for alpha, coef, intercept in regr.regularization_path(alphas):
+                mse = scoring_stats.stats_mse(coef, intercept)
+                print('alpha {}: RMSE {:.5f}'.format(alpha, np.sqrt(mse)))
+                if mse < best_mse:
+                    best_alpha, best_mse = alpha, mse
+            print('best alpha: {}'.format(best_alpha))
+            regr.set_params(alpha=best_alpha)
+        regr.solve()
+
+        model_export_path_folder = 'models/{}_stream'.format(args.model)
+        if not os.path.exists(model_export_path_folder):
+            os.makedirs(model_export_path_folder)
+        model_export_path = '{}/{}_{}_1.joblib'.format(model_export_path_folder, args.model, args.shape)
+        joblib.dump(regr, model_export_path)
+        print("Saved model to {}".format(model_export_path))
+    else:
+        parser.print_help()
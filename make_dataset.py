@@ -0,0 +1,103 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from inverse_design import CELL_ROWS, CELL_COLS, cells_to_images
+
+# Synthetic slit-array datasets in the layout of data/: <datapath>/<dataset>.csv (id, 24 transmittances
+# scaled by 2767.1) and <datapath>/<dataset>/<id>.tiff (100x200, 0/255), for scaling tests offline.
+#   geometry  10x20 cells upsampled by 10; every row is a two-state Markov chain, so open cells form
+#             slits of mean length --mean_slit cells and cover --fill of the array on average
+#   label     an analytical proxy, not a simulation: open fraction plus Gaussian resonances at 10
+#             wavelengths weighted by the spatial frequencies of the column profile
+# Chunks of --chunk_size ids are seeded by (seed, dataset, chunk), so the data does not depend on --jobs.
+
+WAVELENGTHS = np.arange(400, 1600, 50)
+RESONANCES = np.linspace(400, 1525, 10)
+SCALE = 2767.1
+
+
+def slit_cells(rng, n, fill=0.5, mean_slit=3.0):
+    close = 1. / mean_slit
+    open_ = min(fill * close / (1 - fill), 1.)
+    cells = np.zeros((n, CELL_ROWS, CELL_COLS), dtype=np.uint8)
+    state = rng.random_sample((n, CELL_ROWS)) < fill
+    draws = rng.random_sample((n, CELL_ROWS, CELL_COLS))
+    for col in range(CELL_COLS):
+        cells[:, :, col] = state
+        state = np.where(state, draws[:, :, col] >= close, draws[:, :, col] < open_)
+    return cells
+
+
+def proxy_spectra(cells):
+    # (n, 24) transmittances in [0, 1]
+    open_fraction = cells.mean(axis=(1, 2))
+    profile = cells.mean(axis=1)
+    amplitude = np.abs(np.fft.rfft(profile - profile.mean(axis=1, keepdims=True), axis=1))[:, 1:11] / CELL_COLS
+    resonance = np.exp(-np.square((WAVELENGTHS[None, :] - RESONANCES[:, None]) / 60.))
+    spectra = 0.8 * open_fraction[:, None] + 3. * amplitude.dot(resonance)
+    return np.clip(spectra, 0, 1)
+
+
+def write_chunk(task):
+    datapath, dataset, dataset_index, chunk_index, first_id, n, seed, fill, mean_slit = task
+    from PIL import Image
+    rng = np.random.RandomState([seed, dataset_index, chunk_index])
+    cells = slit_cells(rng, n, fill, mean_slit)
+    for i, image in enumerate(cells_to_images(cells)):
+        Image.fromarray(image).save(os.path.join(datapath, dataset, '{}.tiff'.format(first_id + i)))
+    ids = np.arange(first_id, first_id + n)
+    return np.column_stack([ids, proxy_spectra(cells) * SCALE])
+
+
+def make_dataset(datapath, dataset, dataset_index, n_samples, seed=0, fill=0.5, mean_slit=3.0, chunk_size=1000,
+                 pool=None):
+    if not os.path.exists(os.path.join(datapath, dataset)):
+        os.makedirs(os.path.join(datapath, dataset))
+    tasks = [(datapath, dataset, dataset_index, chunk_index, start + 1, min(chunk_size, n_samples - start), seed,
+              fill, mean_slit) for chunk_index, start in enumerate(range(0, n_samples, chunk_size))]
+    rows = pool.map(write_chunk, tasks) if pool is not None else [write_chunk(task) for task in tasks]
+    np.savetxt(os.path.join(datapath, '{}.csv'.format(dataset)), np.concatenate(rows), delimiter=',',
+               fmt=['%d'] + ['%.4f'] * len(WAVELENGTHS))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datapath", help="Output folder (e.g. data/synthetic/train)", required=True)
+    parser.add_argument("-n", "--n_samples", help="Samples in total", default=10000)
+    parser.add_argument("-d", "--datasets", help="Number of dataset folders the samples are split into", default=1)
+    parser.add_argument("--prefix", help="Dataset name prefix, datasets are <prefix>_<i>", default='binary_syn')
+    parser.add_argument("--fill", help="Mean fraction of open cells", default=0.5)
+    parser.add_argument("--mean_slit", help="Mean slit length in cells (10 px)", default=3.0)
+    parser.add_argument("--seed", help="Random seed", default=0)
+    parser.add_argument("--chunk_size", help="Samples per seeded chunk", default=1000)
+    parser.add_argument("-j", "--jobs", help="Writer processes", default=1)
+
+    args = parser.parse_args()
+    n_samples = int(args.n_samples)
+    n_datasets = int(args.datasets)
+    fill = float(args.fill)
+    if not 0 < fill < 1:
+        parser.error('--fill has to be between 0 and 1')
+    if float(args.mean_slit) < 1:
+        parser.error('--mean_slit has to be at least one cell')
+    datasets = ['{}_{}'.format(args.prefix, i + 1) for i in range(n_datasets)]
+    sizes = [n_samples // n_datasets + (1 if i < n_samples % n_datasets else 0) for i in range(n_datasets)]
+
+    start_time = time.time()
+    pool = multiprocessing.get_context('spawn').Pool(int(args.jobs)) if int(args.jobs) > 1 else None
+    try:
+        for dataset_index, (dataset, size) in enumerate(zip(datasets, sizes)):
+            make_dataset(args.datapath, dataset, dataset_index, size, int(args.seed), fill, float(args.mean_slit),
+                         int(args.chunk_size), pool)
+            print('{}/{}: {} samples'.format(args.datapath, dataset, size))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start_time
+    print('Wrote {} samples in {:.1f}s ({:.0f} samples/s)'.format(n_samples, elapsed, n_samples / elapsed))
+    print('DATASETS = {}'.format(datasets))
@@ -0,0 +1,124 @@
+import argparse
+import heapq
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from inference import TracedModel, apply_profile, artifact_model_name, is_keras_model, load_model, load_profile
+from inference import predict
+from spectrum_metrics import local_minmax_array
+from train import DATAPATH_TEST, DATASETS_TEST, image_shape, iter_dataset, reshape_input
+
+# The worst predicted samples of a model, in one streamed pass over the datasets (chunk by chunk, so
+# the datasets never have to fit in memory). Per sample errors:
+#   rmse               over the 24 outputs
+#   diff_rmse          of the first differences along the wavelengths
+#   local_minmax_rmse  at the local extrema of the true spectrum (0 for a spectrum without extrema)
+# A bounded heap per metric keeps the k largest; every entry is mapped back to <dataset>/<id>, the
+# .tiff evaluate.py plots, and keeps its true and predicted spectrum.
+
+METRICS = ['rmse', 'diff_rmse', 'local_minmax_rmse']
+
+
+def sample_errors(y, y_predict, mask_array=None):
+    if mask_array is None:
+        mask_array = local_minmax_array(y)
+    squares = np.square(y_predict - y)
+    extrema = mask_array.sum(axis=1)
+    return {
+        'rmse': np.sqrt(squares.mean(axis=1)),
+        'diff_rmse': np.sqrt(np.mean(np.square(np.diff(y_predict, axis=1) - np.diff(y, axis=1)), axis=1)),
+        'local_minmax_rmse': np.sqrt((squares * mask_array).sum(axis=1) / np.maximum(extrema, 1)),
+    }
+
+
+class WorstK:
+    # the k largest errors; min-heap of (error, order, sample) so the smallest kept one is on top
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.order = 0
+
+    def threshold(self):
+        return self.heap[0][0] if len(self.heap) == self.k else -np.inf
+
+    def push_batch(self, errors, ids, y, y_predict, all_errors):
+        # only the k worst of the batch can enter
+        if len(errors) > self.k:
+            worst = np.argpartition(-errors, self.k - 1)[:self.k]
+        else:
+            worst = np.arange(len(errors))
+        for i in worst[np.argsort(-errors[worst])]:
+            if errors[i] <= self.threshold():
+                break
+            self.order += 1
+            sample = (ids[i], dict((key, float(values[i])) for key, values in all_errors.items()), y[i].copy(),
+                      y_predict[i].copy())
+            if len(self.heap) == self.k:
+                heapq.heapreplace(self.heap, (float(errors[i]), self.order, sample))
+            else:
+                heapq.heappush(self.heap, (float(errors[i]), self.order, sample))
+
+    def sorted(self):
+        return [entry[2] for entry in sorted(self.heap, key=lambda entry: (-entry[0], entry[1]))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", help="Model (keras path without .json/.h5, or .joblib)", required=True)
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("--datapath", help="Folder of the datasets", default=DATAPATH_TEST)
+    parser.add_argument("-d", "--datasets", help="Datasets, comma separated (default: the test datasets)",
+                        default=None)
+    parser.add_argument("-k", "--top_k", help="Worst samples kept per metric", default=20)
+    parser.add_argument("-c", "--chunk_size", help="Samples per streamed chunk", default=4096)
+    parser.add_argument("-o", "--output", help="Output path prefix (.csv and .npz)", default='result/worst/worst')
+
+    args = parser.parse_args()
+    datasets = args.datasets.split(',') if args.datasets else DATASETS_TEST
+    top_k = int(args.top_k)
+    model_name = artifact_model_name(args.model)
+    img_rows, img_cols, channels = image_shape(model_name, args.shape)
+
+    predict_args = apply_profile(load_profile(args.model, 'throughput'), keras_model=is_keras_model(args.model))
+    model = load_model(args.model)
+    if hasattr(model, 'input_shape'):
+        model = TracedModel(model, [256])
+    worst = dict((metric, WorstK(top_k)) for metric in METRICS)
+    totals = dict((metric, 0.) for metric in METRICS)
+    n_samples = 0
+
+    start_time = time.time()
+    for x, y, ids in iter_dataset(args.datapath, datasets, model_name, args.shape, int(args.chunk_size),
+                                  return_ids=True):
+        x, _ = reshape_input(x, model_name, img_rows, img_cols, channels)
+        y_predict = predict(model, x, **predict_args)
+        errors = sample_errors(y, y_predict)
+        for metric in METRICS:
+            worst[metric].push_batch(errors[metric], ids, y, y_predict, errors)
+            totals[metric] += float(errors[metric].sum())
+        n_samples += len(y)
+    elapsed = time.time() - start_time
+    print('Ranked {} samples in {:.1f}s ({:.0f} samples/s)'.format(n_samples, elapsed, n_samples / elapsed))
+
+    rows = []
+    spectra = {}
+    for metric in METRICS:
+        samples = worst[metric].sorted()
+        print('{} (mean {:.4f}), worst {}:'.format(metric, totals[metric] / n_samples, len(samples)))
+        for rank, ((dataset, file_id), sample_error, _, _) in enumerate(samples, 1):
+            rows.append(dict([('metric', metric), ('rank', rank), ('dataset', dataset), ('id', file_id)],
+                             **sample_error))
+            print('{:>4}  {}/{}  {:.4f}'.format(rank, dataset, file_id, sample_error[metric]))
+        spectra['{}_y'.format(metric)] = np.array([sample[2] for sample in samples])
+        spectra['{}_y_predict'.format(metric)] = np.array([sample[3] for sample in samples])
+
+    output_folder = os.path.dirname(args.output)
+    if output_folder and not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    pd.DataFrame(rows, columns=['metric', 'rank', 'dataset', 'id'] + METRICS).to_csv(args.output + '.csv',
+                                                                                      index=False)
+    np.savez(args.output + '.npz', **spectra)
+    print('Saved the worst samples to {}.csv, their spectra to {}.npz'.format(args.output, args.output))
@@ -0,0 +1,122 @@
+from math import sqrt
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.metrics import Metric
+
+# Streaming Keras versions of the spectrum metrics of test.py. Each metric keeps running sums,
+# so a validation pass costs one update per batch and the epoch value equals the metric over
+# the whole validation set:
+#   r2                R² per wavelength, averaged over the 24 outputs (r2_score uniform_average)
+#   diff_rmse         RMSE of the first differences along the wavelengths
+#   local_minmax_rmse RMSE at the local extrema of the true spectrum (find_peaks on y and 1 - y)
+
+
+class R2Score(Metric):
+    def __init__(self, name='r2', n_outputs=24, **kwargs):
+        super(R2Score, self).__init__(name=name, **kwargs)
+        self.n_outputs = n_outputs
+        self.count = self.add_weight(name='count', initializer='zeros')
+        self.total = self.add_weight(name='total', shape=(n_outputs,), initializer='zeros')
+        self.total_squares = self.add_weight(name='total_squares', shape=(n_outputs,), initializer='zeros')
+        self.residual_squares = self.add_weight(name='residual_squares', shape=(n_outputs,), initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.cast(y_true, self.dtype)
+        y_pred = tf.cast(y_pred, self.dtype)
+        self.count.assign_add(tf.cast(tf.shape(y_true)[0], self.dtype))
+        self.total.assign_add(K.sum(y_true, axis=0))
+        self.total_squares.assign_add(K.sum(K.square(y_true), axis=0))
+        self.residual_squares.assign_add(K.sum(K.square(y_pred - y_true), axis=0))
+
+    def result(self):
+        total_variance = self.total_squares - tf.math.divide_no_nan(K.square(self.total), self.count)
+        return K.mean(1 - tf.math.divide_no_nan(self.residual_squares, total_variance))
+
+    def get_config(self):
+        config = super(R2Score, self).get_config()
+        config['n_outputs'] = self.n_outputs
+        return config
+
+
+class DiffRMSE(Metric):
+    def __init__(self, name='diff_rmse', **kwargs):
+        super(DiffRMSE, self).__init__(name=name, **kwargs)
+        self.squares = self.add_weight(name='squares', initializer='zeros')
+        self.count = self.add_weight(name='count', initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.cast(y_true, self.dtype)
+        y_pred = tf.cast(y_pred, self.dtype)
+        error = (y_pred[:, 1:] - y_pred[:, :-1]) - (y_true[:, 1:] - y_true[:, :-1])
+        self.squares.assign_add(K.sum(K.square(error)))
+        self.count.assign_add(tf.cast(tf.size(error), self.dtype))
+
+    def result(self):
+        return K.sqrt(tf.math.divide_no_nan(self.squares, self.count))
+
+
+def local_minmax_mask(y):
+    # interior points that are strict local maxima (y >= 0) or minima (y <= 1) of each spectrum,
+    # the points find_peaks(y, height=0) / find_peaks(1 - y, height=0) pick in test.py
+    diff = y[:, 1:] - y[:, :-1]
+    inner = y[:, 1:-1]
+    maxima = tf.logical_and(tf.logical_and(diff[:, :-1] > 0, diff[:, 1:] < 0), inner >= 0)
+    minima = tf.logical_and(tf.logical_and(diff[:, :-1] < 0, diff[:, 1:] > 0), inner <= 1)
+    return tf.logical_or(maxima, minima)
+
+
+class LocalMinMaxRMSE(Metric):
+    def __init__(self, name='local_minmax_rmse', **kwargs):
+        super(LocalMinMaxRMSE, self).__init__(name=name, **kwargs)
+        self.squares = self.add_weight(name='squares', initializer='zeros')
+        self.count = self.add_weight(name='count', initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.cast(y_true, self.dtype)
+        y_pred = tf.cast(y_pred, self.dtype)
+        mask = tf.cast(local_minmax_mask(y_true), self.dtype)
+        self.squares.assign_add(K.sum(K.square(y_pred[:, 1:-1] - y_true[:, 1:-1]) * mask))
+        self.count.assign_add(K.sum(mask))
+
+    def result(self):
+        return K.sqrt(tf.math.divide_no_nan(self.squares, self.count))
+
+
+# custom_objects for load_model
+METRIC_OBJECTS = {'R2Score': R2Score, 'DiffRMSE': DiffRMSE, 'LocalMinMaxRMSE': LocalMinMaxRMSE}
+
+
+def spectrum_metrics():
+    # fresh instances for every compile
+    return [R2Score(), DiffRMSE(), LocalMinMaxRMSE()]
+
+
+def local_minmax_array(y):
+    # the local extrema mask of test.py
+    from scipy.signal import find_peaks
+    mask_array = np.zeros(y.shape, dtype=bool)
+    for j in range(len(y)):
+        peaks_positive, _ = find_peaks(y[j], height=0)
+        peaks_negative, _ = find_peaks(1 - y[j], height=0)
+        mask_array[j, peaks_positive] = True
+        mask_array[j, peaks_negative] = True
+    return mask_array
+
+
+def compute_metrics(y_true, y_pred, mask_array=None):
+    # the numbers test.py reports, for scripts that compare models offline
+    from sklearn.metrics import mean_squared_error, r2_score
+    if mask_array is None:
+        mask_array = local_minmax_array(y_true)
+    rmse = sqrt(mean_squared_error(y_true, y_pred))
+    diff_rmse = sqrt(mean_squared_error(np.diff(y_true, axis=1), np.diff(y_pred, axis=1)))
+    return {
+        'r2': r2_score(y_true, y_pred),
+        'rmse': rmse,
+        'local_minmax_rmse': sqrt(mean_squared_error(y_true[mask_array], y_pred[mask_array])),
+        'r2_local_minmax': r2_score(y_true[mask_array], y_pred[mask_array]),
+        'diff_rmse': diff_rmse,
+        'rmse_add_diff_rmse': rmse + diff_rmse,
+    }
@@ -0,0 +1,47 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from scipy.signal import find_peaks
+
+# The spectrum plot of evaluate.py: real and predicted transmittance over the wavelengths, the local
+# extrema of the real spectrum marked. Only matplotlib, numpy and scipy, so the renderer processes
+# of a multi-sample report start light.
+
+
+def plot_sample(y_test, y_predicts, labels, colors, fontname=None):
+    x_axis = range(400, 1600, 50)
+    fig, ax = plt.subplots(1, 1, figsize=(14, 7))
+    ax.plot(x_axis, y_test, label='real', color='black')
+    for label, color, y_predict in zip(labels, colors, y_predicts):
+        ax.plot(x_axis, y_predict, label=label, color=color)
+
+    peaks_positive, _ = find_peaks(y_test, height=0)
+    peaks_negative, _ = find_peaks(1 - y_test, height=0)
+    mask = np.zeros_like(y_test, bool)
+    mask[peaks_positive] = 1
+    mask[peaks_negative] = 1
+    peak_array = mask * y_test
+    peak_array[peak_array == 0] = np.nan
+    ax.plot(x_axis, peak_array, "o", markersize=10)
+
+    ax.set_title(r'predict simulation', fontsize = 14, fontname = fontname)
+    ax.set_xlabel('wavelength', fontsize = 14, fontname = fontname)
+    ax.set_ylabel('transmittance', fontsize = 14, fontname = fontname)
+    ax.legend(loc = 'upper left', fontsize = 14)
+    # ax.legend(loc = 'lower center', fontsize = 14)
+    ax.grid(True)
+
+    # ax.set_ylim(0, 10000)
+    # ax.set_yticks(np.arange(0, 10000 + 1, 2500))
+
+    fig.tight_layout()
+    fig.set_size_inches(11,8)
+    return fig
+
+
+def render_sample(task):
+    # runs in the renderer pool (Agg, no display)
+    figure_path, y_test, y_predicts, labels, colors, fontname = task
+    fig = plot_sample(y_test, y_predicts, labels, colors, fontname)
+    fig.savefig(figure_path)
+    plt.close(fig)
+    return figure_path
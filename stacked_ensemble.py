@@ -0,0 +1,202 @@
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+from keras import activations
+
+from inference import TracedModel, load_model
+
+# N keras members of one architecture (e.g. the cnn_4l16_d0.4_noBN models of test_ensemble.py) run
+# as one model on a shared input batch:
+#   first Conv2D / Dense  one layer with the kernels of all members concatenated (N x the filters)
+#   later Conv2D          grouped convolution, member g reads and writes channels g*C:(g+1)*C;
+#                         or one convolution per member where the runtime has no grouped conv
+#   Flatten               (B, h, w, N*C) -> (N, B, h*w*C), the flatten order of each member
+#   later Dense           (N, B, F) x (N, F, U), one matmul per member in the same graph
+#   Activation, MaxPooling2D act per channel and are shared; Dropout is a no-op at inference
+# The output is (B, N, outputs), every member's prediction; TracedModel traces it like a keras model.
+
+
+def architecture(model):
+    signature = []
+    for layer in model.layers:
+        config = layer.get_config()
+        config.pop('name', None)
+        signature.append((layer.__class__.__name__, repr(sorted(config.items())),
+                          [weight.shape for weight in layer.get_weights()]))
+    return signature
+
+
+def grouped_conv_supported():
+    try:
+        tf.nn.conv2d(tf.zeros((1, 4, 4, 4)), tf.zeros((3, 3, 2, 4)), 1, 'SAME').numpy()
+        return True
+    except (tf.errors.OpError, ValueError):
+        return False
+
+
+class StackedModel:
+    def __init__(self, models, conv=None):
+        reference = models[0]
+        signature = architecture(reference)
+        for model in models[1:]:
+            if architecture(model) != signature:
+                raise ValueError('Members differ in architecture, they can not be stacked')
+        if conv is None:
+            conv = 'grouped' if grouped_conv_supported() else 'split'
+        if conv not in ['grouped', 'split']:
+            raise ValueError('Unknown conv: {} (grouped, split)'.format(conv))
+
+        self.n_members = len(models)
+        self.input_shape = reference.input_shape
+        self.conv = conv
+        self.ops = []
+        state = 'shared'
+        for index, layer in enumerate(reference.layers):
+            name = layer.__class__.__name__
+            config = layer.get_config()
+            weights = [model.layers[index].get_weights() for model in models]
+            if name in ['InputLayer', 'Dropout']:
+                continue
+            if name == 'Conv2D':
+                if state == 'batched' or tuple(config['strides']) != (1, 1) or \
+                        tuple(config['dilation_rate']) != (1, 1) or config['data_format'] == 'channels_first':
+                    raise ValueError('Only channels_last Conv2D with unit strides can be stacked')
+                kernel = np.concatenate([member[0] for member in weights], axis=-1)
+                kind = 'conv' if state == 'shared' or conv == 'grouped' else 'conv_split'
+                self.ops.append((kind, tf.constant(kernel), config['padding'].upper()))
+                if config['use_bias']:
+                    self.ops.append(('bias', tf.constant(np.concatenate([member[1] for member in weights]))))
+                state = 'channels'
+            elif name == 'Dense':
+                if state == 'channels':
+                    raise ValueError('Dense on a 4D input can not be stacked, add a Flatten')
+                if state == 'shared':
+                    kernel = np.concatenate([member[0] for member in weights], axis=-1)
+                    self.ops.append(('dense', tf.constant(kernel)))
+                    if config['use_bias']:
+                        self.ops.append(('bias', tf.constant(np.concatenate([member[1] for member in weights]))))
+                    self.ops.append(('to_members', config['units']))
+                else:
+                    self.ops.append(('batched_dense', tf.constant(np.stack([member[0] for member in weights]))))
+                    if config['use_bias']:
+                        self.ops.append(('bias', tf.constant(np.stack([member[1] for member in weights])[:, None])))
+                state = 'batched'
+            elif name == 'Activation':
+                pass
+            elif name == 'MaxPooling2D':
+                if state == 'batched':
+                    raise ValueError('MaxPooling2D after Flatten can not be stacked')
+                self.ops.append(('max_pool', config['pool_size'], config['strides'] or config['pool_size'],
+                                 config['padding'].upper()))
+            elif name == 'Flatten':
+                self.ops.append(('flatten' if state == 'channels' else 'shared_flatten',))
+                if state == 'channels':
+                    state = 'batched'
+            else:
+                raise ValueError('{} layers can not be stacked'.format(name))
+            if config.get('activation', 'linear') != 'linear':
+                self.ops.append(('activation', activations.get(config['activation'])))
+        if state != 'batched':
+            raise ValueError('The members have to end in Dense layers')
+        self.function = tf.function(self.call)
+
+    def call(self, x):
+        n = self.n_members
+        x = tf.cast(x, tf.float32)
+        batch = tf.shape(x)[0]
+        for op in self.ops:
+            kind = op[0]
+            if kind == 'conv':
+                x = tf.nn.conv2d(x, op[1], 1, op[2])
+            elif kind == 'conv_split':
+                channels = x.shape[-1] // n
+                kernel_channels = op[1].shape[-1] // n
+                x = tf.concat([tf.nn.conv2d(x[..., member * channels:(member + 1) * channels],
+                                            op[1][..., member * kernel_channels:(member + 1) * kernel_channels],
+                                            1, op[2]) for member in range(n)], axis=-1)
+            elif kind == 'bias':
+                x = x + op[1]
+            elif kind == 'activation':
+                x = op[1](x)
+            elif kind == 'max_pool':
+                x = tf.nn.max_pool2d(x, op[1], op[2], op[3])
+            elif kind == 'shared_flatten':
+                x = tf.reshape(x, [batch, -1])
+            elif kind == 'flatten':
+                # (B, h, w, N*C) -> (N, B, h*w*C): each member's channels in its own flatten order
+                shape = tf.shape(x)
+                x = tf.reshape(x, [batch, shape[1], shape[2], n, x.shape[-1] // n])
+                x = tf.reshape(tf.transpose(x, [3, 0, 1, 2, 4]), [n, batch, -1])
+            elif kind == 'dense':
+                x = tf.matmul(x, op[1])
+            elif kind == 'to_members':
+                x = tf.transpose(tf.reshape(x, [batch, n, op[1]]), [1, 0, 2])
+            elif kind == 'batched_dense':
+                # one matmul per member inside the graph: as fast as a batched matmul on large batches,
+                # and batched matmul kernels are slow for the few rows of small batches
+                x = tf.stack([tf.matmul(x[member], op[1][member]) for member in range(n)])
+        return tf.transpose(x, [1, 0, 2])
+
+    def __call__(self, x, training=False):
+        return self.function(x)
+
+    def predict(self, x, batch_size=None, verbose=0):
+        batch_size = batch_size or 32
+        return np.concatenate([self.function(np.asarray(x[start:start + batch_size], dtype=np.float32)).numpy()
+                               for start in range(0, len(x), batch_size)])
+
+
+def load_stacked(model_paths, conv=None):
+    return StackedModel([load_model(model_path) for model_path in model_paths], conv)
+
+
+def weighted_mean(member_predictions, weights=None):
+    # (B, N, outputs) -> (B, outputs)
+    if weights is None:
+        return member_predictions.mean(axis=1)
+    weights = np.asarray(weights, dtype=member_predictions.dtype)
+    return np.tensordot(member_predictions, weights, axes=([1], [0])) / weights.sum()
+
+
+def throughput(model, x, repeats=3):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.time()
+        model.predict(x)
+        timings.append(time.time() - start_time)
+    return len(x) / min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--members", help="Keras members of one architecture (path without .json/.h5)",
+                        nargs='+', required=True)
+    parser.add_argument("-n", "--samples", help="Random input samples of the benchmark", default=1024)
+    parser.add_argument("-b", "--batch_size", help="Batch size", default=256)
+    parser.add_argument("--conv", help="Convolutions after the first (grouped, split; default: grouped when "
+                                       "the runtime supports it)", default=None)
+
+    args = parser.parse_args()
+    batch_size = int(args.batch_size)
+    members = [load_model(member_path) for member_path in args.members]
+    stacked = StackedModel(members, args.conv)
+    print('Stacked {} members, convolutions: {}'.format(stacked.n_members, stacked.conv))
+
+    x = np.random.RandomState(0).rand(int(args.samples), *members[0].input_shape[1:]).astype(np.float32)
+    traced_members = [TracedModel(member, [batch_size]) for member in members]
+    traced_stacked = TracedModel(stacked, [batch_size])
+
+    separate = np.stack([member.predict(x) for member in traced_members], axis=1)
+    together = traced_stacked.predict(x)
+    print('max |stacked - separate|: {:.3g}'.format(float(np.abs(separate - together).max())))
+
+    member_throughputs = [throughput(member, x) for member in traced_members]
+    single_throughput = member_throughputs[0]
+    separate_throughput = 1 / sum(1 / member_throughput for member_throughput in member_throughputs)
+    stacked_throughput = throughput(traced_stacked, x)
+    print('{:<28}{:>14}'.format('', 'samples/s'))
+    print('{:<28}{:>14.1f}'.format('one member', single_throughput))
+    print('{:<28}{:>14.1f}'.format('{} members, one by one'.format(stacked.n_members), separate_throughput))
+    print('{:<28}{:>14.1f}'.format('{} members, stacked'.format(stacked.n_members), stacked_throughput))
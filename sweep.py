@@ -0,0 +1,242 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import time
+from math import sqrt
+
+import numpy as np
+import pandas as pd
+
+from train import DATAPATH_TRAIN, DATASETS_TRAIN, DATAPATH_VALID, DATASETS_VALID
+from train import load_dataset, share_array, transform_images, image_shape, reshape_input
+
+# Example spec (json):
+# {
+#     "search": "grid",          # or "random" together with "num_trials"
+#     "num_trials": 20,
+#     "seed": 0,
+#     "params": {
+#         "model": ["cnn"],
+#         "loss_function": ["rmse", "rmse,diff_rmse", "rmse,diff_bce", "rmse,diff_rmse_minmax"],
+#         "batch_size": [64, 128],
+#         "epochs": [100]
+#     }
+# }
+DEFAULT_PARAMS = {
+    'model': 'cnn',
+    'loss_function': 'rmse',
+    'batch_size': 128,
+    'epochs': 300,
+}
+
+
+def expand_spec(spec):
+    params = dict((key, value if isinstance(value, list) else [value]) for key, value in spec['params'].items())
+    for key in params:
+        if key not in DEFAULT_PARAMS:
+            raise ValueError('Unknown sweep parameter: {}'.format(key))
+
+    keys = sorted(params.keys())
+    grid = [dict(zip(keys, values)) for values in itertools.product(*[params[key] for key in keys])]
+
+    search = spec.get('search', 'grid')
+    if search == 'random':
+        rng = random.Random(spec.get('seed', 0))
+        num_trials = min(int(spec.get('num_trials', len(grid))), len(grid))
+        grid = rng.sample(grid, num_trials)
+    elif search != 'grid':
+        raise ValueError('Unknown search type: {}'.format(search))
+
+    trials = []
+    for trial_id, values in enumerate(grid):
+        trial_params = dict(DEFAULT_PARAMS)
+        trial_params.update(values)
+        trials.append({'id': trial_id, 'params': trial_params})
+    return trials
+
+
+def limit_threads(threads):
+    # BLAS pools read these when the worker starts, TF before its runtime is initialized
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[name] = str(threads)
+
+
+def limit_tf_threads(threads):
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def make_median_stopping(trial_id, progress, grace_epochs, min_trials, monitor='val_r2'):
+    from keras.callbacks import Callback
+    # val_loss sums each trial's own loss terms, so trials with different loss functions are only
+    # comparable on a metric of spectrum_metrics(); r2 is stored negated to keep lower as better
+    sign = -1 if monitor.endswith('r2') else 1
+
+    class MedianStopping(Callback):
+        # stop when the best value so far is worse than the median of the
+        # other trials' best values at the same epoch
+        def __init__(self):
+            super(MedianStopping, self).__init__()
+            self.stopped_epoch = 0
+
+        def on_epoch_end(self, epoch, logs=None):
+            value = (logs or {}).get(monitor)
+            if value is None:
+                return
+            history = list(progress.get(trial_id, [])) + [sign * float(value)]
+            progress[trial_id] = history
+            if epoch + 1 < grace_epochs:
+                return
+
+            others = [min(h[:epoch + 1]) for key, h in progress.items() if key != trial_id and len(h) > epoch]
+            if len(others) >= min_trials and min(history) > statistics.median(others):
+                print('Trial {}: early terminated at epoch {}'.format(trial_id, epoch + 1))
+                self.stopped_epoch = epoch + 1
+                self.model.stop_training = True
+
+    return MedianStopping()
+
+
+def run_trial(trial, data_paths, input_shape_type, threads, progress, grace_epochs, min_trials, model_folder):
+    limit_tf_threads(threads)
+    from sklearn.externals import joblib
+    from sklearn.metrics import mean_squared_error, r2_score
+    from train import CustomLoss, create_model
+
+    params = trial['params']
+    model_name = params['model']
+    batch_size = int(params['batch_size'])
+    epochs = int(params['epochs'])
+    result = {'id': trial['id'], 'status': 'completed', 'epochs_run': 0, 'best_val_loss': np.nan}
+    result.update(params)
+
+    start_time = time.time()
+    try:
+        img_rows, img_cols, channels = image_shape(model_name, input_shape_type)
+        x_train = transform_images(np.load(data_paths['x_train'], mmap_mode='r'), model_name, input_shape_type)
+        x_validation = transform_images(np.load(data_paths['x_validation'], mmap_mode='r'), model_name,
+                                        input_shape_type)
+        y_train = np.load(data_paths['y_train'], mmap_mode='r')
+        y_validation = np.load(data_paths['y_validation'], mmap_mode='r')
+        x_train, input_shape = reshape_input(x_train, model_name, img_rows, img_cols, channels)
+        x_validation, _ = reshape_input(x_validation, model_name, img_rows, img_cols, channels)
+
+        custom_loss = CustomLoss(params['loss_function'])
+        model = create_model(model_name, input_shape, custom_loss.custom_loss, n_jobs=threads)
+
+        if model_name.startswith('cnn') or model_name.startswith('nn'):
+            median_stopping = make_median_stopping(trial['id'], progress, grace_epochs, min_trials)
+            history = model.fit(x_train, y_train,
+                                batch_size=batch_size,
+                                epochs=epochs,
+                                verbose=0,
+                                validation_data=(x_validation, y_validation),
+                                callbacks=[median_stopping])
+            result['epochs_run'] = len(history.history['loss'])
+            result['best_val_loss'] = float(np.min(history.history['val_loss']))
+            if median_stopping.stopped_epoch > 0:
+                result['status'] = 'stopped'
+        else:
+            model.fit(x_train, y_train)
+
+        y_predict = model.predict(x_validation)
+        result['val_rmse'] = sqrt(mean_squared_error(y_validation, y_predict))
+        result['val_r2'] = r2_score(y_validation, y_predict)
+
+        if model_folder is not None:
+            model_export_path = os.path.join(model_folder, 'trial_{}'.format(trial['id']))
+            if model_name.startswith('cnn') or model_name.startswith('nn'):
+                with open(model_export_path + '.json', 'w') as json_file:
+                    json_file.write(model.to_json())
+                model.save_weights(model_export_path + '.h5')
+            else:
+                joblib.dump(model, model_export_path + '.joblib')
+    except Exception as e:
+        print('Trial {} failed: {}'.format(trial['id'], e))
+        result['status'] = 'failed'
+        result['error'] = str(e)
+        result['val_rmse'] = np.nan
+        result['val_r2'] = np.nan
+
+    result['train_time'] = time.time() - start_time
+    print('Trial {} {}: {} val_rmse={:.4f} ({:.1f}s)'.format(trial['id'], result['status'], params,
+                                                             result['val_rmse'], result['train_time']))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", help="Sweep spec (json) with grid or random search params.")
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-w", "--workers", help="Number of concurrent trials.", default=None)
+    parser.add_argument("-t", "--threads_per_trial", help="Thread budget of a single trial.", default=1)
+    parser.add_argument("-g", "--grace_epochs", help="Epochs before a trial can be terminated early.", default=10)
+    parser.add_argument("--min_trials", help="Trials needed at an epoch to compare against the median.",
+                        default=3)
+    parser.add_argument("--no_early_termination", help="Run every trial to the end.", action='store_true')
+    parser.add_argument("--cache_dir", help="Where the shared dataset arrays are written.", default=None)
+    parser.add_argument("--save_models", help="Keep the model of every trial.", action='store_true')
+
+    args = parser.parse_args()
+    with open(args.spec) as spec_file:
+        spec = json.load(spec_file)
+    sweep_name = os.path.splitext(os.path.basename(args.spec))[0]
+    trials = expand_spec(spec)
+    threads = int(args.threads_per_trial)
+    workers = int(args.workers) if args.workers else max(1, (os.cpu_count() or 1) // threads)
+    grace_epochs = int(args.grace_epochs)
+    min_trials = 10 ** 9 if args.no_early_termination else int(args.min_trials)
+
+    cache_dir = args.cache_dir
+    if cache_dir is None:
+        cache_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    cache_dir = tempfile.mkdtemp(prefix='sweep_{}_'.format(sweep_name), dir=cache_dir)
+
+    # load once at full resolution, every trial derives its own input from the shared arrays
+    print('Data Loading... Start.')
+    x_train, y_train = load_dataset(DATAPATH_TRAIN, DATASETS_TRAIN, 'cnn', 'rect')
+    x_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, 'cnn', 'rect')
+    data_paths = dict()
+    for key, array in [('x_train', x_train), ('y_train', y_train),
+                       ('x_validation', x_validation), ('y_validation', y_validation)]:
+        data_paths[key] = os.path.join(cache_dir, '{}.npy'.format(key))
+        share_array(array, data_paths[key])
+    del x_train, y_train, x_validation, y_validation
+    print('Data Loading... Finished.')
+
+    model_folder = None
+    if args.save_models:
+        model_folder = 'models/sweep_{}'.format(sweep_name)
+        if not os.path.exists(model_folder):
+            os.makedirs(model_folder)
+
+    print('{} trials on {} workers x {} threads'.format(len(trials), workers, threads))
+    limit_threads(threads)
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    progress = manager.dict()
+    try:
+        # one process per trial, so every trial starts with a clean TF session
+        with context.Pool(workers, maxtasksperchild=1) as pool:
+            results = pool.starmap(run_trial, [(trial, data_paths, args.shape, threads, progress, grace_epochs,
+                                                min_trials, model_folder) for trial in trials], chunksize=1)
+    finally:
+        manager.shutdown()
+        for path in data_paths.values():
+            os.remove(path)
+        os.rmdir(cache_dir)
+
+    leaderboard = pd.DataFrame(results).sort_values('val_rmse', na_position='last')
+    leaderboard_folder = 'result/sweep'
+    if not os.path.exists(leaderboard_folder):
+        os.makedirs(leaderboard_folder)
+    leaderboard_path = '{}/{}_leaderboard.csv'.format(leaderboard_folder, sweep_name)
+    leaderboard.to_csv(leaderboard_path, index=False)
+    print(leaderboard.to_string(index=False))
+    print('Saved leaderboard to {}'.format(leaderboard_path))
@@ -11,6 +11,8 @@ from sklearn.metrics import mean_squared_error, r2_score
 from scipy.signal import find_peaks
 import numpy as np
 import matplotlib.pyplot as plt
+from forest_export import forest_path, load_forest
+from inference import apply_profile, load_profile, predict, trace_model
 
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
@@ -124,6 +126,10 @@ def rescale(arr, std, mean):
 
 # PARAMETERS
 MODEL_SHAPE_TYPE = 'rect'
+# autotuned profile of each model on this host (inference.py autotune): 'latency', 'throughput' or None
+INFERENCE_PROFILE = 'throughput'
+# keras models are traced and warmed up for these batch sizes (and the predict batch size) before timing, [] to skip
+TRACE_BATCH_SIZES = [1]
 ## TRAIN
 # DATAPATH = os.path.join('data', 'train')
 # DATASETS = [
@@ -349,7 +355,10 @@ for i, model_name_detail in enumerate(model_name_details):
         parsed_model_name = model_name_detail.split('/')[0] + '_' + model_name_detail.split('/')[1]
         MODEL_JSON_PATH = '{}/{}.json'.format(model_folder_path, model_name_detail)
         MODEL_H5_PATH = '{}/{}.h5'.format(model_folder_path, model_name_detail)
+        # thread settings have to be in place before the model is built
+        predict_args = apply_profile(load_profile(MODEL_JSON_PATH, INFERENCE_PROFILE))
         # load json and create model
+        tic()
         json_file = open(MODEL_JSON_PATH, 'r')
         loaded_model_json = json_file.read()
         json_file.close()
@@ -357,21 +366,31 @@ for i, model_name_detail in enumerate(model_name_details):
         # load weights into new model
         loaded_model.load_weights(MODEL_H5_PATH)
         print("Loaded model from disk")
+        loadTime = toc()
+        if TRACE_BATCH_SIZES:
+            # tracing and first-call allocation stay out of the timed predict
+            loaded_model = trace_model(loaded_model, TRACE_BATCH_SIZES + [predict_args.get('batch_size', 32)])
 
         if model_name_detail.startswith('cnn'):
             tic()
-            y_predict = loaded_model.predict(x_test)
+            y_predict = predict(loaded_model, x_test, **predict_args)
         else:
             x_test_nn = x_test.reshape(x_test.shape[0], img_rows * img_cols * channels)
             tic()
-            y_predict = loaded_model.predict(x_test_nn)
+            y_predict = predict(loaded_model, x_test_nn, **predict_args)
         runningTime = toc()
+        print('load {:.3f}s, steady-state predict {:.3f}s'.format(loadTime, runningTime))
 
     else:
         MODEL_PATH = '{}/{}/{}.joblib'.format(model_folder_path, model_name, model_name_detail)
-        loaded_model = joblib.load(MODEL_PATH)
+        predict_args = apply_profile(load_profile(MODEL_PATH, INFERENCE_PROFILE), keras_model=False)
+        # prefer the compiled, memory-mapped export of tree models (forest_export.py)
+        if os.path.isdir(forest_path(MODEL_PATH)):
+            loaded_model = load_forest(forest_path(MODEL_PATH))
+        else:
+            loaded_model = joblib.load(MODEL_PATH)
         tic()
-        y_predict = loaded_model.predict(x_test_compressed)
+        y_predict = predict(loaded_model, x_test_compressed, **predict_args)
         runningTime = toc()
         # corr = np.corrcoef(y_test_compressed, y_predict)[0, 1]
         # rmse = root_mean_squared_error(y_test_compressed, y_predict)
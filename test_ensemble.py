@@ -11,7 +11,11 @@ from sklearn.metrics import mean_squared_error, r2_score
 from scipy.signal import find_peaks
 import numpy as np
 import matplotlib.pyplot as plt
+from forest_export import forest_path, load_forest
+from inference import apply_profile, load_profile, predict, trace_model
+from stacked_ensemble import load_stacked
 
+import json
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
@@ -124,6 +128,15 @@ def rescale(arr, std, mean):
 
 # PARAMETERS
 MODEL_SHAPE_TYPE = 'rect'
+# autotuned profile of each model on this host (inference.py autotune): 'latency', 'throughput' or None
+INFERENCE_PROFILE = 'throughput'
+# keras models are traced and warmed up for these batch sizes (and the predict batch size) before timing, [] to skip
+TRACE_BATCH_SIZES = [1]
+# ensemble config of ensemble_select.py: its members and weights replace model_name_details, None for the equal mean
+ENSEMBLE_CONFIG = None
+# True: cnn members of one architecture run as one stacked model (stacked_ensemble.py) under the profile of the
+# first member, the running time is then reported once for the stack; False: one model at a time
+STACK_MEMBERS = False
 DATAPATH = './data/train'
 
 
@@ -222,6 +235,15 @@ colors=[
 model_folder_path = 'models_paper'
 is_mean_std = False
 
+model_weights = [1.0] * len(model_name_details)
+if ENSEMBLE_CONFIG:
+    with open(ENSEMBLE_CONFIG) as config_file:
+        ensemble_config = json.load(config_file)
+    model_folder_path = ensemble_config['model_folder_path']
+    model_name_details = [member['detail'] for member in ensemble_config['members']]
+    model_weights = [member['weight'] for member in ensemble_config['members']]
+    print('Ensemble from {}: {}'.format(ENSEMBLE_CONFIG, list(zip(model_name_details, model_weights))))
+
 if MODEL_SHAPE_TYPE == 'rect':
     img_rows, img_cols, channels = 100, 200, 1
 else:
@@ -325,15 +347,41 @@ rmse_for_boxplot = dict()
 rmse_local_for_boxplot = dict()
 result_y_predict = []
 result_list = []
+
+stacked_y_predict = None
+if STACK_MEMBERS and len(model_name_details) > 1 and all(detail.startswith('cnn') for detail in model_name_details):
+    member_paths = ['{}/{}'.format(model_folder_path, detail) for detail in model_name_details]
+    predict_args = apply_profile(load_profile(member_paths[0] + '.json', INFERENCE_PROFILE))
+    try:
+        tic()
+        stacked_model = load_stacked(member_paths)
+        loadTime = toc()
+    except ValueError as e:
+        print('Members run one at a time: {}'.format(e))
+    else:
+        if TRACE_BATCH_SIZES:
+            stacked_model = trace_model(stacked_model, TRACE_BATCH_SIZES + [predict_args.get('batch_size', 32)])
+        tic()
+        stacked_y_predict = predict(stacked_model, x_test, **predict_args)
+        stackedRunningTime = toc()
+        print('{} stacked members: load {:.3f}s, steady-state predict {:.3f}s'.format(
+            len(member_paths), loadTime, stackedRunningTime))
+
 for i, model_name_detail in enumerate(model_name_details):
     print(model_name_detail)
     parsed_model_name = model_name_detail.split('/')[0]
     runningTime = 0
-    if model_name_detail.startswith('cnn') or model_name_detail.startswith('nn'):
+    if stacked_y_predict is not None:
+        parsed_model_name = model_name_detail.split('/')[0] + '_' + model_name_detail.split('/')[1]
+        y_predict = stacked_y_predict[:, i]
+    elif model_name_detail.startswith('cnn') or model_name_detail.startswith('nn'):
         parsed_model_name = model_name_detail.split('/')[0] + '_' + model_name_detail.split('/')[1]
         MODEL_JSON_PATH = '{}/{}.json'.format(model_folder_path, model_name_detail)
         MODEL_H5_PATH = '{}/{}.h5'.format(model_folder_path, model_name_detail)
+        # thread settings have to be in place before the model is built
+        predict_args = apply_profile(load_profile(MODEL_JSON_PATH, INFERENCE_PROFILE))
         # load json and create model
+        tic()
         json_file = open(MODEL_JSON_PATH, 'r')
         loaded_model_json = json_file.read()
         json_file.close()
@@ -341,21 +389,31 @@ for i, model_name_detail in enumerate(model_name_details):
         # load weights into new model
         loaded_model.load_weights(MODEL_H5_PATH)
         print("Loaded model from disk")
+        loadTime = toc()
+        if TRACE_BATCH_SIZES:
+            # tracing and first-call allocation stay out of the timed predict
+            loaded_model = trace_model(loaded_model, TRACE_BATCH_SIZES + [predict_args.get('batch_size', 32)])
 
         if model_name_detail.startswith('cnn'):
             tic()
-            y_predict = loaded_model.predict(x_test)
+            y_predict = predict(loaded_model, x_test, **predict_args)
         else:
             x_test_nn = x_test.reshape(x_test.shape[0], img_rows * img_cols * channels)
             tic()
-            y_predict = loaded_model.predict(x_test_nn)
+            y_predict = predict(loaded_model, x_test_nn, **predict_args)
         runningTime = toc()
+        print('load {:.3f}s, steady-state predict {:.3f}s'.format(loadTime, runningTime))
 
     else:
         MODEL_PATH = '{}/{}/{}.joblib'.format(model_folder_path, model_name, model_name_detail)
-        loaded_model = joblib.load(MODEL_PATH)
+        predict_args = apply_profile(load_profile(MODEL_PATH, INFERENCE_PROFILE), keras_model=False)
+        # prefer the compiled, memory-mapped export of tree models (forest_export.py)
+        if os.path.isdir(forest_path(MODEL_PATH)):
+            loaded_model = load_forest(forest_path(MODEL_PATH))
+        else:
+            loaded_model = joblib.load(MODEL_PATH)
         tic()
-        y_predict = loaded_model.predict(x_test_compressed)
+        y_predict = predict(loaded_model, x_test_compressed, **predict_args)
         runningTime = toc()
         # corr = np.corrcoef(y_test_compressed, y_predict)[0, 1]
         # rmse = root_mean_squared_error(y_test_compressed, y_predict)
@@ -366,11 +424,11 @@ for i, model_name_detail in enumerate(model_name_details):
         y_predict = rescale(y_predict, MEAN, STD)
 
     if len(result_y_predict) == 0:
-        result_y_predict = y_predict
+        result_y_predict = model_weights[i] * y_predict
     else:
-        result_y_predict = result_y_predict + y_predict
+        result_y_predict = result_y_predict + model_weights[i] * y_predict
 
-result_y_predict = result_y_predict / len(model_name_details)
+result_y_predict = result_y_predict / sum(model_weights)
 
 print(result_y_predict)
 y_predict = result_y_predict
@@ -399,7 +457,11 @@ result_rmse2[parsed_model_name] = rmse2
 result_r2[parsed_model_name] = r2
 result_r2_local_minmax[parsed_model_name] = r2_local_minmax
 result_rmse[parsed_model_name] = rmse
-result_runningTime[parsed_model_name] = runningTime
+if stacked_y_predict is not None:
+    # one predict for all members
+    result_runningTime['stacked_{}_members'.format(len(model_name_details))] = stackedRunningTime
+else:
+    result_runningTime[parsed_model_name] = runningTime
 
 y_test_diff = tf_diff_axis_1(y_test)
 y_predict_diff = tf_diff_axis_1(y_predict)
@@ -3,6 +3,8 @@ from keras.models import Sequential
 from keras.layers import Dense, Dropout, Flatten
 from keras.layers import Conv2D, MaxPooling2D, Activation
 from keras.optimizers import Adam
+from keras.callbacks import Callback, EarlyStopping
+from keras.models import load_model, model_from_json
 import matplotlib.pyplot as plt
 from keras import backend as K
 import tensorflow as tf
@@ -10,27 +12,54 @@ from keras import losses
 from PIL import Image
 import numpy as np
 import argparse
+import hashlib
+import json
 import os
+import time
 from sklearn.multioutput import MultiOutputRegressor
 from sklearn.linear_model import LinearRegression, Lasso, Ridge, ElasticNet
 from sklearn.neural_network import MLPRegressor
 from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor, GradientBoostingRegressor, AdaBoostRegressor
-from sklearn.svm import SVR
 from sklearn.externals import joblib
-from sklearn.neighbors import KNeighborsRegressor
 from sklearn.tree import DecisionTreeRegressor
+from hist_gbr import HistGradientBoostingMultiRegressor
+from forest_export import compile_forest, forest_path
+import linear_stream
+from linear_stream import LINEAR_MODELS
+from kernel_approx import KernelApproximationRegressor
+from hamming_index import HammingKNeighborsRegressor
+from spectrum_metrics import spectrum_metrics, METRIC_OBJECTS
+
+
+LOSS_TERMS = ['mse', 'diff_mse', 'rmse', 'diff_rmse', 'diff_ce', 'diff_bce', 'diff_rmse_minmax', 'diff_poly']
 
 
 class CustomLoss:
-    def __init__(self, _loss_function):
+    def __init__(self, _loss_function, n_outputs=24, poly_degree=3, diff_bce_sharpness=50.):
         super(CustomLoss, self).__init__()
+        self.diff_bce_sharpness = diff_bce_sharpness
         self.loss_function_array = _loss_function.split(',')
+        unknown = [name for name in self.loss_function_array if name not in LOSS_TERMS]
+        if unknown:
+            raise ValueError('Unknown loss function: {}'.format(', '.join(unknown)))
+        # the loss is assembled from the requested terms only, and the intermediates
+        # shared by several terms are computed once per step
+        self.terms = [name for name in LOSS_TERMS if name in self.loss_function_array]
+        self.use_error = any(name in ['mse', 'rmse'] for name in self.terms)
+        self.use_diff = any(name in ['diff_mse', 'diff_rmse', 'diff_ce', 'diff_bce'] for name in self.terms)
+        self.use_diff_error = any(name in ['diff_mse', 'diff_rmse'] for name in self.terms)
+
+        # polyval(polyfit(x, y, 3), x) is linear in y: y P with P = (V pinv(V))' for the Vandermonde
+        # matrix V of the wavelengths. x in [-1, 1] spans the same polynomials as arange(24) but
+        # keeps V well conditioned
+        vandermonde = np.vander(np.linspace(-1, 1, n_outputs), poly_degree + 1)
+        self.poly_projection = (vandermonde @ np.linalg.pinv(vandermonde)).T.astype(np.float32)
 
     def tf_diff_axis_1(self, a):
         return a[:, 1:] - a[:, :-1]
 
-    def tf_minmax_axis_1(self, a):
-        b = self.tf_diff_axis_1(a)
+    def tf_minmax_axis_1(self, a, a_diff=None):
+        b = self.tf_diff_axis_1(a) if a_diff is None else a_diff
         sign = K.sign(b)
         abs_sign = tf.abs(self.tf_diff_axis_1(sign))
         mask_array = K.greater(abs_sign, 0)
@@ -41,43 +70,115 @@ class CustomLoss:
 
     def custom_loss(self, y_true, y_pred):
         loss = 0
-        y_true_diff = self.tf_diff_axis_1(y_true)
-        y_pred_diff = self.tf_diff_axis_1(y_pred)
-        threshold_value = 0
-        y_true_diff_binary = K.cast(K.greater(y_true_diff, threshold_value), K.floatx())
-        y_pred_diff_binary = K.cast(K.greater(y_pred_diff, threshold_value), K.floatx())
-        y_true_minmax = self.tf_minmax_axis_1(y_true)
-        y_pred_minmax = self.tf_minmax_axis_1(y_pred)
+        if self.use_error:
+            mean_squared_error = K.mean(K.square(y_pred - y_true))
+        if self.use_diff:
+            y_true_diff = self.tf_diff_axis_1(y_true)
+            y_pred_diff = self.tf_diff_axis_1(y_pred)
+        if self.use_diff_error:
+            diff_mean_squared_error = K.mean(K.square(y_pred_diff - y_true_diff))
 
-        if 'mse' in self.loss_function_array:
-            loss = loss + K.mean(K.square(y_pred - y_true))
+        if 'mse' in self.terms:
+            loss = loss + mean_squared_error
 
-        if 'diff_mse' in self.loss_function_array:
-            loss = loss + K.mean(K.square(y_pred_diff - y_true_diff))
+        if 'diff_mse' in self.terms:
+            loss = loss + diff_mean_squared_error
 
-        if 'rmse' in self.loss_function_array:
-            loss = loss + K.sqrt(K.mean(K.square(y_pred - y_true)))
+        if 'rmse' in self.terms:
+            loss = loss + K.sqrt(mean_squared_error)
 
-        if 'diff_rmse' in self.loss_function_array:
-            loss = loss + K.sqrt(K.mean(K.square(y_pred_diff - y_true_diff)))
+        if 'diff_rmse' in self.terms:
+            loss = loss + K.sqrt(diff_mean_squared_error)
 
-        if 'diff_ce' in self.loss_function_array:
+        if 'diff_ce' in self.terms:
             loss = loss + losses.binary_crossentropy(y_true_diff, y_pred_diff)
 
-        if 'diff_bce' in self.loss_function_array:
-            loss = loss + losses.binary_crossentropy(y_true_diff_binary, y_pred_diff_binary)
-
-        if 'diff_rmse_minmax' in self.loss_function_array:
+        if 'diff_bce' in self.terms:
+            # rising / falling of the true spectrum against a smooth step of the predicted differences;
+            # the hard step (K.greater) of the prediction has no gradient
+            threshold_value = 0
+            y_true_diff_binary = K.cast(K.greater(y_true_diff, threshold_value), K.floatx())
+            y_pred_diff_step = K.sigmoid(self.diff_bce_sharpness * (y_pred_diff - threshold_value))
+            loss = loss + K.mean(losses.binary_crossentropy(y_true_diff_binary, y_pred_diff_step))
+
+        if 'diff_rmse_minmax' in self.terms:
+            y_true_minmax = self.tf_minmax_axis_1(y_true, y_true_diff if self.use_diff else None)
+            y_pred_minmax = self.tf_minmax_axis_1(y_pred, y_pred_diff if self.use_diff else None)
             loss = loss + K.sqrt(K.mean(K.square(y_pred_minmax - y_true_minmax)))
 
-        if 'diff_poly' in self.loss_function_array:
-            x = np.arange(24)
-            loss = loss + np.sum(
-                (np.polyval(np.polyfit(x, y_pred, 3)) - np.polyval(np.polyfit(x, y_true, 3))) ** 2
-            )
+        if 'diff_poly' in self.terms:
+            # squared distance between the cubic fits of both spectra, summed over the wavelengths
+            poly_error = tf.matmul(y_pred - y_true, tf.constant(self.poly_projection))
+            loss = loss + K.mean(K.sum(K.square(poly_error), axis=-1))
 
         return loss
 
+class TrainingCheckpoint(Callback):
+    # keeps the full model (weights + optimizer state) of the latest epoch, the history so far and the
+    # state of early_stopping (wait, best value and weights), so a killed job can resume where it stopped.
+    # Goes after early_stopping in the callbacks: it restores the state once early_stopping has reset
+    # itself and saves it once early_stopping has seen the epoch.
+    def __init__(self, checkpoint_path, period, initial_history=None, early_stopping=None,
+                 early_stopping_state=None):
+        super(TrainingCheckpoint, self).__init__()
+        self.checkpoint_path = checkpoint_path
+        self.period = period
+        self.history = dict(initial_history or {})
+        self.early_stopping = early_stopping
+        self.early_stopping_state = early_stopping_state
+        self.last_epoch = None
+        self.saved_epoch = None
+
+    def on_train_begin(self, logs=None):
+        if self.early_stopping is None or not self.early_stopping_state:
+            return
+        self.early_stopping.wait = self.early_stopping_state['wait']
+        self.early_stopping.best = self.early_stopping_state['best']
+        if self.early_stopping.restore_best_weights and os.path.exists(self.checkpoint_path + '.best.npz'):
+            with np.load(self.checkpoint_path + '.best.npz') as best_weights:
+                self.early_stopping.best_weights = [best_weights['arr_{}'.format(i)]
+                                                    for i in range(len(best_weights.files))]
+
+    def on_epoch_end(self, epoch, logs=None):
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(value))
+        # with --validation_freq the val_ entries only exist for some epochs
+        if 'val_loss' in (logs or {}):
+            self.history.setdefault('val_epoch', []).append(epoch)
+        self.last_epoch = epoch + 1
+        if self.period > 0 and (epoch + 1) % self.period == 0:
+            self.save(epoch + 1)
+
+    def on_train_end(self, logs=None):
+        # the last (or early stopped) epoch, unless the period already saved it
+        if self.period > 0 and self.last_epoch is not None and self.last_epoch != self.saved_epoch:
+            self.save(self.last_epoch)
+
+    def save(self, epoch):
+        # write to temporary files first so a kill during saving keeps the previous checkpoint
+        self.model.save(self.checkpoint_path + '.tmp.h5')
+        state = {'epoch': epoch, 'history': self.history}
+        if self.early_stopping is not None:
+            state['early_stopping'] = {'wait': int(self.early_stopping.wait), 'best': float(self.early_stopping.best)}
+            if self.early_stopping.best_weights is not None:
+                np.savez(self.checkpoint_path + '.tmp.best.npz', *self.early_stopping.best_weights)
+                os.replace(self.checkpoint_path + '.tmp.best.npz', self.checkpoint_path + '.best.npz')
+        with open(self.checkpoint_path + '.tmp.json', 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(self.checkpoint_path + '.tmp.h5', self.checkpoint_path + '.h5')
+        os.replace(self.checkpoint_path + '.tmp.json', self.checkpoint_path + '.json')
+        self.saved_epoch = epoch
+
+
+def load_checkpoint(checkpoint_path, custom_objects):
+    if not os.path.exists(checkpoint_path + '.json'):
+        return None, 0, {}, None
+    with open(checkpoint_path + '.json') as state_file:
+        state = json.load(state_file)
+    model = load_model(checkpoint_path + '.h5', custom_objects=custom_objects)
+    return model, state['epoch'], state['history'], state.get('early_stopping')
+
+
 def tic():
     import time
     global startTime_for_tictoc
@@ -118,7 +219,264 @@ def compress_image(prev_image, n):
     return new_image
 
 
-def create_model(model_type, model_input_shape, loss_function):
+def transform_images(images, model_name, input_shape_type):
+    # works on a single image or on a stacked (N, rows, cols) array
+    if model_name.startswith('cnn') is False and model_name.startswith('nn') is False:
+        images = np.ascontiguousarray(images[..., ::10, ::10])
+
+    if model_name.startswith('cnn_small'):
+        images = np.ascontiguousarray(images[..., ::5, ::5])
+
+    if input_shape_type.startswith('rect') is False:
+        v_flipped_images = np.flip(images, -2)
+        images = np.concatenate([images, v_flipped_images], axis=-2)
+    return images
+
+
+def image_shape(model_name, input_shape_type):
+    if input_shape_type.startswith('rect'):
+        img_rows, img_cols, channels = 100, 200, 1
+    else:
+        img_rows, img_cols, channels = 200, 200, 1
+
+    if model_name.startswith('cnn') is False and model_name.startswith('nn') is False:
+        img_rows = img_rows // 10
+        img_cols = img_cols // 10
+
+    if model_name.startswith('cnn_small'):
+        img_rows = img_rows // 5
+        img_cols = img_cols // 5
+    return img_rows, img_cols, channels
+
+
+def load_image(datapath, data, file, idx):
+    # returns the image and the id of the file it was read from
+    try:
+        file_id = int(file)
+        image = Image.open(os.path.join(datapath, data, '{}.tiff'.format(file_id)))
+        image = np.array(image, dtype=np.uint8)
+    except (TypeError, ValueError, FileNotFoundError) as te:
+        file_id = idx + 1
+        image = Image.open(os.path.join(datapath, data, '{}.tiff'.format(file_id)))
+        try:
+            image = np.array(image, dtype=np.uint8)
+        except:
+            return None, file_id
+    return image, file_id
+
+
+def file_row(file_names, file_id):
+    # the csv row load_image reads <file_id>.tiff for: the file name column, row idx + 1 for cells
+    # that are not a number
+    for idx, file in enumerate(file_names):
+        try:
+            if int(file) == file_id:
+                return idx
+        except (TypeError, ValueError):
+            if idx + 1 == file_id:
+                return idx
+    return file_id - 1
+
+
+def load_dataset(datapath, datasets, model_name, input_shape_type, max_samples=None, seed=0, return_ids=False):
+    rows = []
+    for data in datasets:
+        dataframe = pd.read_csv(os.path.join(datapath, '{}.csv'.format(data)), delim_whitespace=False, header=None)
+        dataset = dataframe.values
+
+        # split into input (X) and output (Y) variables
+        fileNames = dataset[:, 0]
+        for idx, file in enumerate(fileNames):
+            rows.append((data, idx, file, dataset[idx, 1:25]))
+
+    # pick the rows before decoding, so a small sample of a large corpus stays cheap
+    if max_samples is not None and max_samples < len(rows):
+        selected = np.sort(np.random.RandomState(seed).choice(len(rows), max_samples, replace=False))
+        rows = [rows[i] for i in selected]
+
+    x = []
+    y = []
+    ids = []
+    for data, idx, file, label in rows:
+        image, file_id = load_image(datapath, data, file, idx)
+        if image is None:
+            continue
+        x.append(transform_images(image, model_name, input_shape_type))
+        y.append(label)
+        ids.append((data, file_id))
+
+    x = np.array(x)
+    y = np.array(y, dtype=np.float64)
+    y = np.true_divide(y, 2767.1)
+    if return_ids:
+        return x, y, ids
+    return x, y
+
+
+def count_samples(datapath, datasets):
+    return sum(len(pd.read_csv(os.path.join(datapath, '{}.csv'.format(data)), delim_whitespace=False, header=None))
+               for data in datasets)
+
+
+def iter_dataset(datapath, datasets, model_name, input_shape_type, chunk_size, return_ids=False):
+    x = []
+    y = []
+    ids = []
+    for data in datasets:
+        dataframe = pd.read_csv(os.path.join(datapath, '{}.csv'.format(data)), delim_whitespace=False, header=None)
+        dataset = dataframe.values
+        fileNames = dataset[:, 0]
+        for idx, file in enumerate(fileNames):
+            image, file_id = load_image(datapath, data, file, idx)
+            if image is None:
+                continue
+            x.append(transform_images(image, model_name, input_shape_type))
+            y.append(dataset[idx, 1:25])
+            ids.append((data, file_id))
+            if len(x) == chunk_size:
+                chunk = (np.array(x), np.true_divide(np.array(y, dtype=np.float64), 2767.1))
+                yield chunk + (ids,) if return_ids else chunk
+                x = []
+                y = []
+                ids = []
+    if len(x) > 0:
+        chunk = (np.array(x), np.true_divide(np.array(y, dtype=np.float64), 2767.1))
+        yield chunk + (ids,) if return_ids else chunk
+
+
+def store_manifest(datapath, datasets, model_name, input_shape_type):
+    # what a store is built from: the folders and the input transform of the model type
+    img_rows, img_cols, _ = image_shape(model_name, input_shape_type)
+    return {'datapath': os.path.normpath(datapath), 'datasets': list(datasets), 'shape': input_shape_type,
+            'image': [img_rows, img_cols]}
+
+
+def store_key(manifest):
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def load_dataset_store(datapath, datasets, model_name, input_shape_type, store_path, chunk_size=4096):
+    # decode the TIFFs once into .npy files on disk and hand out memory maps of them,
+    # so later runs and later passes never hold the whole dataset in RAM
+    manifest = store_manifest(datapath, datasets, model_name, input_shape_type)
+    if os.path.exists(store_path + '_x.npy'):
+        if not os.path.exists(store_path + '.json'):
+            raise ValueError('{} has no manifest, delete it to rebuild'.format(store_path))
+        with open(store_path + '.json') as manifest_file:
+            if json.load(manifest_file) != manifest:
+                raise ValueError('{} was built from other datasets or another input transform, '
+                                 'delete it or choose another store'.format(store_path))
+    else:
+        store_folder = os.path.dirname(store_path)
+        if store_folder and not os.path.exists(store_folder):
+            os.makedirs(store_folder)
+        img_rows, img_cols, _ = image_shape(model_name, input_shape_type)
+        n_samples = count_samples(datapath, datasets)
+        x_store = np.lib.format.open_memmap(store_path + '_x.tmp.npy', mode='w+', dtype=np.uint8,
+                                            shape=(n_samples, img_rows, img_cols))
+        y_store = np.lib.format.open_memmap(store_path + '_y.tmp.npy', mode='w+', dtype=np.float64,
+                                            shape=(n_samples, 24))
+        count = 0
+        for x, y in iter_dataset(datapath, datasets, model_name, input_shape_type, chunk_size):
+            x_store[count:count + len(x)] = x
+            y_store[count:count + len(y)] = y
+            count += len(x)
+        x_store.flush()
+        y_store.flush()
+        del x_store, y_store
+        if count < n_samples:
+            # some images could not be decoded, rewrite without the unused tail
+            np.save(store_path + '_x.npy', np.load(store_path + '_x.tmp.npy', mmap_mode='r')[:count])
+            np.save(store_path + '_y.npy', np.load(store_path + '_y.tmp.npy', mmap_mode='r')[:count])
+            os.remove(store_path + '_x.tmp.npy')
+            os.remove(store_path + '_y.tmp.npy')
+        else:
+            os.replace(store_path + '_x.tmp.npy', store_path + '_x.npy')
+            os.replace(store_path + '_y.tmp.npy', store_path + '_y.npy')
+        with open(store_path + '.json', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    return np.load(store_path + '_x.npy', mmap_mode='r'), np.load(store_path + '_y.npy', mmap_mode='r')
+
+
+def iter_batches(x, y, chunk_size, rng=None):
+    # with rng every chunk is a random sample of all rows (the store is in folder order),
+    # read in sorted order so the reads stay mostly sequential
+    if rng is None:
+        for start in range(0, len(x), chunk_size):
+            yield np.asarray(x[start:start + chunk_size]), np.asarray(y[start:start + chunk_size])
+        return
+    order = rng.permutation(len(x))
+    for start in range(0, len(x), chunk_size):
+        rows = np.sort(order[start:start + chunk_size])
+        yield np.asarray(x[rows]), np.asarray(y[rows])
+
+
+OUT_OF_CORE_MODELS = ('rf', 'extratree', 'mlp', 'svm') + LINEAR_MODELS
+
+
+def fit_out_of_core(model, model_name, x, y, chunk_size, epochs, seed=0):
+    n_chunks = max(1, -(-len(x) // chunk_size))
+    rng = np.random.RandomState(seed)
+    if model_name.startswith('rf') or model_name.startswith('extratree'):
+        # every chunk (a random sample of all folders) grows its share of the trees, i.e. bagging over
+        # disjoint random subsets; the first chunks take the remainder so the total is n_estimators
+        n_estimators = model.n_estimators
+        if n_chunks > n_estimators:
+            # every chunk needs at least one tree, otherwise the rest of the store is never read
+            chunk_size = -(-len(x) // n_estimators)
+            n_chunks = -(-len(x) // chunk_size)
+            print('{} trees over {} samples: chunks grown to {} samples'.format(n_estimators, len(x), chunk_size))
+        trees = [n_estimators // n_chunks + (1 if i < n_estimators % n_chunks else 0) for i in range(n_chunks)]
+        model.set_params(warm_start=True, n_estimators=0)
+        for (x_chunk, y_chunk), chunk_trees in zip(iter_batches(x, y, chunk_size, rng), trees):
+            model.set_params(n_estimators=model.n_estimators + chunk_trees)
+            model.fit(x_chunk, y_chunk)
+    elif model_name.startswith('mlp'):
+        # lbfgs needs the full batch, adam can be fed chunk by chunk, in a new random order every epoch
+        model.set_params(solver='adam')
+        for epoch in range(epochs):
+            for x_chunk, y_chunk in iter_batches(x, y, chunk_size, rng):
+                model.partial_fit(x_chunk, y_chunk)
+    elif model_name.startswith('svm'):
+        # the feature map is fixed from a random sample of the whole store first, the sums do not
+        # depend on the chunk order
+        model.init_features(x)
+        for x_chunk, y_chunk in iter_batches(x, y, chunk_size):
+            model.partial_fit(x_chunk, y_chunk)
+        model.solve()
+    elif model_name.startswith(LINEAR_MODELS):
+        # exact solution from the accumulated Gram matrix, one pass over the chunks
+        model = linear_stream.from_sklearn(model)
+        for x_chunk, y_chunk in iter_batches(x, y, chunk_size):
+            model.partial_fit(x_chunk, y_chunk)
+        model.solve()
+    else:
+        raise ValueError('{} does not support incremental fitting'.format(model_name))
+    return model
+
+
+def reshape_input(x, model_name, img_rows, img_cols, channels):
+    if model_name.startswith('cnn'):
+        if K.image_data_format() == 'channels_first':
+            x = x.reshape(x.shape[0], channels, img_rows, img_cols)
+            input_shape = (channels, img_rows, img_cols)
+        else:
+            x = x.reshape(x.shape[0], img_rows, img_cols, channels)
+            input_shape = (img_rows, img_cols, channels)
+    else:
+        x = x.reshape(x.shape[0], channels * img_rows * img_cols)
+        input_shape = channels * img_rows * img_cols
+    return x, input_shape
+
+
+def share_array(array, path):
+    # dump once, then every worker maps the same pages read-only
+    np.save(path, array)
+    return np.load(path, mmap_mode='r')
+
+
+def create_model(model_type, model_input_shape, loss_function, n_jobs=None):
     if model_type.startswith('cnn'):
         model = Sequential()
         model.add(Conv2D(16, kernel_size=(3, 3), padding='same', input_shape=model_input_shape, use_bias=False))
@@ -137,18 +495,20 @@ def create_model(model_type, model_input_shape, loss_function):
         model.add(Dense(1024, activation='relu'))
         model.add(Dropout(0.4))
         model.add(Dense(24, activation='sigmoid'))
-        model.compile(loss=loss_function, optimizer=Adam(lr=0.0005), metrics=['accuracy'])
+        model.compile(loss=loss_function, optimizer=Adam(lr=0.0005), metrics=spectrum_metrics())
     elif model_type.startswith('rf'):
-        regr = RandomForestRegressor(n_estimators=100, max_depth=30, random_state=2)
+        regr = RandomForestRegressor(n_estimators=100, max_depth=30, random_state=2, n_jobs=n_jobs)
         return regr
     elif model_type.startswith('svm'):
-        regr = SVR(kernel='rbf', C=1e3, gamma=0.1)
+        # SVR is single-output and cubic in the sample count, use a low-rank RBF kernel ridge instead
+        method = 'rff' if model_type.startswith('svm_rff') else 'nystroem'
+        regr = KernelApproximationRegressor(method=method, n_components=1000, alpha=1e-3)
         return regr
     elif model_type.startswith('lasso'):
         regr = Lasso()
         return regr
     elif model_type.startswith('lr'):
-        regr = LinearRegression()
+        regr = LinearRegression(n_jobs=n_jobs)
         return regr
     elif model_type.startswith('ridge'):
         regr = Ridge()
@@ -158,7 +518,7 @@ def create_model(model_type, model_input_shape, loss_function):
                             hidden_layer_sizes=(20, 10), random_state=1)
         return regr
     elif model_type.startswith('knn'):
-        regr = KNeighborsRegressor()
+        regr = HammingKNeighborsRegressor(n_jobs=n_jobs)
         return regr
     elif model_type.startswith('elasticnet'):
         regr = ElasticNet(random_state=0)
@@ -166,27 +526,68 @@ def create_model(model_type, model_input_shape, loss_function):
     elif model_type.startswith('extratree'):
         regr = ExtraTreesRegressor(n_estimators=10,
                                    max_features=32,  # Out of 20000
-                                   random_state=0)
+                                   random_state=0,
+                                   n_jobs=n_jobs)
         return regr
     elif model_type.startswith('dt'):
         regr = DecisionTreeRegressor(max_depth=5)
         return regr
+    elif model_type.startswith('gbr_exact'):
+        regr = MultiOutputRegressor(GradientBoostingRegressor(n_estimators=100, max_depth=5), n_jobs=n_jobs)
+        return regr
     elif model_type.startswith('gbr'):
-        regr = MultiOutputRegressor(GradientBoostingRegressor(n_estimators=100, max_depth=5))
+        regr = HistGradientBoostingMultiRegressor(n_estimators=100, max_depth=5, n_jobs=n_jobs)
         return regr
     elif model_type.startswith('ada'):
-        regr = MultiOutputRegressor(AdaBoostRegressor(n_estimators=300))
+        regr = MultiOutputRegressor(AdaBoostRegressor(n_estimators=300), n_jobs=n_jobs)
         return regr
     else:
         model = Sequential()
         model.add(Dense(512, activation='relu', input_dim=model_input_shape))
         model.add(Dense(512, activation='relu'))
         model.add(Dense(24, activation='sigmoid'))
-        model.compile(loss=loss_function, optimizer='adam', metrics=['accuracy'])
+        model.compile(loss=loss_function, optimizer='adam', metrics=spectrum_metrics())
+
+    return model
+
 
+def load_finetune_model(parent_path, loss_function, learning_rate, freeze_conv):
+    with open(parent_path + '.json', 'r') as json_file:
+        model = model_from_json(json_file.read())
+    model.load_weights(parent_path + '.h5')
+
+    if freeze_conv:
+        for layer in model.layers:
+            if isinstance(layer, Conv2D):
+                layer.trainable = False
+
+    # trainable flags only take effect on compile
+    model.compile(loss=loss_function, optimizer=Adam(lr=learning_rate), metrics=spectrum_metrics())
     return model
 
 
+def finetune_name(model_name, parent_path, datapath, datasets):
+    # <model>_ft_<parent>_<key>: the key covers the full parent path and the fine-tune datasets, so a
+    # fine-tune never shares its export or checkpoint folder with the parent, a from-scratch run or
+    # a fine-tune of another parent or on other data
+    key = hashlib.sha1(json.dumps([os.path.abspath(parent_path), datapath, datasets]).encode()).hexdigest()[:8]
+    return '{}_ft_{}_{}'.format(model_name, os.path.basename(parent_path), key)
+
+
+def write_lineage(export_path, parent_path, lineage):
+    with open(parent_path + '.h5', 'rb') as weight_file:
+        parent_sha256 = hashlib.sha256(weight_file.read()).hexdigest()
+    lineage = dict(lineage)
+    lineage['parent'] = parent_path
+    lineage['parent_sha256'] = parent_sha256
+    lineage['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    if os.path.exists(parent_path + '.lineage.json'):
+        with open(parent_path + '.lineage.json') as parent_lineage_file:
+            lineage['parent_lineage'] = json.load(parent_lineage_file)
+    with open(export_path + '.lineage.json', 'w') as lineage_file:
+        json.dump(lineage, lineage_file, indent=2)
+
+
 ## TRAIN
 DATAPATH_TRAIN = os.path.join('data', 'train')
 DATASETS_TRAIN = [
@@ -274,6 +675,31 @@ if __name__ == '__main__':
     parser.add_argument("-n", "--is_normalized", help="Set is Normalized", action='store_true')
     parser.add_argument("-d", "--data_type", help="Select data type.. (train, valid, test)",
                         default='train')
+    parser.add_argument("--checkpoint_every", help="Save a resumable checkpoint every N epochs (0: off)", default=10)
+    parser.add_argument("--resume", help="Resume from the latest checkpoint", action='store_true')
+    parser.add_argument("--early_stopping", help="Stop after N epochs without improvement (0: off)", default=0)
+    parser.add_argument("--monitor", help="Metric watched by early stopping "
+                                          "(val_loss, val_r2, val_diff_rmse, val_local_minmax_rmse)",
+                        default='val_loss')
+    parser.add_argument("--validation_freq", help="Validate every N epochs", default=1)
+    parser.add_argument("--validation_samples", help="Validate on a fixed random subset of N samples (0: all)",
+                        default=0)
+    parser.add_argument("-f", "--finetune_from", help="Fine-tune an existing model (path without .json/.h5)",
+                        default=None)
+    parser.add_argument("--finetune_datapath", help="Folder of the newly ingested datasets", default=DATAPATH_TRAIN)
+    parser.add_argument("--finetune_datasets", help="Newly ingested datasets, comma separated", default=None)
+    parser.add_argument("--replay_ratio", help="Replayed old training samples per new sample", default=0)
+    parser.add_argument("--freeze_conv", help="Keep the conv stack fixed while fine-tuning", action='store_true')
+    parser.add_argument("--learning_rate", help="Learning rate used for fine-tuning", default=0.0001)
+    parser.add_argument("-j", "--n_jobs", help="Worker count of the sklearn models (-1: all cores)", default=-1)
+    parser.add_argument("--out_of_core", help="Fit sklearn models chunk by chunk from a memory-mapped store "
+                                              "({})".format(', '.join(OUT_OF_CORE_MODELS)), action='store_true')
+    parser.add_argument("--chunk_size", help="Samples per chunk of --out_of_core", default=4096)
+    parser.add_argument("--store", help="Path prefix of the memory-mapped train store of --out_of_core",
+                        default=None)
+    parser.add_argument("--kernel_rank", help="Rank of the kernel approximation of svm", default=1000)
+    parser.add_argument("--export_forest", help="Also export tree models (rf, extratree, dt, gbr) as compiled "
+                                                "memory-mapped arrays", action='store_true')
 
     args = parser.parse_args()
     model_name = args.model
@@ -282,134 +708,57 @@ if __name__ == '__main__':
     loss_functions = args.loss_function
     input_shape_type = args.shape
 
-    DATAPATH = DATAPATH_TRAIN
-    DATASETS = DATASETS_TRAIN
-
-    if input_shape_type.startswith('rect'):
-        img_rows, img_cols, channels = 100, 200, 1
+    img_rows, img_cols, channels = image_shape(model_name, input_shape_type)
+
+    if args.finetune_from is not None:
+        if model_name.startswith('cnn') is False and model_name.startswith('nn') is False:
+            parser.error('--finetune_from needs a keras model (cnn, nn)')
+        if args.finetune_datasets is None:
+            parser.error('--finetune_from needs --finetune_datasets')
+
+        finetune_datasets = args.finetune_datasets.split(',')
+        print('Data Loading... Fine-tune dataset Start.')
+        x_train, y_train = load_dataset(args.finetune_datapath, finetune_datasets, model_name, input_shape_type)
+        replay_samples = int(len(x_train) * float(args.replay_ratio))
+        if replay_samples > 0:
+            x_replay, y_replay = load_dataset(DATAPATH_TRAIN, DATASETS_TRAIN, model_name, input_shape_type,
+                                              max_samples=replay_samples)
+            x_train = np.concatenate([x_train, x_replay])
+            y_train = np.concatenate([y_train, y_replay])
+        print('Data Loading... Fine-tune dataset Finished. ({} new, {} replayed)'.format(
+            len(x_train) - replay_samples, replay_samples))
+        model_name = finetune_name(model_name, args.finetune_from, args.finetune_datapath, finetune_datasets)
+    elif args.out_of_core:
+        if model_name.startswith(OUT_OF_CORE_MODELS) is False:
+            parser.error('--out_of_core supports {}'.format(', '.join(OUT_OF_CORE_MODELS)))
+        if args.is_normalized:
+            parser.error('--out_of_core does not support --is_normalized')
+        # the name changes with DATASETS_TRAIN, so an edited dataset list never reuses an old store
+        store_path = args.store or os.path.join('data', 'store', 'train_{}x{}_{}_{}'.format(
+            img_rows, img_cols, input_shape_type,
+            store_key(store_manifest(DATAPATH_TRAIN, DATASETS_TRAIN, model_name, input_shape_type))))
+        print('Data Loading... Train store {} Start.'.format(store_path))
+        x_train, y_train = load_dataset_store(DATAPATH_TRAIN, DATASETS_TRAIN, model_name, input_shape_type,
+                                              store_path)
+        print('Data Loading... Train store Finished.')
     else:
-        img_rows, img_cols, channels = 200, 200, 1
-
-    if model_name.startswith('cnn') is False and model_name.startswith('nn') is False:
-        img_rows = img_rows // 10
-        img_cols = img_cols // 10
-
-    x_train = []
-    y_train = []
-
-    print('Data Loading... Train dataset Start.')
-
-    # load Train dataset
-    for data in DATASETS:
-        dataframe = pd.read_csv(os.path.join(DATAPATH, '{}.csv'.format(data)), delim_whitespace=False, header=None)
-        dataset = dataframe.values
-
-        # split into input (X) and output (Y) variables
-        fileNames = dataset[:, 0]
-        y_train.extend(dataset[:, 1:25])
-        for idx, file in enumerate(fileNames):
-
-            try:
-                image = Image.open(os.path.join(DATAPATH, data, '{}.tiff'.format(int(file))))
-                image = np.array(image, dtype=np.uint8)
-            except (TypeError, FileNotFoundError) as te:
-                image = Image.open(os.path.join(DATAPATH, data, '{}.tiff'.format(idx + 1)))
-                try:
-                    image = np.array(image, dtype=np.uint8)
-                except:
-                    continue
-
-            if model_name.startswith('cnn') is False and model_name.startswith('nn') is False:
-                image = compress_image(image, 10)
-
-            if model_name.startswith('cnn_small'):
-                image = compress_image(image, 5)
-
-            if input_shape_type.startswith('rect'):
-                x_train.append(image)
-            else:
-                v_flipped_image = np.flip(image, 0)
-                square_image = np.vstack([image, v_flipped_image])
-                x_train.append(square_image)
-
-    print('Data Loading... Train dataset Finished.')
+        print('Data Loading... Train dataset Start.')
+        x_train, y_train = load_dataset(DATAPATH_TRAIN, DATASETS_TRAIN, model_name, input_shape_type)
+        print('Data Loading... Train dataset Finished.')
     print('Data Loading... Validation dataset Start.')
-
-    DATAPATH = DATAPATH_VALID
-    DATASETS = DATASETS_VALID
-
-    x_validation = []
-    y_validation = []
-    for data in DATASETS:
-        dataframe = pd.read_csv(os.path.join(DATAPATH, '{}.csv'.format(data)), delim_whitespace=False, header=None)
-        dataset = dataframe.values
-
-        # split into input (X) and output (Y) variables
-        fileNames = dataset[:, 0]
-        y_validation.extend(dataset[:, 1:25])
-        for idx, file in enumerate(fileNames):
-
-            try:
-                image = Image.open(os.path.join(DATAPATH, data, '{}.tiff'.format(int(file))))
-                image = np.array(image, dtype=np.uint8)
-            except (TypeError, FileNotFoundError) as te:
-                image = Image.open(os.path.join(DATAPATH, data, '{}.tiff'.format(idx + 1)))
-                try:
-                    image = np.array(image, dtype=np.uint8)
-                except:
-                    continue
-
-            if model_name.startswith('cnn') is False and model_name.startswith('nn') is False:
-                image = compress_image(image, 10)
-
-            if model_name.startswith('cnn_small'):
-                image = compress_image(image, 5)
-
-            if input_shape_type.startswith('rect'):
-                x_validation.append(image)
-            else:
-                v_flipped_image = np.flip(image, 0)
-                square_image = np.vstack([image, v_flipped_image])
-                x_validation.append(square_image)
-    print('Data Loading... Validation dataset Finished.')
-    x_train = np.array(x_train)
-    y_train = np.array(y_train)
-    y_train = np.true_divide(y_train, 2767.1)
-
-    x_validation = np.array(x_validation)
-    y_validation = np.array(y_validation)
-    y_validation = np.true_divide(y_validation, 2767.1)
+    x_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, model_name, input_shape_type,
+                                              max_samples=int(args.validation_samples) or None)
+    print('Data Loading... Validation dataset Finished. ({} samples)'.format(len(x_validation)))
 
     if args.is_normalized:
         print('y_train mean : ', y_train.mean(), np.std(y_train))
         MEAN = 0.5052
         STD = 0.2104
         y_train = scale(y_train, MEAN, STD)
-        y_validaton = scale(y_validaton, MEAN, STD)
+        y_validation = scale(y_validation, MEAN, STD)
 
-    if model_name.startswith('cnn'):
-        if K.image_data_format() == 'channels_first':
-            x_train = x_train.reshape(x_train.shape[0], channels, img_rows, img_cols)
-            y_train = y_train.reshape(y_train.shape[0], channels, img_rows, img_cols)
-
-            x_validation = x_validation.reshape(x_validation.shape[0], channels, img_rows, img_cols)
-            y_validaton = y_validaton.reshape(y_validaton.shape[0], channels, img_rows, img_cols)
-            input_shape = (channels, img_rows, img_cols)
-        else:
-            x_train = x_train.reshape(x_train.shape[0], img_rows, img_cols, channels)
-            x_validation = x_validation.reshape(x_validation.shape[0], img_rows, img_cols, channels)
-            input_shape = (img_rows, img_cols, channels)
-    else:
-        if K.image_data_format() == 'channels_first':
-            x_train = x_train.reshape(x_train.shape[0], channels * img_rows * img_cols)
-            y_train = y_train.reshape(y_train.shape[0], channels * img_rows * img_cols)
-            x_validation = x_validation.reshape(x_validation.shape[0], channels * img_rows * img_cols)
-            y_validaton = y_validaton.reshape(y_validaton.shape[0], channels * img_rows * img_cols)
-            input_shape = channels * img_rows * img_cols
-        else:
-            x_train = x_train.reshape(x_train.shape[0], img_rows * img_cols * channels)
-            x_validation = x_validation.reshape(x_validation.shape[0], img_rows * img_cols * channels)
-            input_shape = channels * img_rows * img_cols
+    x_train, input_shape = reshape_input(x_train, model_name, img_rows, img_cols, channels)
+    x_validation, _ = reshape_input(x_validation, model_name, img_rows, img_cols, channels)
 
     # for DEBUG
     # print('x shape:', x_train.shape)
@@ -417,21 +766,57 @@ if __name__ == '__main__':
     # print(x_train.shape[0], 'train samples')
 
     custom_loss = CustomLoss(loss_functions)
-    model = create_model(model_name, input_shape, custom_loss.custom_loss)
+    if args.finetune_from is not None:
+        model = load_finetune_model(args.finetune_from, custom_loss.custom_loss, float(args.learning_rate),
+                                    args.freeze_conv)
+    else:
+        model = create_model(model_name, input_shape, custom_loss.custom_loss, n_jobs=int(args.n_jobs))
+        if model_name.startswith('svm'):
+            model.set_params(n_components=int(args.kernel_rank))
 
     if model_name.startswith('cnn') or model_name.startswith('nn'):
+        checkpoint_folder = 'models/{}_{}_{}/checkpoints'.format(model_name, batch_size, epochs)
+        if not os.path.exists(checkpoint_folder):
+            os.makedirs(checkpoint_folder)
+        checkpoint_path = '{}/{}_{}'.format(checkpoint_folder, loss_functions, input_shape_type)
+
+        initial_epoch = 0
+        initial_history = {}
+        early_stopping_state = None
+        if args.resume:
+            resumed_model, initial_epoch, initial_history, early_stopping_state = load_checkpoint(
+                checkpoint_path, dict(METRIC_OBJECTS, custom_loss=custom_loss.custom_loss))
+            if resumed_model is not None:
+                model = resumed_model
+                print('Resumed from checkpoint at epoch {}'.format(initial_epoch))
+
+        callbacks = []
+        early_stopping = None
+        if int(args.early_stopping) > 0:
+            # patience counts validated epochs only when --validation_freq > 1
+            early_stopping = EarlyStopping(monitor=args.monitor, patience=int(args.early_stopping),
+                                           mode='max' if args.monitor.endswith('r2') else 'min',
+                                           restore_best_weights=True, verbose=1)
+            callbacks.append(early_stopping)
+        checkpoint = TrainingCheckpoint(checkpoint_path, int(args.checkpoint_every), initial_history, early_stopping,
+                                        early_stopping_state)
+        callbacks.append(checkpoint)
+
         tic()
-        history = model.fit(x_train, y_train,
-                            batch_size=batch_size,
-                            epochs=epochs,
-                            # pass validtation for monitoring
-                            # validation loss and metrics
-                            validation_data=(x_validation, y_validation))
+        model.fit(x_train, y_train,
+                  batch_size=batch_size,
+                  epochs=epochs,
+                  initial_epoch=initial_epoch,
+                  callbacks=callbacks,
+                  # pass validtation for monitoring
+                  # validation loss and metrics
+                  validation_data=(x_validation, y_validation),
+                  validation_freq=int(args.validation_freq))
         toc()
-        score = model.evaluate(x_train, y_train, verbose=0)
-        print('Train loss:', score[0])
-        print('Train accuracy:', score[1])
-        print("%s: %.2f%%" % (model.metrics_names[1], score[1] * 100))
+        history = checkpoint.history
+        score = model.evaluate(x_train, y_train, batch_size=batch_size, verbose=0)
+        for metric_name, value in zip(model.metrics_names, score):
+            print('Train {}: {:.4f}'.format(metric_name, value))
 
         # serialize model to JSON
         model_json = model.to_json()
@@ -450,19 +835,39 @@ if __name__ == '__main__':
             model_export_path_template.format(model_export_path_folder, loss_functions, input_shape_type, 'h5'))
         print("Saved model to disk")
 
+        if args.finetune_from is not None:
+            write_lineage(os.path.splitext(model_export_path)[0], args.finetune_from, {
+                'datapath': args.finetune_datapath,
+                'datasets': finetune_datasets,
+                'replay_samples': replay_samples,
+                'freeze_conv': args.freeze_conv,
+                'learning_rate': float(args.learning_rate),
+                'loss_function': loss_functions,
+                'epochs': len(history['loss']),
+            })
+
         # Loss
-        plt.plot(history.history['loss'])
-        plt.plot(history.history['val_loss'])
+        plt.plot(history['loss'])
+        legend = ['Training']
+        # no validation entries when no validated epoch ran (--validation_freq > epochs)
+        if 'val_loss' in history:
+            plt.plot(history.get('val_epoch', range(len(history['val_loss']))), history['val_loss'])
+            legend.append('Validation')
         plt.xlabel('Epoch')
         plt.ylabel('Loss')
         plt.title('Model - Loss')
-        plt.legend(['Training', 'Validation'], loc='upper right')
+        plt.legend(legend, loc='upper right')
         train_progress_figure_path_folder = 'result/train_progress'
         if not os.path.exists(train_progress_figure_path_folder):
             os.makedirs(train_progress_figure_path_folder)
         plt.savefig('{}/{}_{}.png'.format(train_progress_figure_path_folder, model_name, loss_functions))
     else:
-        regr = model.fit(x_train, y_train)
+        tic()
+        if args.out_of_core:
+            model = fit_out_of_core(model, model_name, x_train, y_train, int(args.chunk_size), epochs)
+        else:
+            model.fit(x_train, y_train)
+        toc()
 
         model_export_path_folder = 'models/{}_{}_{}'.format(model_name, batch_size, epochs)
         if not os.path.exists(model_export_path_folder):
@@ -473,3 +878,7 @@ if __name__ == '__main__':
                                                               input_shape_type)
         joblib.dump(model, model_export_path)
         print("Saved model to disk")
+
+        if args.export_forest:
+            compile_forest(model).save(forest_path(model_export_path))
+            print("Saved compiled forest to {}".format(forest_path(model_export_path)))
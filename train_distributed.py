@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from train import DATAPATH_TRAIN, DATASETS_TRAIN, DATAPATH_VALID, DATASETS_VALID
+from train import CustomLoss, create_model, load_dataset, share_array, image_shape, reshape_input, tic, toc
+
+# Data-parallel training of the cnn / nn models with synchronous all-reduce
+# (tf.distribute.MultiWorkerMirroredStrategy).
+#
+# local, 4 worker processes on one machine (cores are split between them):
+#     python train_distributed.py -w 4
+# several hosts, start one worker per host with the same host list:
+#     python train_distributed.py --worker_hosts host1:2222,host2:2222 --task_index 0
+#     python train_distributed.py --worker_hosts host1:2222,host2:2222 --task_index 1
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def split_cores(workers):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    per_worker = max(1, len(cores) // workers)
+    return [cores[i * per_worker:(i + 1) * per_worker] or cores for i in range(workers)]
+
+
+def launch_local(args, argv):
+    workers = int(args.workers)
+    hosts = ','.join('localhost:{}'.format(free_port()) for _ in range(workers))
+    img_rows, img_cols, channels = image_shape(args.model, args.shape)
+
+    # load once, every worker maps the same arrays read-only
+    cache_dir = tempfile.mkdtemp(prefix='train_distributed_',
+                                 dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    print('Data Loading... Start.')
+    x_train, y_train = load_dataset(DATAPATH_TRAIN, DATASETS_TRAIN, args.model, args.shape)
+    x_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, args.model, args.shape)
+    for key, array in [('x_train', x_train), ('y_train', y_train),
+                       ('x_validation', x_validation), ('y_validation', y_validation)]:
+        share_array(array, os.path.join(cache_dir, '{}.npy'.format(key)))
+    del x_train, y_train, x_validation, y_validation
+    print('Data Loading... Finished.')
+
+    processes = []
+    try:
+        for task_index, cores in enumerate(split_cores(workers)):
+            command = [sys.executable, os.path.abspath(__file__)] + argv + [
+                '--worker_hosts', hosts,
+                '--task_index', str(task_index),
+                '--cores', ','.join(str(core) for core in cores),
+                '--data_cache', cache_dir,
+            ]
+            processes.append(subprocess.Popen(command))
+        return_codes = [process.wait() for process in processes]
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        for key in ['x_train', 'y_train', 'x_validation', 'y_validation']:
+            os.remove(os.path.join(cache_dir, '{}.npy'.format(key)))
+        os.rmdir(cache_dir)
+
+    if any(return_codes):
+        sys.exit('worker failed with exit codes {}'.format(return_codes))
+
+
+def make_distributed_dataset(strategy, x, y, per_worker_batch_size, shuffle, seed=0):
+    import tensorflow as tf
+
+    def gather(batch):
+        # sorted rows read the (memory-mapped) arrays sequentially
+        batch = np.sort(batch)
+        return np.asarray(x[batch], dtype=np.float32), np.asarray(y[batch], dtype=np.float32)
+
+    def read(batch):
+        x_batch, y_batch = tf.numpy_function(gather, [batch], [tf.float32, tf.float32])
+        x_batch.set_shape((None,) + x.shape[1:])
+        y_batch.set_shape((None,) + y.shape[1:])
+        return x_batch, y_batch
+
+    def dataset_fn(input_context):
+        # every input pipeline reads its own strided shard of the samples, batch by batch from the
+        # arrays (no graph constant, so the shard size is not bounded by the 2 GB graph limit)
+        shard = range(input_context.input_pipeline_id, len(x), input_context.num_input_pipelines)
+        dataset = tf.data.Dataset.range(shard.start, shard.stop, shard.step)
+        if shuffle:
+            dataset = dataset.shuffle(len(shard), seed=seed, reshuffle_each_iteration=True)
+        dataset = dataset.repeat().batch(per_worker_batch_size, drop_remainder=True)
+        return dataset.map(read).prefetch(2)
+
+    return strategy.distribute_datasets_from_function(dataset_fn)
+
+
+def run_worker(args):
+    hosts = args.worker_hosts.split(',')
+    task_index = int(args.task_index)
+    num_workers = len(hosts)
+    os.environ['TF_CONFIG'] = json.dumps({
+        'cluster': {'worker': hosts},
+        'task': {'type': 'worker', 'index': task_index},
+    })
+
+    threads = os.cpu_count()
+    if args.cores:
+        cores = [int(core) for core in args.cores.split(',')]
+        os.sched_setaffinity(0, cores)
+        threads = len(cores)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+
+    model_name = args.model
+    batch_size = int(args.batch_size)
+    epochs = int(args.epochs)
+    loss_functions = args.loss_function
+    img_rows, img_cols, channels = image_shape(model_name, args.shape)
+
+    if args.data_cache:
+        x_train = np.load(os.path.join(args.data_cache, 'x_train.npy'), mmap_mode='r')
+        y_train = np.load(os.path.join(args.data_cache, 'y_train.npy'), mmap_mode='r')
+        x_validation = np.load(os.path.join(args.data_cache, 'x_validation.npy'), mmap_mode='r')
+        y_validation = np.load(os.path.join(args.data_cache, 'y_validation.npy'), mmap_mode='r')
+    else:
+        x_train, y_train = load_dataset(DATAPATH_TRAIN, DATASETS_TRAIN, model_name, args.shape)
+        x_validation, y_validation = load_dataset(DATAPATH_VALID, DATASETS_VALID, model_name, args.shape)
+    x_train, input_shape = reshape_input(x_train, model_name, img_rows, img_cols, channels)
+    x_validation, _ = reshape_input(x_validation, model_name, img_rows, img_cols, channels)
+
+    # -b is the per-worker batch, so every worker keeps the single process step cost
+    steps_per_epoch = (len(x_train) // num_workers) // batch_size
+    validation_steps = max(1, (len(x_validation) // num_workers) // batch_size)
+    train_dataset = make_distributed_dataset(strategy, x_train, y_train, batch_size, shuffle=True)
+    validation_dataset = make_distributed_dataset(strategy, x_validation, y_validation, batch_size, shuffle=False)
+
+    custom_loss = CustomLoss(loss_functions)
+    # the architecture comes from create_model, the variables are created under the strategy
+    model_json = create_model(model_name, input_shape, custom_loss.custom_loss).to_json()
+    with strategy.scope():
+        model = tf.keras.models.model_from_json(model_json)
+        learning_rate = (0.0005 if model_name.startswith('cnn') else 0.001)
+        if args.scale_lr:
+            learning_rate *= num_workers
+        model.compile(loss=custom_loss.custom_loss, optimizer=tf.keras.optimizers.Adam(learning_rate))
+
+    is_chief = task_index == 0
+
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch_start = time.time()
+
+        def on_epoch_end(self, epoch, logs=None):
+            epoch_time = time.time() - self.epoch_start
+            if is_chief:
+                print('epoch {}: {:.2f}s, {:.0f} samples/s'.format(
+                    epoch + 1, epoch_time, steps_per_epoch * batch_size * num_workers / epoch_time))
+
+    tic()
+    history = model.fit(train_dataset,
+                        epochs=epochs,
+                        steps_per_epoch=steps_per_epoch,
+                        validation_data=validation_dataset,
+                        validation_steps=validation_steps,
+                        callbacks=[EpochTimer()],
+                        verbose=2 if is_chief else 0)
+    toc()
+
+    if is_chief:
+        model_export_path_folder = 'models/{}_dp{}_{}_{}'.format(model_name, num_workers, batch_size, epochs)
+        if not os.path.exists(model_export_path_folder):
+            os.makedirs(model_export_path_folder)
+        model_export_path = '{}/{}_{}_1'.format(model_export_path_folder, loss_functions, args.shape)
+        with open(model_export_path + '.json', 'w') as json_file:
+            json_file.write(model.to_json())
+        model.save_weights(model_export_path + '.h5')
+        with open(model_export_path + '.history.json', 'w') as history_file:
+            json.dump(dict((key, [float(v) for v in values]) for key, values in history.history.items()),
+                      history_file)
+        print("Saved model to disk")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", help="Select model type. (cnn, nn)", default="cnn")
+    parser.add_argument("-s", "--shape", help="Select input image shape. (rectangle or square?)", default='rect')
+    parser.add_argument("-l", "--loss_function", help="Select loss functions.. (rmse,diff_rmse,diff_ce)",
+                        default='rmse')
+    parser.add_argument("-e", "--epochs", help="Set epochs", default=300)
+    parser.add_argument("-b", "--batch_size", help="Set batch size per worker", default=128)
+    parser.add_argument("-w", "--workers", help="Start this many local worker processes", default=1)
+    parser.add_argument("--scale_lr", help="Scale the learning rate with the number of workers",
+                        action='store_true')
+    parser.add_argument("--worker_hosts", help="host:port of every worker, comma separated", default=None)
+    parser.add_argument("--task_index", help="Index of this worker in --worker_hosts", default=None)
+    parser.add_argument("--cores", help="Pin this worker to the given cores, comma separated", default=None)
+    parser.add_argument("--data_cache", help="Folder with the shared .npy arrays of the local launcher",
+                        default=None)
+
+    args = parser.parse_args()
+    if args.model.startswith('cnn') is False and args.model.startswith('nn') is False:
+        parser.error('data-parallel training supports the keras models only (cnn, nn)')
+
+    if args.task_index is None:
+        if args.worker_hosts is not None:
+            parser.error('--worker_hosts needs --task_index')
+        launch_local(args, sys.argv[1:])
+    else:
+        run_worker(args)